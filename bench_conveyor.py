@@ -0,0 +1,371 @@
+"""Benchmarks de extremo a extremo del sistema de cinta transportadora (sin pantalla)
+
+Mide con cargas sintéticas el protocolo (texto, JSON y binario), el conteo, la inserción y
+búsqueda en el log, la exportación CSV, el almacenamiento de eventos y el camino completo
+socket → motor → cola de la GUI. Con --capture se reproduce además una captura real de
+la ESP32. Reporta throughput, latencias p50/p99 y pico de memoria:
+
+    python bench_conveyor.py
+    python bench_conveyor.py --sizes 10000,100000 --export-rows 1000000 --save base.json
+    python bench_conveyor.py --compare base.json --capture captura_planta.cap
+"""
+import argparse
+import json
+import os
+import platform
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from conveyor_core import (
+    COLOR_FRAME, COUNT_COLORS, DATA_FRAME, FRAME_COLOR, FRAME_DATA, FRAME_DETECTION,
+    FRAME_HEADER, CaptureReader, ConveyorEngine, CountHistory, IndexedLogBuffer, LogRecord, write_count_csv,
+)
+from conveyor_store import EventStore
+
+# ========== CARGAS SINTÉTICAS ==========
+
+def protocol_messages(n):
+    """Mezcla representativa de lo que envía la ESP32"""
+    base = [
+        "DETECTADO",
+        "Color: ROJO",
+        "DETECTADO",
+        "Color: AZUL",
+        '{"type":"update","red":5,"green":1,"blue":0,"other":0,"total":6,"detections":7,"status":1,'
+        '"speed":75,"last_color":"VERDE"}',
+        '{"type":"status","stm32":1,"speed":75,"detections":7}',
+        '{"type":"data","red":5,"green":1,"blue":0,"other":0,"total":6,"detections":7,"color":"NINGUNO"}',
+        '{"type": "update", "red": ',  # Mensaje corrupto
+    ]
+    return [base[i % len(base)] for i in range(n)]
+
+def binary_frames(n):
+    """Tramas de detección, color y datos en un solo buffer: [(tipo, offset, largo)]"""
+    buf = bytearray()
+    frames = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            frame_type, payload = FRAME_DETECTION, b""
+        elif kind == 1:
+            frame_type, payload = FRAME_COLOR, COLOR_FRAME.pack(i % len(COUNT_COLORS))
+        else:
+            frame_type, payload = FRAME_DATA, DATA_FRAME.pack(i, i, i, i, 4 * i, i, 0)
+        offset = len(buf) + FRAME_HEADER.size
+        buf += FRAME_HEADER.pack(len(payload), frame_type) + payload
+        frames.append((frame_type, offset, len(payload)))
+    return buf, frames
+
+def quiet_engine():
+    """Motor con una línea y sin suscriptores (el costo del bus se mide aparte)"""
+    engine = ConveyorEngine()
+    engine.add_line("Bench")
+    engine.run_sync(lambda: None)
+    return engine
+
+# ========== MEDICIÓN ==========
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def measure(name, size, setup, run, per_op=True):
+    """Ejecuta run(state) dos veces: una cronometrada y otra con tracemalloc para el pico
+    
+    run devuelve la lista de latencias por operación (ns) si per_op, o None si la
+    operación es única y la latencia es la duración total.
+    """
+    state = setup()
+    start = time.perf_counter()
+    latencies = run(state)
+    elapsed = time.perf_counter() - start
+    cleanup(state)
+    
+    state = setup()
+    tracemalloc.start()
+    run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cleanup(state)
+    
+    if per_op and latencies:
+        latencies.sort()
+        p50 = percentile(latencies, 0.50) / 1000
+        p99 = percentile(latencies, 0.99) / 1000
+    else:
+        p50 = p99 = elapsed * 1e6
+    return {
+        "benchmark": name,
+        "size": size,
+        "seconds": elapsed,
+        "ops_per_s": size / elapsed if elapsed else 0.0,
+        "p50_us": p50,
+        "p99_us": p99,
+        "peak_mb": peak / (1 << 20),
+    }
+
+def cleanup(state):
+    for item in state if isinstance(state, tuple) else (state,):
+        if isinstance(item, ConveyorEngine):
+            item.shutdown()
+        elif isinstance(item, EventStore):
+            item.close()
+        elif isinstance(item, CountHistory):
+            item.close()
+        elif isinstance(item, str) and os.path.exists(item):
+            os.remove(item)
+
+def timed_loop(items, fn):
+    clock = time.perf_counter_ns
+    latencies = []
+    append = latencies.append
+    for item in items:
+        t0 = clock()
+        fn(item)
+        append(clock() - t0)
+    return latencies
+
+# ========== BENCHMARKS ==========
+
+def bench_protocol(size):
+    messages = protocol_messages(size)
+    
+    def run(engine):
+        handle = engine.handle_line
+        return timed_loop(messages, lambda data: handle("Bench", data))
+    return measure("protocolo_texto_json", size, quiet_engine, run)
+
+def bench_binary(size):
+    buf, frames = binary_frames(size)
+    
+    def run(engine):
+        handle = engine.handle_frame
+        return timed_loop(frames, lambda frame: handle("Bench", frame[0], buf, frame[1], frame[2]))
+    return measure("protocolo_binario", size, quiet_engine, run)
+
+def bench_counting(size):
+    colors = [COUNT_COLORS[i % len(COUNT_COLORS)] for i in range(size)]
+    
+    def run(engine):
+        line = engine.lines["Bench"]
+        accumulate = engine.accumulate_count
+        return timed_loop(colors, lambda color: accumulate(line, color))
+    return measure("conteo", size, quiet_engine, run)
+
+def bench_bus(size):
+    """Publicación en el bus con la GUI suscrita (cola) y espera hasta que la consume otro hilo"""
+    def setup():
+        engine = quiet_engine()
+        events = queue.Queue()
+        engine.bus.subscribe(lambda event: events.put((time.perf_counter_ns(), event)))
+        return engine, events
+    
+    def run(state):
+        engine, events = state
+        waits = []
+        
+        def consume():
+            for _ in range(size):
+                sent, _ = events.get()
+                waits.append(time.perf_counter_ns() - sent)
+        
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        for _ in range(size):
+            engine.bus.publish("counts", "Bench")
+        consumer.join()
+        return waits
+    return measure("bus_espera_en_cola", size, setup, run)
+
+def bench_log(size):
+    categories = ("Conteo", "Detecciones", "Comunicación", "Errores")
+    records = [LogRecord(time.time(), categories[i % 4], f"Caja ROJO contada (Total: {i})") for i in range(size)]
+    
+    def run(buffer):
+        return timed_loop(records, buffer.append)
+    return measure("log_insercion", size, lambda: IndexedLogBuffer(min(size, 50000)), run)
+
+def bench_log_search(size):
+    def setup():
+        buffer = IndexedLogBuffer(min(size, 50000))
+        for i in range(size):
+            category = "Errores" if i % 10 == 0 else "Conteo"
+            buffer.append(LogRecord(time.time(), category, f"Caja ROJO contada (Total: {i})"))
+        return buffer
+    
+    queries = [dict(category="Errores"), dict(text="caja rojo"), dict(text="tot", category="Conteo")] * 10
+    
+    def run(buffer):
+        return timed_loop(queries, lambda query: buffer.search(**query))
+    result = measure("log_busqueda", size, setup, run)
+    result["ops_per_s"] = len(queries) / result["seconds"] if result["seconds"] else 0.0
+    return result
+
+def bench_export(size):
+    def setup():
+        history = CountHistory()
+        now = time.time()
+        for i in range(size):
+            history.append(now + i, COUNT_COLORS[i % 4], (i, i, i, i, 4 * i, i), "Bench")
+        fd, filename = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        return history, filename
+    
+    def run(state):
+        history, filename = state
+        snapshot = history.snapshot()
+        try:
+            write_count_csv(snapshot, filename)
+        finally:
+            snapshot.close()
+        return None
+    return measure("exportacion_csv", size, setup, run, per_op=False)
+
+def bench_store(size):
+    def setup():
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        return EventStore(path), path
+    
+    def run(state):
+        store, _ = state
+        latencies = timed_loop(range(size), lambda i: store.record("count", "Bench", "ROJO", i, (i, 0, 0, 0, i, 0)))
+        while store.written < size and store.error is None:
+            time.sleep(0.005)
+        return latencies
+    # La duración incluye la espera hasta que el escritor confirmó todos los lotes
+    return measure("almacen_eventos", size, setup, run)
+
+def bench_end_to_end(size):
+    """Socket local → transporte → protocolo → bus → cola de la GUI, con size cajas"""
+    payload = "".join(f"DETECTADO\nColor: {COUNT_COLORS[i % 4]}\n" for i in range(size)).encode("utf-8")
+    
+    def setup():
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        
+        def serve():
+            conn, _ = server.accept()
+            conn.sendall(payload)
+            while conn.recv(4096):  # Descartar los comandos hasta que el cliente cierre
+                pass
+            conn.close()
+            server.close()
+        
+        threading.Thread(target=serve, daemon=True).start()
+        engine = ConveyorEngine()
+        engine.add_line("Bench", "127.0.0.1", server.getsockname()[1])
+        events = queue.SimpleQueue()
+        engine.bus.subscribe(lambda event: events.put((time.perf_counter_ns(), event)))
+        return engine, events
+    
+    def run(state):
+        engine, events = state
+        engine.connect("Bench")
+        waits = []
+        counted = 0
+        while counted < size:
+            try:
+                sent, event = events.get(timeout=10)
+            except queue.Empty:
+                break  # El motor dejó de recibir: se reporta lo medido
+            waits.append(time.perf_counter_ns() - sent)
+            if event.kind == "counts":
+                counted += 1
+        return waits
+    return measure("extremo_a_extremo", size, setup, run)
+
+def bench_replay(path):
+    """Captura real de una ESP32 reproducida a máxima velocidad por el camino de parseo"""
+    reader = CaptureReader(path)
+    size = sum(1 for _ in reader)
+    reader.close()
+    
+    def run(engine):
+        engine.replay(path, 0).result()
+        return None
+    return measure("reproduccion_captura", size, quiet_engine, run, per_op=False)
+
+BENCHMARKS = {
+    "protocolo": bench_protocol,
+    "binario": bench_binary,
+    "conteo": bench_counting,
+    "bus": bench_bus,
+    "log": bench_log,
+    "busqueda": bench_log_search,
+    "almacen": bench_store,
+    "extremo": bench_end_to_end,
+}
+
+# ========== REPORTE ==========
+
+def print_results(results, baseline=None):
+    reference = {(r["benchmark"], r["size"]): r for r in (baseline or {}).get("results", [])}
+    header = f"{'benchmark':<22} {'tamaño':>9} {'ops/s':>12} {'p50 µs':>10} {'p99 µs':>10} {'pico MB':>9}"
+    if reference:
+        header += f" {'vs base':>9}"
+    print(header)
+    for r in results:
+        row = (f"{r['benchmark']:<22} {r['size']:>9} {r['ops_per_s']:>12.0f} {r['p50_us']:>10.2f} "
+               f"{r['p99_us']:>10.2f} {r['peak_mb']:>9.2f}")
+        base = reference.get((r["benchmark"], r["size"]))
+        if base and base["ops_per_s"]:
+            row += f" {r['ops_per_s'] / base['ops_per_s']:>8.2f}x"
+        print(row, flush=True)
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(",") if size]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks del sistema de cinta transportadora")
+    parser.add_argument("--sizes", type=parse_sizes, default=[10000, 100000],
+                        help="Tamaños de carga separados por comas")
+    parser.add_argument("--export-rows", type=parse_sizes, default=[100000, 1000000],
+                        help="Filas de la exportación CSV")
+    parser.add_argument("--only", help="Benchmarks a ejecutar, separados por comas: "
+                                       + ",".join(list(BENCHMARKS) + ["exportacion"]))
+    parser.add_argument("--capture", action="append", default=[],
+                        help="Captura grabada con --capture del servicio para reproducir (se puede repetir)")
+    parser.add_argument("--save", help="Guardar los resultados en JSON")
+    parser.add_argument("--compare", help="Resultados JSON anteriores para comparar")
+    args = parser.parse_args(argv)
+    
+    selected = args.only.split(",") if args.only else list(BENCHMARKS) + ["exportacion"]
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    
+    results = []
+    for name in selected:
+        if name == "exportacion":
+            results.extend(bench_export(rows) for rows in args.export_rows)
+        elif name in BENCHMARKS:
+            results.extend(BENCHMARKS[name](size) for size in args.sizes)
+        else:
+            parser.error(f"benchmark desconocido: {name}")
+    results.extend(bench_replay(path) for path in args.capture)
+    
+    print_results(results, baseline)
+    
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=2)
+        print(f"Resultados guardados en {args.save}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
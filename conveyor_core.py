@@ -0,0 +1,2564 @@
+"""Motor sin interfaz del sistema de cinta transportadora
+
+Contiene las sesiones con las ESP32, el protocolo, los contadores por línea y el bus de
+eventos al que se suscribe la GUI. Se puede ejecutar solo como servicio:
+
+    python conveyor_core.py --line "Línea 1=192.168.4.1:8080" --interval 1000
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import glob
+import gzip
+import http.server
+import json
+import mmap
+import os
+import queue
+import random
+import re
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime
+
+from conveyor_store import EventStore, STORE_FILENAME
+
+# Cantidad máxima de registros de log retenidos en memoria
+LOG_RETENTION = 50000
+
+# Historial de conteos: filas retenidas en memoria y tamaño de cada segmento volcado a disco
+HISTORY_HOT_ROWS = 100000
+HISTORY_SEGMENT_ROWS = 50000
+
+COUNT_COLORS = ("ROJO", "VERDE", "AZUL", "OTRO")
+
+class SpillSegments:
+    """Referencias a los segmentos volcados, compartidas por un historial y sus copias
+    
+    Un segmento se borra cuando lo suelta el último que lo usa: una exportación en curso
+    sigue leyendo aunque el historial se limpie o se cierre.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refs = {}  # ruta → historiales que la usan
+    
+    def acquire(self, paths):
+        with self.lock:
+            for path in paths:
+                self.refs[path] = self.refs.get(path, 0) + 1
+    
+    def release(self, paths):
+        unused = []
+        with self.lock:
+            for path in paths:
+                self.refs[path] -= 1
+                if not self.refs[path]:
+                    del self.refs[path]
+                    unused.append(path)
+        for path in unused:
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))  # Solo si ya no quedan segmentos
+            except OSError:
+                pass
+
+class CountHistory:
+    """Historial de conteos en arreglos tipados por columna, con volcado a disco"""
+    
+    COLUMNS = ("ROJO", "VERDE", "AZUL", "OTRO", "TOTAL", "DETECCIONES")
+    COLOR_CODES = {color: code for code, color in enumerate(COUNT_COLORS)}
+    HEADER = struct.Struct("<I")
+    
+    def __init__(self, hot_rows=HISTORY_HOT_ROWS, segment_rows=HISTORY_SEGMENT_ROWS):
+        self.hot_rows = max(1, hot_rows)
+        self.segment_rows = max(1, min(segment_rows, self.hot_rows))
+        self.spill_dir = None
+        self.segments = []  # (ruta, filas) de los segmentos volcados, del más antiguo al más nuevo
+        self.spilled_rows = 0
+        self.line_names = []  # Nombre de cada código de línea
+        self.line_codes = {}
+        self._segment_seq = 0  # Nunca se reutilizan nombres de segmento
+        self.spill_refs = SpillSegments()
+        self._new_columns()
+    
+    def _new_columns(self):
+        self.timestamps = array("d")
+        self.colors = array("B")
+        self.lines = array("H")
+        self.counts = [array("I") for _ in self.COLUMNS]
+    
+    def __len__(self):
+        return self.spilled_rows + len(self.timestamps)
+    
+    def append(self, timestamp, color, counts, line=""):
+        """Agrega una fila; counts sigue el orden de COLUMNS
+        
+        Los valores se validan antes de tocar ninguna columna para que un conteo
+        inválido no deje las columnas desalineadas.
+        """
+        row = array("I", counts)  # TypeError/OverflowError si no son enteros sin signo
+        if len(row) != len(self.COLUMNS):
+            raise ValueError(f"Se esperaban {len(self.COLUMNS)} conteos, llegaron {len(row)}")
+        color_code = self.COLOR_CODES.get(color, self.COLOR_CODES["OTRO"])
+        
+        code = self.line_codes.get(line)
+        if code is None:
+            code = self.line_codes[line] = len(self.line_names)
+            self.line_names.append(line)
+        
+        self.timestamps.append(timestamp)
+        self.colors.append(color_code)
+        self.lines.append(code)
+        for column, value in zip(self.counts, row):
+            column.append(value)
+        
+        if len(self.timestamps) >= self.hot_rows:
+            self._spill()
+    
+    def _spill(self):
+        """Vuelca a disco el segmento más antiguo de la ventana en memoria"""
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="conteo_historial_")
+        else:
+            os.makedirs(self.spill_dir, exist_ok=True)  # Se borra al soltar el último segmento
+        
+        rows = self.segment_rows
+        path = os.path.join(self.spill_dir, f"segmento_{self._segment_seq:06d}.bin")
+        self._segment_seq += 1
+        with open(path, "wb") as f:
+            f.write(self.HEADER.pack(rows))
+            for column in [self.timestamps, self.colors, self.lines] + self.counts:
+                column[:rows].tofile(f)
+                del column[:rows]
+        
+        self.segments.append((path, rows))
+        self.spill_refs.acquire([path])
+        self.spilled_rows += rows
+    
+    def _read_segment(self, path):
+        with open(path, "rb") as f:
+            rows, = self.HEADER.unpack(f.read(self.HEADER.size))
+            columns = []
+            for typecode in ["d", "B", "H"] + ["I"] * len(self.COLUMNS):
+                column = array(typecode)
+                column.fromfile(f, rows)
+                columns.append(column)
+        return columns
+    
+    def iter_rows(self):
+        """Recorre las filas en orden: (timestamp, color, ROJO, VERDE, AZUL, OTRO, TOTAL, DETECCIONES, línea)"""
+        for path, _ in self.segments:
+            yield from self._iter_columns(self._read_segment(path))
+        yield from self._iter_columns([self.timestamps, self.colors, self.lines] + self.counts)
+    
+    def _iter_columns(self, columns):
+        timestamps, colors, lines, *counts = columns
+        names = self.line_names
+        for timestamp, code, line, *values in zip(timestamps, colors, lines, *counts):
+            yield (timestamp, COUNT_COLORS[code], *values, names[line])
+    
+    def snapshot(self):
+        """Copia de solo lectura del historial; comparte los segmentos en disco hasta su close()"""
+        copy = CountHistory(self.hot_rows, self.segment_rows)
+        copy.spill_refs = self.spill_refs
+        copy.segments = list(self.segments)
+        self.spill_refs.acquire([path for path, _ in copy.segments])
+        copy.spilled_rows = self.spilled_rows
+        copy.line_names = list(self.line_names)
+        copy.line_codes = dict(self.line_codes)
+        copy.timestamps = array("d", self.timestamps)
+        copy.colors = array("B", self.colors)
+        copy.lines = array("H", self.lines)
+        copy.counts = [array("I", column) for column in self.counts]
+        return copy
+    
+    def clear(self):
+        segments, self.segments = self.segments, []
+        self.spill_refs.release([path for path, _ in segments])
+        self.spilled_rows = 0
+        self._new_columns()
+    
+    def close(self):
+        """Libera el historial; el directorio de volcado se borra con su último segmento"""
+        self.clear()
+        if self.spill_dir:
+            try:
+                os.rmdir(self.spill_dir)
+            except OSError:
+                pass
+            self.spill_dir = None
+
+# Exportación de conteos por bloques
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_BUFFER_BYTES = 1 << 20
+
+def write_count_csv(history, filename, cancel_event=None, progress=None):
+    """Escribe el historial de conteos en CSV por bloques; devuelve False si se canceló"""
+    total_rows = len(history)
+    written = 0
+    last_second = None
+    ts = ""
+    chunk = []
+    
+    with open(filename, "w", encoding='utf-8', buffering=EXPORT_BUFFER_BYTES) as f:
+        f.write("FECHA_HORA,COLOR,ROJO,VERDE,AZUL,OTRO,TOTAL,DETECCIONES,LINEA\n")
+        
+        for timestamp, color, red, green, blue, other, total, detections, line in history.iter_rows():
+            # Las filas de un mismo segundo comparten la fecha formateada
+            second = int(timestamp)
+            if second != last_second:
+                last_second = second
+                ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+            
+            chunk.append(f"{ts},{color},{red},{green},{blue},{other},{total},{detections},{line}\n")
+            
+            if len(chunk) >= EXPORT_CHUNK_ROWS:
+                f.writelines(chunk)
+                written += len(chunk)
+                chunk.clear()
+                
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                if progress:
+                    progress(written, total_rows)
+        
+        f.writelines(chunk)
+        written += len(chunk)
+    
+    if progress:
+        progress(written, total_rows)
+    return True
+
+def write_count_summary(summary, filename, per_line=()):
+    """Escribe el resumen final de conteo; per_line agrega el detalle (nombre, resumen) de cada línea"""
+    with open(filename, "w", encoding='utf-8') as f:
+        f.write("=== RESUMEN FINAL DE CONTEO ===\n")
+        f.write(f"Fecha y hora: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        for name, counts in [(None, summary)] + list(per_line):
+            if name:
+                f.write(f"--- {name} ---\n")
+            else:
+                f.write("=" * 40 + "\n")
+            f.write(f"Rojo: {counts['ROJO']}\n")
+            f.write(f"Verde: {counts['VERDE']}\n")
+            f.write(f"Azul: {counts['AZUL']}\n")
+            f.write(f"Otro: {counts['OTRO']}\n")
+            f.write(f"Total: {counts['TOTAL']}\n")
+            f.write(f"Detecciones: {counts['DETECCIONES']}\n")
+        f.write("=" * 40 + "\n")
+
+# Transporte TCP
+CONNECT_TIMEOUT_S = 5
+TEST_TIMEOUT_S = 3
+RECV_BUFFER_SIZE = 64 * 1024
+KEEPALIVE_OPTIONS = (("TCP_KEEPIDLE", 10), ("TCP_KEEPINTVL", 5), ("TCP_KEEPCNT", 3))
+SEND_BUFFER_SIZE = 4096  # Búfer de envío corto: lo encolado en el kernel no se puede adelantar
+
+def tune_socket(sock):
+    """Desactiva Nagle y activa keepalive para detectar enlaces caídos"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    for name, value in KEEPALIVE_OPTIONS:
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+# Protocolo binario opcional (negociado al conectar con BINARY_HELLO)
+#
+# La ESP32 que lo soporta responde {"type": "proto", "mode": "bin1"} y desde ese momento
+# envía tramas [longitud: uint16 LE][tipo: uint8][datos]. Los comandos siguen siendo texto.
+BINARY_HELLO = "PROTO BIN1"
+BINARY_MODE = "bin1"
+FRAME_HEADER = struct.Struct("<HB")
+FRAME_UPDATE = 0x01     # rojo, verde, azul, otro, total, detecciones, estado, velocidad, último color
+FRAME_DATA = 0x02       # rojo, verde, azul, otro, total, detecciones, color
+FRAME_STATUS = 0x03     # stm32, velocidad, detecciones
+FRAME_DETECTION = 0x04  # sin datos
+FRAME_COLOR = 0x05      # color
+FRAME_DELTA = 0x06      # secuencia, color (sincronización por eventos)
+FRAME_SNAPSHOT = 0x07   # secuencia, y los campos de FRAME_DATA (sincronización por eventos)
+FRAME_TEXT = 0x7F       # línea de texto/JSON en UTF-8 (alertas, errores, respuestas)
+FRAME_NAMES = {FRAME_UPDATE: "update", FRAME_DATA: "data", FRAME_STATUS: "status",
+               FRAME_DETECTION: "detection", FRAME_COLOR: "color", FRAME_DELTA: "delta",
+               FRAME_SNAPSHOT: "snapshot", FRAME_TEXT: "text"}
+UPDATE_FRAME = struct.Struct("<6IBBB")
+DATA_FRAME = struct.Struct("<6IB")
+DELTA_FRAME = struct.Struct("<IB")
+SNAPSHOT_FRAME = struct.Struct("<I6IB")
+STATUS_FRAME = struct.Struct("<BBI")
+COLOR_FRAME = struct.Struct("<B")
+NO_COLOR_CODE = 0xFF  # "NINGUNO"; los demás códigos son índices de COUNT_COLORS
+
+class Connection:
+    """Socket, tareas de lectura y escritura, modo de framing y cola de envío de una conexión"""
+    __slots__ = ("sock", "task", "binary", "on_line", "on_frame", "on_send_failed",
+                 "writer", "outbox", "urgent", "queued", "ready")
+    
+    def __init__(self, sock, on_line, on_frame, on_send_failed=None):
+        self.sock = sock
+        self.task = None
+        self.binary = False
+        self.on_line = on_line
+        self.on_frame = on_frame
+        self.on_send_failed = on_send_failed
+        
+        # Cola de envío: lo urgente sale antes que lo normal; queued son los envíos
+        # coalescibles pendientes (encolados o escribiéndose)
+        self.writer = None
+        self.outbox = deque()
+        self.urgent = deque()
+        self.queued = set()
+        self.ready = asyncio.Event()
+
+class AsyncTransport:
+    """Conexiones TCP con varias ESP32 multiplexadas en un único event loop
+    
+    Cada conexión se identifica con una clave (el nombre de la línea). El loop corre en
+    su propio hilo, con framing sin copias de líneas de texto o de tramas binarias; los
+    callbacks se invocan desde ese hilo.
+    """
+    
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.connections = {}  # clave → Connection
+    
+    def submit(self, coro):
+        """Programa una corrutina en el event loop desde cualquier hilo"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
+    def connect(self, key, host, port, on_line, on_connected, on_failed, on_closed, on_frame=None,
+                on_send_failed=None):
+        return self.submit(self._connect(key, host, port, on_line, on_connected, on_failed, on_closed, on_frame,
+                                         on_send_failed))
+    
+    def disconnect(self, key):
+        return self.submit(self._close(key))
+    
+    def queue_send(self, key, data, urgent=False, coalesce=False):
+        """Encola datos para la conexión sin bloquear; llamar desde el hilo del loop
+        
+        urgent adelanta los datos a todo lo encolado; coalesce los descarta si ya hay un
+        envío igual pendiente. Devuelve False si no se encolaron. Los errores de envío
+        llegan a on_send_failed.
+        """
+        conn = self.connections.get(key)
+        if conn is None:
+            return False
+        if coalesce:
+            if data in conn.queued:
+                return False
+            conn.queued.add(data)
+        (conn.urgent if urgent else conn.outbox).append(data)
+        conn.ready.set()
+        return True
+    
+    def discard(self, key, items):
+        """Quita de la cola de envío lo pendiente que esté en items y lo devuelve; llamar desde el hilo del loop"""
+        conn = self.connections.get(key)
+        if conn is None:
+            return []
+        discarded = [data for data in conn.outbox if data in items]
+        if discarded:
+            conn.outbox = deque(data for data in conn.outbox if data not in items)
+            conn.queued.difference_update(discarded)
+        return discarded
+    
+    def set_binary(self, key):
+        """Pasa la conexión a tramas binarias; llamar desde el hilo del loop (p. ej. desde on_line)"""
+        conn = self.connections.get(key)
+        if conn is not None and conn.on_frame is not None:
+            conn.binary = True
+    
+    def probe(self, host, port):
+        """Prueba de conexión; el futuro devuelve None o el mensaje de error"""
+        return self.submit(self._probe(host, port))
+    
+    def shutdown(self):
+        # Cerrar los sockets antes de detener el loop para no dejar tareas pendientes
+        try:
+            self.submit(self._close_all()).result(timeout=2)
+        except (concurrent.futures.TimeoutError, OSError):
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2)
+        if not self.loop.is_running():
+            self.loop.close()
+    
+    async def _open(self, host, port, timeout):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(self.loop.sock_connect(sock, (host, port)), timeout)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+    
+    async def _connect(self, key, host, port, on_line, on_connected, on_failed, on_closed, on_frame, on_send_failed):
+        await self._close(key)
+        try:
+            sock = await self._open(host, port, CONNECT_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            on_failed(f"Timeout: No se pudo conectar a {host}:{port}")
+            return
+        except ConnectionRefusedError:
+            on_failed(f"Conexión rechazada por {host}")
+            return
+        except Exception as e:
+            on_failed(f"Error conectando a {host}: {str(e)}")
+            return
+        
+        tune_socket(sock)
+        conn = self.connections[key] = Connection(sock, on_line, on_frame, on_send_failed)
+        conn.writer = self.loop.create_task(self._write(conn))
+        on_connected(host, port)
+        conn.task = self.loop.create_task(self._read(key, conn, on_closed))
+    
+    async def _read(self, key, conn, on_closed):
+        buf = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buf)
+        end = 0  # Bytes válidos en el buffer
+        error = None
+        metrics = self.metrics
+        clock = time.perf_counter
+        try:
+            while True:
+                if end == len(buf):
+                    # Mensaje más largo que el buffer: crecer (requiere liberar la vista)
+                    view.release()
+                    buf.extend(bytes(len(buf)))
+                    view = memoryview(buf)
+                
+                n = await self.loop.sock_recv_into(conn.sock, view[end:])
+                if not n:
+                    break
+                
+                received = clock()
+                start = self._consume(conn, buf, view, end, end + n)
+                metrics.observe("lectura", clock() - received)
+                metrics.inc("bytes_recibidos", "", n)
+                end += n
+                
+                # Mover el mensaje incompleto al inicio del buffer
+                if start:
+                    rest = end - start
+                    view[:rest] = view[start:end]
+                    end = rest
+                    
+        except asyncio.CancelledError:
+            # Desconexión solicitada: no se notifica
+            raise
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except Exception as e:
+            error = str(e)
+        finally:
+            view.release()
+        
+        # El escritor espera en conn.ready: sin cancelarlo quedaría pendiente para siempre
+        if conn.writer is not None:
+            conn.writer.cancel()
+        conn.sock.close()
+        if self.connections.get(key) is conn:
+            del self.connections[key]
+        on_closed(error)
+    
+    @staticmethod
+    def _consume(conn, buf, view, scan, end):
+        """Entrega los mensajes completos del buffer y devuelve dónde empieza el resto
+        
+        En modo texto solo se buscan saltos de línea desde scan (los bytes nuevos); el
+        modo puede cambiar a binario a mitad del buffer, tras la línea que lo negocia.
+        """
+        start = 0
+        while start < end:
+            if conn.binary:
+                if end - start < FRAME_HEADER.size:
+                    break
+                length, frame_type = FRAME_HEADER.unpack_from(buf, start)
+                frame_end = start + FRAME_HEADER.size + length
+                if frame_end > end:
+                    break
+                conn.on_frame(frame_type, buf, start + FRAME_HEADER.size, length)
+                start = frame_end
+            else:
+                newline = buf.find(b"\n", max(scan, start), end)
+                if newline == -1:
+                    break
+                line = str(view[start:newline], "utf-8", "ignore").strip()
+                if line:
+                    conn.on_line(line)
+                start = newline + 1
+        return start
+    
+    async def _close(self, key):
+        conn = self.connections.pop(key, None)
+        if conn is None:
+            return
+        for task in (conn.task, conn.writer):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        conn.sock.close()
+    
+    async def _close_all(self):
+        for key in list(self.connections):
+            await self._close(key)
+    
+    async def _write(self, conn):
+        """Vacía la cola de envío de la conexión; un enlace lento solo retrasa esta tarea"""
+        try:
+            while True:
+                if conn.urgent:
+                    data = conn.urgent.popleft()
+                elif conn.outbox:
+                    data = conn.outbox.popleft()
+                else:
+                    conn.ready.clear()
+                    await conn.ready.wait()
+                    continue
+                await self.loop.sock_sendall(conn.sock, data)
+                conn.queued.discard(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if conn.on_send_failed is not None:
+                conn.on_send_failed(e)
+    
+    async def _probe(self, host, port):
+        try:
+            sock = await self._open(host, port, TEST_TIMEOUT_S)
+            sock.close()
+            return None
+        except asyncio.TimeoutError:
+            return "timed out"
+        except Exception as e:
+            return str(e)
+
+# Vista combinada de todas las líneas
+PLANT_VIEW = "Planta (total)"
+
+# Actualización automática: suscripción (la ESP32 envía "update" en cada cambio) o consulta
+# adaptativa de GET_DATA que se acelera con cajas pasando y se espacia con la línea inactiva
+SUBSCRIBE_COMMAND = "SUBSCRIBE"
+POLL_MIN_MS = 100
+POLL_IDLE_MS = 10000
+
+# Sincronización por eventos: la ESP32 que responde {"type": "ok", "cmd": "delta"} envía un
+# snapshot base y luego un mensaje "delta" numerado por cada detección (con el color si la
+# caja se contó). Los snapshots llevan la secuencia del último evento que incluyen; ante un
+# hueco se pide uno y los anteriores al último evento aplicado se descartan
+DELTA_SYNC_COMMAND = "SYNC DELTA"
+
+# Cola de envío: consultas idempotentes (basta una pendiente) y comandos urgentes, que se
+# adelantan a lo encolado y anulan los comandos pendientes indicados
+COALESCED_COMMANDS = frozenset(("GET_DATA", "GET_STATUS"))
+URGENT_COMMANDS = {"STOP": (b"START\n",)}
+
+# Respuesta esperada de cada comando (tipo de mensaje, u "ok:<cmd>"). El firmware no devuelve
+# identificadores: cada respuesta se empareja con la solicitud pendiente más antigua que la espera.
+# Todas las genera la ESP32 (status sale de su estado en caché y ping_sent solo confirma el
+# reenvío), así que el tiempo de respuesta mide el enlace con la ESP32, nunca el tramo del STM32
+COMMAND_REPLIES = {
+    "GET_DATA": "data",
+    "START": "ok:start",
+    "STOP": "ok:stop",
+    "RESET_COUNTERS": "ok:reset",
+    "GET_STATUS": "status",
+    "PING_STM32": "ping_sent",
+}
+REQUEST_TIMEOUT_S = 3.0
+RTT_WINDOW = 100  # Muestras recientes para la salud del enlace
+
+# Reconexión automática tras un corte: espera exponencial con jitter entre intentos
+RECONNECT_BASE_S = 0.5
+RECONNECT_MAX_S = 30
+
+class PendingRequest:
+    """Comando enviado que espera su respuesta"""
+    __slots__ = ("id", "command", "reply", "sent", "handle")
+    
+    def __init__(self, request_id, command, reply, sent):
+        self.id = request_id
+        self.command = command
+        self.reply = reply
+        self.sent = sent
+        self.handle = None  # Timeout programado
+
+class LineState:
+    """Estado y contadores de una línea (cinta) conectada a su propia ESP32"""
+    
+    def __init__(self, name, host="192.168.4.1", port=8080):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.connected = False
+        self.system_running = False
+        self.stm32_connected = False
+        self.esp_status = 0
+        self.conveyor_speed = 75
+        self.current_color = "NINGUNO"
+        self.last_color_time = 0
+        self.protocol = "texto"  # "texto" o BINARY_MODE, negociado al conectar
+        self.push = False  # La ESP32 aceptó la suscripción a updates
+        self.delta = False  # La ESP32 aceptó la sincronización por eventos
+        self.seq = None  # Secuencia del último evento aplicado (None: sin snapshot base)
+        self.sync_pending = False  # Hueco en la secuencia: se espera un snapshot
+        self.poll_ms = None  # Intervalo actual de la consulta adaptativa
+        self.poll_mark = None  # (total, detecciones) en la consulta anterior
+        self.wanted = False  # El operador pidió la conexión (se reconecta si se corta)
+        self.reconnecting = False
+        self.reconnect_attempts = 0
+        self.resync = False  # Conciliar contadores con el primer snapshot tras reconectar
+        self.resync_base = None  # Contadores al cortarse la conexión, base de la conciliación
+        self.count_offset = (0,) * 6  # Se suma a los snapshots si la ESP32 reinició sus contadores
+        self.requests = deque()  # PendingRequest en orden de envío
+        self.rtt = deque(maxlen=RTT_WINDOW)  # Segundos, enlace con la ESP32
+        self.unanswered = 0  # Solicitudes seguidas sin respuesta
+        self.box_count = {color: 0 for color in COUNT_COLORS}
+        self.total_count = 0
+        self.detection_count = 0
+        
+        # Acumulador de datos en tiempo real (acumulativo)
+        self.realtime_counts = defaultdict(int)
+        self.realtime_detections = 0
+    
+    def set_color(self, color):
+        self.current_color = color
+        self.last_color_time = time.time()
+    
+    def counts(self):
+        """(rojo, verde, azul, otro, total, detecciones), en el orden de los snapshots"""
+        box = self.box_count
+        return (box["ROJO"], box["VERDE"], box["AZUL"], box["OTRO"], self.total_count, self.detection_count)
+    
+    def rtt_ms(self, fraction=0.5):
+        """Cuantil del tiempo de ida y vuelta reciente, en ms (None sin muestras)"""
+        samples = sorted(self.rtt)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+    
+    def reset_counts(self):
+        for color in self.box_count:
+            self.box_count[color] = 0
+        self.total_count = 0
+        self.detection_count = 0
+        self.realtime_counts.clear()
+        self.realtime_detections = 0
+        self.count_offset = (0,) * 6
+        self.resync_base = None
+    
+    @classmethod
+    def combine(cls, lines, name=PLANT_VIEW):
+        """Vista de planta: suma de contadores y estado agregado de varias líneas"""
+        plant = cls(name)
+        for line in lines:
+            for color, count in line.box_count.items():
+                plant.box_count[color] += count
+            for color, count in list(line.realtime_counts.items()):
+                plant.realtime_counts[color] += count
+            plant.total_count += line.total_count
+            plant.detection_count += line.detection_count
+            plant.realtime_detections += line.realtime_detections
+            plant.connected = plant.connected or line.connected
+            plant.reconnecting = plant.reconnecting or line.reconnecting
+            plant.system_running = plant.system_running or line.system_running
+            plant.esp_status = max(plant.esp_status, line.esp_status)
+            plant.unanswered = max(plant.unanswered, line.unanswered)
+            plant.rtt.extend(line.rtt)
+            if line.last_color_time >= plant.last_color_time:
+                plant.current_color = line.current_color
+                plant.last_color_time = line.last_color_time
+        
+        connected = [line for line in lines if line.connected]
+        plant.stm32_connected = bool(connected) and all(line.stm32_connected for line in connected)
+        return plant
+
+class LogRecord:
+    """Registro estructurado de un evento del log"""
+    __slots__ = ("timestamp", "category", "message", "_text")
+    
+    def __init__(self, timestamp, category, message):
+        self.timestamp = timestamp
+        self.category = category
+        self.message = message
+        self._text = None
+    
+    def format(self):
+        """Devuelve la línea de texto del registro (se formatea una sola vez)"""
+        if self._text is None:
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamp))
+            self._text = f"[{ts}] [{self.category}] {self.message}"
+        return self._text
+
+class LogRingBuffer:
+    """Buffer circular acotado de registros de log con inserción O(1)"""
+    
+    def __init__(self, capacity=LOG_RETENTION):
+        self.capacity = max(1, int(capacity))
+        self._items = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+        self.first_seq = 0  # Número de secuencia del registro más antiguo retenido
+    
+    def __len__(self):
+        return self._size
+    
+    def __iter__(self):
+        for i in range(self._size):
+            yield self._items[(self._start + i) % self.capacity]
+    
+    @property
+    def next_seq(self):
+        return self.first_seq + self._size
+    
+    def append(self, record):
+        if self._size < self.capacity:
+            self._items[(self._start + self._size) % self.capacity] = record
+            self._size += 1
+        else:
+            # Buffer lleno: se sobrescribe el registro más antiguo
+            self._items[self._start] = record
+            self._start = (self._start + 1) % self.capacity
+            self.first_seq += 1
+    
+    def get(self, seq):
+        """Registro con número de secuencia seq (debe estar retenido)"""
+        return self._items[(self._start + seq - self.first_seq) % self.capacity]
+    
+    def slice(self, start, stop):
+        """Devuelve los registros entre las posiciones lógicas start y stop"""
+        start = max(0, start)
+        stop = min(stop, self._size)
+        return [self._items[(self._start + i) % self.capacity] for i in range(start, stop)]
+    
+    def clear(self):
+        self.first_seq = self.next_seq
+        self._items = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+    
+    def resize(self, capacity):
+        """Cambia la retención conservando los registros más recientes"""
+        capacity = max(1, int(capacity))
+        records = self.slice(self._size - capacity, self._size)
+        self.first_seq += self._size - len(records)
+        self.capacity = capacity
+        self._items = records + [None] * (capacity - len(records))
+        self._start = 0
+        self._size = len(records)
+
+LOG_TERM = re.compile(r"\w+")
+LOG_PRUNE_MIN = 256  # Registros descartados antes de podar el índice (poda corta: sin pausas)
+
+class LogIndex:
+    """Índice incremental de registros de log por categoría, tiempo y palabra
+    
+    Cada lista de posiciones guarda números de secuencia crecientes, así que los
+    rangos se resuelven con búsqueda binaria. Insertar es O(1) amortizado: la poda solo
+    toca las claves de los registros descartados y el orden de las palabras se
+    recalcula al buscar por prefijo. Los números (totales, puertos, secuencias) no se
+    indexan: casi todos son distintos y solo harían crecer el índice.
+    """
+    
+    def __init__(self, base=0):
+        self.base = base  # Secuencia del primer registro en timestamps
+        self.timestamps = array("d")
+        # Categoría y palabras (separadas por espacios) de cada registro desde base, para la
+        # poda; como cadenas no añaden objetos que recorra el recolector de basura
+        self.entry_categories = deque()
+        self.entry_terms = deque()
+        self.categories = {}  # categoría → secuencias
+        self.terms = {}  # PALABRA → secuencias
+        self.sorted_terms = []  # Claves de terms para buscar prefijos; None: rehacer al buscar
+        self._terms_sorted = True  # False si hay palabras nuevas al final sin ordenar
+    
+    def add(self, seq, record):
+        terms = {term for term in LOG_TERM.findall(record.message.upper()) if not term.isdigit()}
+        self.timestamps.append(record.timestamp)
+        self.entry_categories.append(record.category)
+        self.entry_terms.append(" ".join(terms))
+        self.categories.setdefault(record.category, array("q")).append(seq)
+        for term in terms:
+            postings = self.terms.get(term)
+            if postings is None:
+                postings = self.terms[term] = array("q")
+                if self.sorted_terms is not None:
+                    self.sorted_terms.append(term)
+                    self._terms_sorted = False
+            postings.append(seq)
+    
+    def prune(self, first_seq, force=False):
+        """Descarta las entradas de registros que ya salieron del buffer"""
+        drop = first_seq - self.base
+        if drop <= 0 or (drop < LOG_PRUNE_MIN and not force):
+            return
+        del self.timestamps[:drop]
+        self.base = first_seq
+        
+        # Los descartados son los más antiguos: ocupan el principio de cada lista
+        categories = defaultdict(int)
+        terms = defaultdict(int)
+        for _ in range(drop):
+            categories[self.entry_categories.popleft()] += 1
+            for term in self.entry_terms.popleft().split():
+                terms[term] += 1
+        for index, dropped in ((self.categories, categories), (self.terms, terms)):
+            for key, count in dropped.items():
+                postings = index[key]
+                if count < len(postings):
+                    del postings[:count]
+                else:
+                    del index[key]
+                    if index is self.terms:
+                        self.sorted_terms = None
+    
+    def prefix_terms(self, word):
+        """Palabras indexadas que empiezan por word"""
+        terms = self.sorted_terms
+        if terms is None:
+            terms = self.sorted_terms = sorted(self.terms)
+        elif not self._terms_sorted:
+            terms.sort()  # Ordenada salvo las palabras nuevas del final: casi lineal
+        self._terms_sorted = True
+        i = bisect_left(terms, word)
+        while i < len(terms) and terms[i].startswith(word):
+            yield terms[i]
+            i += 1
+    
+    def search(self, first_seq, next_seq, category=None, text=None, start=None, end=None):
+        """Secuencias retenidas que cumplen todos los filtros, en orden
+        
+        text: palabras (o prefijos de palabras) que deben aparecer en el mensaje, salvo los
+        números, que no están indexados y se ignoran; start/end: rango de tiempo [start, end).
+        """
+        lo = max(first_seq, self.base)
+        hi = next_seq
+        if start is not None:
+            lo = max(lo, self.base + bisect_left(self.timestamps, start))
+        if end is not None:
+            hi = min(hi, self.base + bisect_left(self.timestamps, end))
+        if lo >= hi:
+            return array("q")
+        
+        candidates = []
+        if category is not None:
+            candidates.append(self._window(self.categories.get(category, ()), lo, hi))
+        for word in LOG_TERM.findall((text or "").upper()):
+            if word.isdigit():
+                continue
+            # Prefijo: se unen las posiciones de todas las palabras que empiezan igual
+            matching = set()
+            for term in self.prefix_terms(word):
+                matching.update(self._window(self.terms[term], lo, hi))
+            candidates.append(matching)
+        
+        if not candidates:
+            return array("q", range(lo, hi))
+        
+        candidates.sort(key=len)
+        result = set(candidates[0])
+        for other in candidates[1:]:
+            result.intersection_update(other)
+        return array("q", sorted(result))
+    
+    @staticmethod
+    def _window(postings, lo, hi):
+        return postings[bisect_left(postings, lo):bisect_left(postings, hi)]
+
+class IndexedLogBuffer(LogRingBuffer):
+    """Buffer circular de log con índice para filtrar sin recorrer los registros"""
+    
+    def __init__(self, capacity=LOG_RETENTION):
+        super().__init__(capacity)
+        self.index = LogIndex(self.first_seq)
+    
+    def append(self, record):
+        seq = self.next_seq
+        super().append(record)
+        self.index.add(seq, record)
+        self.index.prune(self.first_seq)
+    
+    def clear(self):
+        super().clear()
+        self.index = LogIndex(self.first_seq)
+    
+    def resize(self, capacity):
+        super().resize(capacity)
+        self.index.prune(self.first_seq, force=True)
+    
+    def search(self, category=None, text=None, start=None, end=None, since=None):
+        """Secuencias de los registros que cumplen los filtros (desde since, si se indica)
+        
+        Los números del texto se comprueban en los mensajes de los candidatos que deja el
+        índice; sin otros filtros eso recorre los registros retenidos.
+        """
+        first = self.first_seq if since is None else max(self.first_seq, since)
+        seqs = self.index.search(first, self.next_seq, category, text, start, end)
+        numbers = [word for word in LOG_TERM.findall((text or "").upper()) if word.isdigit()]
+        if numbers:
+            seqs = array("q", [seq for seq in seqs if self._has_numbers(self.get(seq).message, numbers)])
+        return seqs
+    
+    @staticmethod
+    def _has_numbers(message, numbers):
+        terms = LOG_TERM.findall(message.upper())
+        return all(any(term.startswith(number) for term in terms) for number in numbers)
+
+# Archivo de log: se escribe por lotes desde un hilo propio y rota por tamaño o por tiempo
+LOG_FILENAME = "conveyor.log"
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_ROTATE_S = 24 * 3600
+LOG_FILE_BACKUPS = 20  # Segmentos cerrados que se conservan
+LOG_FILE_FLUSH_S = 0.5  # Espera máxima de un registro antes de llegar al disco
+LOG_FILE_BATCH = 5000  # Registros por escritura como máximo
+LOG_FILE_QUEUE_MAX = 200000  # Registros pendientes antes de descartar (disco bloqueado)
+
+class LogFileSink:
+    """Copia los registros del log a un archivo rotativo sin bloquear al que los produce
+    
+    record() solo encola. El escritor junta los registros en una sola escritura por lote
+    y resume las repeticiones seguidas del mismo mensaje (ráfagas de errores). Los
+    segmentos cerrados se renombran con su fecha y, opcionalmente, se comprimen con gzip.
+    
+    echo: flujo (p. ej. sys.stdout) que recibe también cada lote desde el hilo escritor,
+    para que una consola lenta no frene al que produce los registros. Con path=None solo
+    se escribe en echo.
+    """
+    
+    def __init__(self, path=LOG_FILENAME, max_bytes=LOG_FILE_MAX_BYTES, rotate_s=LOG_FILE_ROTATE_S,
+                 backups=LOG_FILE_BACKUPS, compress=True, echo=None):
+        self.path = path
+        self.echo = echo
+        self.max_bytes = max_bytes
+        self.rotate_s = rotate_s
+        self.backups = backups
+        self.compress = compress
+        self.queue = queue.SimpleQueue()
+        self.dropped = 0  # Registros descartados con la cola llena
+        self.error = None  # Último error del escritor
+        
+        # El archivo se abre aquí para que los errores lleguen al llamador
+        self.file = open(path, "a", encoding="utf-8") if path else None
+        self.size = self.file.tell() if self.file else 0
+        self.opened = time.time()
+        
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+    
+    def record(self, record):
+        if self.queue.qsize() >= LOG_FILE_QUEUE_MAX:
+            self.dropped += 1
+            return
+        self.queue.put(record)
+    
+    def _writer(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + LOG_FILE_FLUSH_S
+            while len(batch) < LOG_FILE_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # None indica cierre: se escribe lo pendiente y se termina
+            if None in batch:
+                running = False
+                batch = [record for record in batch if record is not None]
+            
+            try:
+                if batch:
+                    self._write(batch)
+            except OSError as e:
+                self.error = str(e)
+        if self.file is not None:
+            self.file.close()
+    
+    def _write(self, batch):
+        lines = []
+        previous = None
+        repeated = 0
+        for record in batch:
+            key = (record.category, record.message)
+            if key == previous:
+                repeated += 1
+                continue
+            if repeated:
+                lines.append(f"    (mensaje anterior repetido {repeated} veces más)\n")
+                repeated = 0
+            previous = key
+            lines.append(f"{record.format()}\n")
+        if repeated:
+            lines.append(f"    (mensaje anterior repetido {repeated} veces más)\n")
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append(f"    ({dropped} registros descartados: la escritura no daba abasto)\n")
+        
+        data = "".join(lines)
+        if self.echo is not None:
+            self.echo.write(data)
+            self.echo.flush()
+        if self.file is None:
+            return
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data.encode("utf-8"))
+        
+        if self.size >= self.max_bytes or time.time() - self.opened >= self.rotate_s:
+            self._rotate()
+    
+    def _rotate(self):
+        """Cierra el segmento actual con su fecha, lo comprime y poda los más antiguos"""
+        self.file.close()
+        base, ext = os.path.splitext(self.path)
+        stamp = datetime.fromtimestamp(self.opened).strftime("%Y%m%d_%H%M%S")
+        closed = f"{base}_{stamp}{ext}"
+        suffix = 1
+        while os.path.exists(closed) or os.path.exists(closed + ".gz"):
+            closed = f"{base}_{stamp}_{suffix}{ext}"
+            suffix += 1
+        try:
+            os.replace(self.path, closed)
+        finally:
+            # Aunque falle el renombrado se sigue escribiendo en el archivo actual
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.size = self.file.tell()
+            self.opened = time.time()
+        
+        if self.compress:
+            with open(closed, "rb") as src, gzip.open(closed + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(closed)
+        
+        segments = sorted(glob.glob(glob.escape(base) + "_*" + glob.escape(ext) + "*"), key=os.path.getmtime)
+        for old in segments[:-self.backups] if self.backups else segments:
+            os.remove(old)
+    
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+# ========== CAUDAL ==========
+
+# (segundos por cubeta, cubetas): 1 h a 1 s, 7 días a 1 min y 90 días a 1 h
+THROUGHPUT_RESOLUTIONS = ((1, 3600), (60, 7 * 24 * 60), (3600, 90 * 24))
+THROUGHPUT_MIN_BUCKETS = 60  # Cubetas mínimas en pantalla al elegir la resolución
+
+class ThroughputRing:
+    """Cajas por color en cubetas de tamaño fijo sobre un buffer circular"""
+    
+    def __init__(self, seconds, size):
+        self.seconds = seconds
+        self.size = size
+        self.ids = array("q", [-1]) * size  # Cubeta guardada en cada posición
+        self.counts = {color: array("I", [0]) * size for color in COUNT_COLORS}
+    
+    def add(self, ts, color, n=1):
+        bucket = int(ts // self.seconds)
+        pos = bucket % self.size
+        if self.ids[pos] != bucket:
+            # La posición tenía una cubeta vieja: se reutiliza
+            self.ids[pos] = bucket
+            for counts in self.counts.values():
+                counts[pos] = 0
+        if color in self.counts:
+            self.counts[color][pos] += n
+    
+    def series(self, color, first, last):
+        """Cuentas de las cubetas first..last (0 si la cubeta ya no está en el buffer)"""
+        ids = self.ids
+        counts = self.counts[color]
+        size = self.size
+        return [counts[b % size] if ids[b % size] == b else 0 for b in range(first, last + 1)]
+
+class ThroughputHistory:
+    """Caudal por color a varias resoluciones (1 s / 1 min / 1 h) para graficar"""
+    
+    def __init__(self, resolutions=THROUGHPUT_RESOLUTIONS):
+        self.levels = [ThroughputRing(seconds, size) for seconds, size in resolutions]
+    
+    def add(self, ts, color, n=1):
+        for level in self.levels:
+            level.add(ts, color, n)
+    
+    def level_for(self, span):
+        """Resolución más gruesa con al menos THROUGHPUT_MIN_BUCKETS cubetas en span segundos
+        
+        Así las cubetas a recorrer quedan acotadas sea cual sea la ventana mostrada.
+        """
+        fitting = [level for level in self.levels if span // level.seconds <= level.size]
+        for level in reversed(fitting):
+            if span // level.seconds >= THROUGHPUT_MIN_BUCKETS:
+                return level
+        return fitting[0] if fitting else self.levels[-1]
+
+def decimate_minmax(values, width):
+    """Reduce una serie a como mucho 2 puntos (mínimo y máximo) por columna de píxeles
+    
+    Devuelve pares (índice, valor) en orden; los picos se conservan aunque haya
+    muchos más valores que píxeles.
+    """
+    n = len(values)
+    if n <= 2 * width:
+        return list(enumerate(values))
+    
+    points = []
+    for column in range(width):
+        start = column * n // width
+        end = (column + 1) * n // width
+        chunk = values[start:end]
+        low = min(range(len(chunk)), key=chunk.__getitem__)
+        high = max(range(len(chunk)), key=chunk.__getitem__)
+        for i in sorted({low, high}):
+            points.append((start + i, chunk[i]))
+    return points
+
+# ========== MÉTRICAS ==========
+
+# Cubetas de latencia en potencias de 2: de 1 µs a ~4 s
+METRICS_BUCKETS_S = tuple(2 ** e / 1e6 for e in range(23))
+METRICS_PORT = 9108  # Puerto local del endpoint /metrics (0 lo desactiva)
+
+# Etapas del camino de un mensaje, en orden
+METRICS_STAGES = (
+    ("lectura", "Procesamiento de cada bloque recibido del socket"),
+    ("parseo", "Parseo y manejo de cada mensaje"),
+    ("cola", "Espera de cada evento en la cola de la GUI"),
+    ("despacho", "Despacho de los eventos de un cuadro en la GUI"),
+    ("dibujado", "Redibujado de los widgets de un cuadro"),
+)
+
+# Tiempo de ida y vuelta de los comandos
+METRICS_RTT = (
+    ("rtt_esp32", "Tiempo hasta la respuesta de la ESP32"),
+)
+METRICS_HISTOGRAMS = METRICS_STAGES + METRICS_RTT
+
+class LatencyHistogram:
+    """Histograma de latencias con cubetas fijas (compatible con el formato de Prometheus)"""
+    
+    __slots__ = ("buckets", "count", "total", "max")
+    
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS_S) + 1)  # La última cubeta es +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, seconds):
+        self.buckets[bisect_left(METRICS_BUCKETS_S, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def quantile(self, fraction):
+        """Límite superior de la cubeta que contiene el cuantil (None sin observaciones)"""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, n in zip(METRICS_BUCKETS_S, self.buckets):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+    """Temporizadores por etapa, contadores y medidores del sistema
+    
+    Cada histograma y contador lo escribe un solo hilo, sin locks; las lecturas desde
+    otros hilos (GUI, endpoint HTTP) pueden ver valores con un mensaje de retraso.
+    """
+    
+    def __init__(self):
+        self.histograms = {stage: LatencyHistogram() for stage, _ in METRICS_HISTOGRAMS}
+        self.counters = defaultdict(int)  # (nombre, etiqueta) → valor
+        self.gauges = {}  # nombre → (descripción, función)
+        self.started = time.time()
+    
+    def observe(self, stage, seconds):
+        self.histograms[stage].observe(seconds)
+    
+    def inc(self, name, label="", n=1):
+        self.counters[(name, label)] += n
+    
+    def gauge(self, name, description, fn):
+        self.gauges[name] = (description, fn)
+    
+    def read_gauges(self):
+        values = {}
+        for name, (_, fn) in list(self.gauges.items()):
+            try:
+                values[name] = fn()
+            except Exception:
+                values[name] = None
+        return values
+    
+    def prometheus(self):
+        """Métricas en el formato de texto de Prometheus"""
+        out = []
+        for stage, description in METRICS_HISTOGRAMS:
+            histogram = self.histograms[stage]
+            name = f"conveyor_{stage}_seconds"
+            out.append(f"# HELP {name} {description}")
+            out.append(f"# TYPE {name} histogram")
+            buckets = list(histogram.buckets)
+            seen = 0
+            for bound, n in zip(METRICS_BUCKETS_S, buckets):
+                seen += n
+                out.append(f'{name}_bucket{{le="{bound:.9g}"}} {seen}')
+            out.append(f'{name}_bucket{{le="+Inf"}} {seen + buckets[-1]}')
+            out.append(f"{name}_sum {histogram.total:.9f}")
+            out.append(f"{name}_count {seen + buckets[-1]}")
+        
+        counters = defaultdict(list)
+        for (name, label), value in list(self.counters.items()):
+            counters[name].append((label, value))
+        for name, values in sorted(counters.items()):
+            out.append(f"# TYPE conveyor_{name}_total counter")
+            for label, value in sorted(values):
+                labels = f'{{tipo="{prometheus_escape(label)}"}}' if label else ""
+                out.append(f"conveyor_{name}_total{labels} {value}")
+        
+        descriptions = {name: description for name, (description, _) in list(self.gauges.items())}
+        for name, value in sorted(self.read_gauges().items()):
+            if value is None:
+                continue
+            out.append(f"# HELP conveyor_{name} {descriptions[name]}")
+            out.append(f"# TYPE conveyor_{name} gauge")
+            out.append(f"conveyor_{name} {value}")
+        return "\n".join(out) + "\n"
+
+def prometheus_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricsServer:
+    """Endpoint HTTP local que sirve las métricas en /metrics desde un hilo propio"""
+    
+    def __init__(self, metrics, host="127.0.0.1", port=METRICS_PORT):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] not in ("/metrics", "/"):
+                    handler.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+            
+            def log_message(handler, *args):
+                pass  # Sin salida por cada consulta
+        
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}/metrics"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# ========== CAPTURA Y REPRODUCCIÓN ==========
+
+# Archivo: cabecera (CVCAP1, hora de inicio) y registros (segundos desde el inicio,
+# índice de línea, tipo, largo) seguidos del mensaje tal como llegó
+CAPTURE_MAGIC = b"CVCAP1"
+CAPTURE_HEADER = struct.Struct("<6sd")
+CAPTURE_RECORD = struct.Struct("<dHBI")
+CAPTURE_LINE = 0x00  # Línea de texto/JSON; los tipos 0x01-0x7F son tramas binarias
+CAPTURE_NAME = 0xFF  # Declara el nombre de la línea con el siguiente índice
+CAPTURE_FLUSH_BYTES = 64 * 1024
+CAPTURE_FLUSH_S = 1.0  # Como mucho se pierde un segundo si el programa se cuelga
+REPLAY_MIN_SLEEP_S = 0.002  # Esperas más cortas se acumulan con la siguiente
+REPLAY_YIELD_RECORDS = 1000  # Mensajes entre cesiones del loop a máxima velocidad
+
+class CaptureWriter:
+    """Graba las líneas y tramas recibidas con su hora monotónica
+    
+    Se usa desde el hilo del motor y escribe por bloques; un error de disco detiene la
+    grabación (queda en error) sin afectar a la recepción.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time()))
+        self.start = time.monotonic()
+        self.names = {}  # nombre de línea → índice
+        self.buffer = bytearray()
+        self.records = 0
+        self.error = None
+    
+    def line(self, name, text):
+        self._append(name, CAPTURE_LINE, text.encode("utf-8"))
+    
+    def frame(self, name, frame_type, buf, offset, length):
+        self._append(name, frame_type, buf[offset:offset + length])
+    
+    def _append(self, name, kind, payload):
+        elapsed = time.monotonic() - self.start
+        index = self.names.get(name)
+        if index is None:
+            index = self.names[name] = len(self.names)
+            encoded = name.encode("utf-8")
+            self.buffer += CAPTURE_RECORD.pack(elapsed, index, CAPTURE_NAME, len(encoded))
+            self.buffer += encoded
+        self.buffer += CAPTURE_RECORD.pack(elapsed, index, kind, len(payload))
+        self.buffer += payload
+        self.records += 1
+        if len(self.buffer) >= CAPTURE_FLUSH_BYTES:
+            self.flush()
+    
+    def flush(self):
+        if self.file is None:
+            self.buffer.clear()
+            return
+        try:
+            self.file.write(self.buffer)
+            self.file.flush()
+        except OSError as e:
+            self.error = str(e)
+            self.file.close()
+            self.file = None
+        self.buffer.clear()
+    
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class CaptureReader:
+    """Lee una captura por mmap; las tramas se decodifican directamente del archivo mapeado"""
+    
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size < CAPTURE_HEADER.size:
+                raise ValueError(f"{path} no es una captura de la cinta")
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, self.started = CAPTURE_HEADER.unpack_from(self.map, 0)
+        if magic != CAPTURE_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} no es una captura de la cinta")
+    
+    def __iter__(self):
+        """(segundos, línea, tipo, buffer, offset, largo) de cada mensaje grabado"""
+        data = self.map
+        size = self.size
+        names = []
+        offset = CAPTURE_HEADER.size
+        while offset + CAPTURE_RECORD.size <= size:
+            elapsed, index, kind, length = CAPTURE_RECORD.unpack_from(data, offset)
+            offset += CAPTURE_RECORD.size
+            if offset + length > size:
+                break  # Último registro incompleto (grabación interrumpida)
+            if kind == CAPTURE_NAME:
+                names.append(str(data[offset:offset + length], "utf-8", "ignore"))
+            else:
+                yield elapsed, names[index], kind, data, offset, length
+            offset += length
+    
+    def close(self):
+        self.map.close()
+
+# ========== BUS DE EVENTOS ==========
+
+# kind: "log", "info", "alarm", "connection", "counts", "detection", "status" o "replay"
+Event = namedtuple("Event", "kind line data")
+
+class EventBus:
+    """Entrega los eventos del motor a los suscriptores (GUI, servicio, almacenamiento)
+    
+    Los callbacks se invocan desde el hilo del motor y no deben bloquear.
+    """
+    
+    def __init__(self):
+        self._subscribers = []
+    
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+        return callback
+    
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+    
+    def publish(self, kind, line=None, data=None):
+        event = Event(kind, line, data)
+        for callback in self._subscribers:
+            callback(event)
+
+# ========== MOTOR ==========
+
+class ConveyorEngine:
+    """Sesiones con las ESP32, protocolo y contadores, sin dependencias de Tkinter
+    
+    Todo el estado se modifica en el hilo del event loop del transporte; los métodos
+    públicos se pueden llamar desde cualquier hilo.
+    """
+    
+    def __init__(self):
+        self.bus = EventBus()
+        self.metrics = Metrics()
+        self.metrics.gauge("lineas_conectadas", "Líneas con conexión activa",
+                           lambda: sum(line.connected for line in list(self.lines.values())))
+        self.transport = AsyncTransport(self.metrics)
+        self.loop = self.transport.loop
+        self.lines = {}
+        self.history = CountHistory()
+        self.binary_protocol = False  # Negociar tramas binarias al conectar
+        self.push_updates = False  # Pedir suscripción a updates al conectar
+        self.delta_sync = False  # Pedir eventos numerados en lugar de snapshots al conectar
+        self.poll_interval_ms = None  # Intervalo inicial de GET_DATA; None: sin actualización automática
+        self._poll_handles = {}  # línea → consulta programada
+        self._reconnect_handles = {}  # línea → reintento de conexión programado
+        self._request_id = 0
+        self.capture = None  # CaptureWriter activo
+        self._capture_handle = None
+        self._replay_future = None
+        
+        # Tablas del decodificador (ver register_message / register_text)
+        self.message_handlers = {}
+        self.ack_handlers = {"start": self._ack_start, "stop": self._ack_stop, "reset": self._ack_reset,
+                             "subscribe": self._ack_subscribe, "delta": self._ack_delta}
+        self.text_handlers = {}  # prefijo → handler, en orden de prioridad
+        self._register_protocol()
+    
+    # ---------- Hilos ----------
+    
+    def call(self, fn, *args):
+        """Ejecuta fn en el hilo del motor sin esperar"""
+        self.loop.call_soon_threadsafe(fn, *args)
+    
+    def run_sync(self, fn, *args):
+        """Ejecuta fn en el hilo del motor y devuelve su resultado"""
+        if threading.current_thread() is self.transport.thread:
+            return fn(*args)
+        
+        future = concurrent.futures.Future()
+        
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+    
+    def shutdown(self):
+        def close():
+            self._cancel_poll()
+            for line in self.lines.values():
+                if line.connected or line.reconnecting:
+                    self._disconnect(line)
+        
+        self.run_sync(close)
+        self.cancel_replay()
+        self.stop_capture()
+        self.transport.shutdown()
+        self.history.close()
+    
+    # ---------- Eventos ----------
+    
+    def line_label(self, line, message):
+        """Antepone el nombre de la línea cuando hay más de una"""
+        if line is not None and len(self.lines) > 1:
+            return f"{line.name}: {message}"
+        return message
+    
+    def log(self, category, message, line=None):
+        self.bus.publish("log", line.name if line else None, (category, self.line_label(line, message)))
+    
+    def info(self, message, line=None):
+        self.bus.publish("info", line.name if line else None, self.line_label(line, message))
+    
+    def alarm(self, message, line=None):
+        self.bus.publish("alarm", line.name if line else None, message)
+    
+    # ---------- Líneas ----------
+    
+    def add_line(self, name, host="192.168.4.1", port=8080):
+        return self.run_sync(self._add_line, name, host, port)
+    
+    def _add_line(self, name, host, port):
+        if name in self.lines or name == PLANT_VIEW:
+            raise ValueError(f"Ya existe una línea llamada {name}")
+        line = self.lines[name] = LineState(name, host, port)
+        return line
+    
+    def remove_line(self, name):
+        self.run_sync(self._remove_line, name)
+    
+    def _remove_line(self, name):
+        line = self.lines.get(name)
+        if line is None:
+            return
+        if line.connected or line.reconnecting:
+            self._disconnect(line)
+        del self.lines[name]
+    
+    def summaries(self):
+        """Resumen de planta y de cada línea, tomado en el hilo del motor"""
+        def collect():
+            plant = LineState.combine(self.lines.values())
+            return (self.summary(plant), [(line.name, self.summary(line)) for line in self.lines.values()])
+        return self.run_sync(collect)
+    
+    @staticmethod
+    def summary(line):
+        return dict(line.box_count, TOTAL=line.total_count, DETECCIONES=line.detection_count)
+    
+    def snapshot_history(self):
+        return self.run_sync(self.history.snapshot)
+    
+    # ---------- Conexión ----------
+    
+    def connect(self, name, host=None, port=None):
+        self.call(self._connect, name, host, port)
+    
+    def _connect(self, name, host, port):
+        line = self.lines.get(name)
+        if line is None or line.connected:
+            return
+        if host is not None:
+            line.host = host
+        if port is not None:
+            line.port = port
+        
+        # Conexión pedida por el operador: cancela una reconexión pendiente
+        self._cancel_reconnect(line)
+        line.wanted = True
+        self._open(line)
+    
+    def _open(self, line):
+        name = line.name
+        self.log("Comunicación", f"Conectando a {line.host}:{line.port}...", line)
+        self.transport.connect(
+            name, line.host, line.port,
+            on_line=lambda data: self.receive_line(name, data),
+            on_connected=lambda h, p: self._connection_successful(name, h, p),
+            on_failed=lambda msg: self._connection_failed(name, msg),
+            on_closed=lambda error: self._connection_lost(name, error),
+            on_frame=lambda frame_type, buf, offset, length: self.receive_frame(name, frame_type, buf, offset, length),
+            on_send_failed=lambda error: self._send_failed(name, error))
+    
+    def _connection_successful(self, name, host, port):
+        line = self.lines.get(name)
+        if line is None or not line.wanted:
+            self.transport.disconnect(name)
+            return
+        
+        resumed = line.reconnecting
+        line.connected = True
+        line.reconnecting = False
+        line.reconnect_attempts = 0
+        line.host = host
+        line.port = port
+        self.bus.publish("connection", name, ("connected", None))
+        
+        if resumed:
+            self.log("Comunicación", f"Reconectado a ESP32 en {host}:{port}", line)
+            self.info(f"Conexión restablecida con ESP32\nIP: {host}:{port}\n", line)
+        else:
+            self.log("Comunicación", f"¡Conectado a ESP32 en {host}:{port}!", line)
+            self.info(f"Conexión establecida con ESP32\nIP: {host}:{port}\n", line)
+        
+        # Ofrecer tramas binarias; si la ESP32 no responde "proto" se sigue en texto
+        if self.binary_protocol:
+            self._send_command(BINARY_HELLO, [name])
+        
+        # Pedir updates por suscripción; mientras no se confirme se consulta GET_DATA
+        if self.push_updates:
+            self._send_command(SUBSCRIBE_COMMAND, [name])
+        
+        # Eventos numerados; mientras no se confirme se siguen usando snapshots
+        if self.delta_sync:
+            self._send_command(DELTA_SYNC_COMMAND, [name])
+        self._start_poll(line)
+        
+        # Solicitar estado inicial
+        self._send_command("GET_STATUS", [name])
+        
+        # Tras un corte, el primer snapshot concilia lo contado mientras tanto
+        if resumed:
+            line.resync = True
+            self._send_command("GET_DATA", [name])
+    
+    def _connection_failed(self, name, error_msg):
+        line = self.lines.get(name)
+        if line is None:
+            return
+        self.log("Errores", error_msg, line)
+        
+        if line.reconnecting:
+            self._schedule_reconnect(line, error_msg)
+            return
+        line.wanted = False
+        self.bus.publish("connection", name, ("failed", self.line_label(line, error_msg)))
+    
+    def _connection_lost(self, name, error):
+        line = self.lines.get(name)
+        if line is None or not line.connected:
+            return
+        if error:
+            self.log("Errores", f"Error recepción: {error}", line)
+        
+        if not line.wanted:
+            self._disconnect(line)
+            return
+        
+        # Corte inesperado: se conservan contadores y estado, y se reintenta la conexión; el
+        # primer snapshot tras reconectar se concilia con los contadores de este momento
+        self._reset_session(line)
+        line.resync = True
+        line.resync_base = line.counts()
+        self.log("Comunicación", "Conexión perdida con ESP32", line)
+        self._schedule_reconnect(line, error or "Conexión cerrada por la ESP32")
+    
+    def _schedule_reconnect(self, line, reason):
+        delay = min(RECONNECT_MAX_S, RECONNECT_BASE_S * 2 ** line.reconnect_attempts)
+        delay = random.uniform(delay / 2, delay)
+        line.reconnecting = True
+        line.reconnect_attempts += 1
+        self._reconnect_handles[line.name] = self.loop.call_later(delay, self._reconnect, line.name)
+        
+        self.bus.publish("connection", line.name, ("reconnecting", self.line_label(line, reason)))
+        self.log("Comunicación", f"Reintentando conexión en {delay:.1f} s (intento {line.reconnect_attempts})", line)
+    
+    def _reconnect(self, name):
+        self._reconnect_handles.pop(name, None)
+        line = self.lines.get(name)
+        if line is not None and line.reconnecting and not line.connected:
+            self._open(line)
+    
+    def _cancel_reconnect(self, line):
+        handle = self._reconnect_handles.pop(line.name, None)
+        if handle is not None:
+            handle.cancel()
+        line.reconnecting = False
+        line.reconnect_attempts = 0
+    
+    def disconnect(self, name):
+        self.call(self._disconnect_name, name)
+    
+    def _disconnect_name(self, name):
+        line = self.lines.get(name)
+        if line is not None and (line.connected or line.reconnecting):
+            self._disconnect(line)
+    
+    def _disconnect(self, line):
+        self._reset_session(line)
+        self._cancel_reconnect(line)
+        
+        line.wanted = False
+        line.resync = False
+        line.resync_base = None
+        line.system_running = False
+        line.stm32_connected = False
+        line.esp_status = 0
+        self.bus.publish("connection", line.name, ("disconnected", None))
+        
+        self.log("Comunicación", "Desconectado de ESP32", line)
+        self.info("Desconectado de ESP32\n", line)
+    
+    def _reset_session(self, line):
+        """Cierra el socket y olvida lo negociado en la conexión (protocolo, suscripción, secuencia)"""
+        self.transport.disconnect(line.name)
+        line.connected = False
+        line.protocol = "texto"
+        line.push = False
+        line.delta = False
+        line.seq = None
+        line.sync_pending = False
+        self._cancel_poll(line.name)
+        self._clear_requests(line)
+    
+    def probe(self, host, port):
+        return self.transport.probe(host, port)
+    
+    # ---------- Comandos ----------
+    
+    def send_command(self, command, names):
+        self.call(self._send_command, command, list(names))
+    
+    def _send_command(self, command, names):
+        """Encola el comando en cada línea: nunca bloquea, aunque el enlace esté congestionado"""
+        data = f"{command}\n".encode('utf-8')
+        supersedes = URGENT_COMMANDS.get(command)
+        coalesce = command in COALESCED_COMMANDS
+        for name in names:
+            line = self.lines.get(name)
+            if line is None or not line.connected:
+                continue
+            if supersedes is not None:
+                self._discard_commands(line, supersedes, command)
+            # Una consulta igual pendiente de envío o esperando respuesta basta
+            if (coalesce and any(request.command == command for request in line.requests)
+                    or not self.transport.queue_send(name, data, supersedes is not None, coalesce)):
+                self.metrics.inc("comandos_coalescidos", command)
+                continue
+            self.metrics.inc("comandos", command)
+            if command in COMMAND_REPLIES:
+                self._track_request(line, command)
+            self.log("Comunicación", f"Comando enviado: {command}", line)
+    
+    def _discard_commands(self, line, superseded, command):
+        """Anula los comandos de superseded que aún no salieron, con sus solicitudes pendientes"""
+        for data in self.transport.discard(line.name, superseded):
+            cancelled = data.decode("utf-8").strip()
+            # Los no enviados son los más recientes: su solicitud es la última de ese comando
+            for request in reversed(line.requests):
+                if request.command == cancelled:
+                    line.requests.remove(request)
+                    request.handle.cancel()
+                    break
+            self.metrics.inc("comandos_anulados", cancelled)
+            self.log("Comunicación", f"Comando {cancelled} descartado sin enviar: lo anula {command}", line)
+    
+    # ---------- Solicitudes y respuestas ----------
+    
+    def _track_request(self, line, command):
+        self._request_id += 1
+        request = PendingRequest(self._request_id, command, COMMAND_REPLIES[command], time.perf_counter())
+        request.handle = self.loop.call_later(REQUEST_TIMEOUT_S, self._request_timeout, line.name, request)
+        line.requests.append(request)
+    
+    def _match_reply(self, line, reply):
+        """Completa la solicitud pendiente más antigua que espera esta respuesta"""
+        for request in line.requests:
+            if request.reply == reply:
+                break
+        else:
+            return
+        line.requests.remove(request)
+        request.handle.cancel()
+        rtt = time.perf_counter() - request.sent
+        line.rtt.append(rtt)
+        self.metrics.observe("rtt_esp32", rtt)
+        if line.unanswered:
+            self.log("Comunicación", f"El enlace responde de nuevo ({line.unanswered} solicitudes sin respuesta)", line)
+            line.unanswered = 0
+        self.bus.publish("status", line.name)
+    
+    def _request_timeout(self, name, request):
+        line = self.lines.get(name)
+        if line is None or request not in line.requests:
+            return
+        line.requests.remove(request)
+        line.unanswered += 1
+        self.metrics.inc("comandos_sin_respuesta", request.command)
+        
+        # Se avisa al comenzar la racha de timeouts, no en cada consulta
+        if line.unanswered == 1:
+            message = f"La ESP32 no respondió a {request.command} (#{request.id}) en {REQUEST_TIMEOUT_S:g} s"
+            self.log("Errores", message, line)
+            self.alarm(f"{self.line_label(line, message)}\n", line)
+        self.bus.publish("status", line.name)
+        
+        # El snapshot de resincronización se vuelve a pedir hasta recibirlo
+        if request.command == "GET_DATA" and line.sync_pending and line.connected:
+            self._send_command("GET_DATA", [name])
+    
+    def _clear_requests(self, line):
+        for request in line.requests:
+            request.handle.cancel()
+        line.requests.clear()
+        line.unanswered = 0
+    
+    def _send_failed(self, name, error):
+        line = self.lines.get(name)
+        if line is None:
+            return
+        self.log("Errores", f"Error enviando comando: {str(error)}", line)
+        self._connection_lost(name, None)
+    
+    def start(self, names):
+        self.call(self._set_running, list(names), True)
+    
+    def stop(self, names):
+        self.call(self._set_running, list(names), False)
+    
+    def _set_running(self, names, running):
+        self._send_command("START" if running else "STOP", names)
+        for name in names:
+            line = self.lines.get(name)
+            if line is not None and (line.connected or not running):
+                line.system_running = running
+                self.bus.publish("status", name)
+                if running:
+                    self._start_poll(line)  # Volver al intervalo inicial al arrancar
+    
+    def reset(self, names):
+        self.call(self._reset, list(names))
+    
+    def _reset(self, names):
+        local = []
+        for name in names:
+            line = self.lines.get(name)
+            if line is None:
+                continue
+            if line.connected:
+                self._send_command("RESET_COUNTERS", [name])
+            else:
+                local.append(line)
+        
+        # Reset local (contadores en tiempo real también)
+        for line in local:
+            line.reset_counts()
+            line.set_color("NINGUNO")
+            self.bus.publish("counts", line.name)
+            self.log("Sistema", "Contadores y detecciones reseteados localmente", line)
+        
+        # Resetear historial cuando se resetean todas las líneas
+        if local and len(local) == len(self.lines):
+            self.history.clear()
+    
+    # ---------- Actualización automática ----------
+    
+    def set_polling(self, interval_ms):
+        """Consulta GET_DATA a las líneas conectadas sin suscripción, partiendo de interval_ms; None la desactiva"""
+        self.call(self._set_polling, interval_ms)
+    
+    def _set_polling(self, interval_ms):
+        self.poll_interval_ms = interval_ms
+        for line in self.lines.values():
+            self._start_poll(line)
+    
+    def _start_poll(self, line):
+        self._cancel_poll(line.name)
+        if not self.poll_interval_ms or not line.connected or line.push or line.delta:
+            return
+        line.poll_ms = self.poll_interval_ms
+        line.poll_mark = None
+        self._schedule_poll(line)
+    
+    def _schedule_poll(self, line):
+        self._poll_handles[line.name] = self.loop.call_later(line.poll_ms / 1000, self._poll, line.name)
+    
+    def _cancel_poll(self, name=None):
+        """Cancela la consulta de una línea, o de todas si name es None"""
+        names = list(self._poll_handles) if name is None else [name]
+        for name in names:
+            handle = self._poll_handles.pop(name, None)
+            if handle is not None:
+                handle.cancel()
+    
+    def _poll(self, name):
+        self._poll_handles.pop(name, None)
+        line = self.lines.get(name)
+        if line is None or not line.connected or line.push or line.delta or not self.poll_interval_ms:
+            return
+        line.poll_ms = self.next_poll_interval(line)
+        self._send_command("GET_DATA", [name])
+        self._schedule_poll(line)
+    
+    @staticmethod
+    def next_poll_interval(line):
+        """Acelera mientras cambian los contadores y espacia con la línea inactiva o detenida"""
+        mark = (line.total_count, line.detection_count)
+        changed = line.poll_mark is not None and mark != line.poll_mark
+        line.poll_mark = mark
+        
+        if changed:
+            return max(POLL_MIN_MS, line.poll_ms // 2)
+        if line.esp_status == 0 and not line.system_running:
+            return POLL_IDLE_MS
+        return min(POLL_IDLE_MS, line.poll_ms * 2)
+    
+    # ---------- Captura y reproducción ----------
+    
+    def receive_line(self, name, data):
+        """Línea recibida por el socket: se graba si hay una captura activa y se procesa"""
+        if self.capture is not None:
+            self.capture.line(name, data)
+        self.handle_line(name, data)
+    
+    def receive_frame(self, name, frame_type, buf, offset, length):
+        if self.capture is not None:
+            self.capture.frame(name, frame_type, buf, offset, length)
+        self.handle_frame(name, frame_type, buf, offset, length)
+    
+    def start_capture(self, path):
+        """Empieza a grabar lo recibido de todas las líneas (OSError si no se puede crear)"""
+        self.run_sync(self._start_capture, path)
+    
+    def _start_capture(self, path):
+        self._stop_capture()
+        self.capture = CaptureWriter(path)
+        self._capture_handle = self.loop.call_later(CAPTURE_FLUSH_S, self._flush_capture)
+        self.log("Sistema", f"Grabando lo recibido de las ESP32 en {path}")
+    
+    def stop_capture(self):
+        """Termina la grabación y devuelve la ruta de la captura (None si no había)"""
+        return self.run_sync(self._stop_capture)
+    
+    def _stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is None:
+            return None
+        self._capture_handle.cancel()
+        capture.close()
+        self.log("Sistema", f"Captura guardada en {capture.path} ({capture.records} mensajes)")
+        return capture.path
+    
+    def _flush_capture(self):
+        capture = self.capture
+        if capture is None:
+            return
+        capture.flush()
+        if capture.error is not None:
+            self.capture = None
+            capture.close()
+            self.log("Errores", f"Error grabando la captura {capture.path}: {capture.error}")
+            return
+        self._capture_handle = self.loop.call_later(CAPTURE_FLUSH_S, self._flush_capture)
+    
+    def replay(self, path, speed=1.0):
+        """Reproduce una captura por el mismo camino de parseo (speed 0: a máxima velocidad)
+        
+        Las líneas grabadas se crean si no existen y no pueden estar conectadas. Devuelve
+        un futuro con (mensajes, segundos).
+        """
+        future = self._replay_future = self.transport.submit(self._replay(path, speed))
+        return future
+    
+    def cancel_replay(self):
+        if self._replay_future is not None:
+            self._replay_future.cancel()
+    
+    async def _replay(self, path, speed):
+        reader = None
+        start = time.monotonic()
+        records = 0
+        try:
+            reader = CaptureReader(path)
+            recorded = datetime.fromtimestamp(reader.started).strftime("%Y-%m-%d %H:%M:%S")
+            pace = f"{speed:g}x" if speed else "máxima velocidad"
+            self.log("Sistema", f"Reproduciendo la captura {path} del {recorded} ({pace})")
+            
+            for elapsed, name, kind, buf, offset, length in reader:
+                line = self.lines.get(name)
+                if line is None:
+                    self._add_line(name, "127.0.0.1", 0)
+                    self.bus.publish("replay", name, "line")
+                elif line.connected or line.reconnecting:
+                    raise ValueError(f"La línea {name} está conectada; desconéctala para reproducir la captura")
+                
+                delay = elapsed / speed - (time.monotonic() - start) if speed else 0
+                if delay > REPLAY_MIN_SLEEP_S:
+                    await asyncio.sleep(delay)
+                elif records % REPLAY_YIELD_RECORDS == 0:
+                    await asyncio.sleep(0)
+                
+                if kind == CAPTURE_LINE:
+                    self.handle_line(name, str(buf[offset:offset + length], "utf-8", "ignore"))
+                else:
+                    self.handle_frame(name, kind, buf, offset, length)
+                records += 1
+        except asyncio.CancelledError:
+            self.log("Sistema", f"Reproducción cancelada tras {records} mensajes")
+            self.bus.publish("replay", None, "cancelled")
+            raise
+        except Exception as e:
+            self.log("Errores", f"Error reproduciendo la captura: {str(e)}")
+            self.bus.publish("replay", None, "failed")
+            raise
+        finally:
+            if reader is not None:
+                reader.close()
+        
+        seconds = time.monotonic() - start
+        self.log("Sistema", f"Reproducción terminada: {records} mensajes en {seconds:.2f} s "
+                            f"({records / max(seconds, 1e-9):.0f} mensajes/s)")
+        self.bus.publish("replay", None, "finished")
+        return records, seconds
+    
+    # ---------- Protocolo ----------
+    
+    def handle_line(self, name, data):
+        """Procesa una línea recibida de la ESP32 de la línea indicada (un solo intento de parseo)"""
+        line = self.lines.get(name)
+        if line is None:
+            return
+        
+        started = time.perf_counter()
+        kind = "texto"  # Tipo de mensaje para el contador
+        try:
+            if data.startswith('{'):
+                try:
+                    json_data = json.loads(data)
+                except json.JSONDecodeError:
+                    # JSON incompleto o corrupto: se trata como mensaje directo
+                    unknown = "Datos recibidos"
+                    kind = "invalido"
+                else:
+                    kind = self.dispatch_message(line, json_data) or "desconocido"
+                    return
+            else:
+                unknown = "Mensaje ESP32"
+            
+            # Mensaje directo: gana el primer prefijo registrado que aparezca
+            for prefix, handler in self.text_handlers.items():
+                index = data.find(prefix)
+                if index != -1:
+                    kind = prefix
+                    handler(line, data[index + len(prefix):])
+                    break
+            else:
+                self.log("Comunicación", f"{unknown}: {data}", line)
+        except Exception as e:
+            self.log("Errores", f"Error procesando datos ESP32: {str(e)}", line)
+        finally:
+            self.metrics.observe("parseo", time.perf_counter() - started)
+            self.metrics.inc("mensajes", kind)
+    
+    def process_detection(self, line):
+        """Procesa una detección de objeto"""
+        line.detection_count += 1
+        line.realtime_detections += 1
+        self.bus.publish("detection", line.name)
+    
+    def accumulate_count(self, line, color):
+        """Acumula conteo en tiempo real (acumulativo)"""
+        line.realtime_counts[color] += 1
+        
+        # Contar siempre (sin verificar tiempo)
+        if color in line.box_count:
+            line.box_count[color] += 1
+            line.total_count += 1
+            line.set_color(color)
+            
+            # Registrar en el historial de conteos
+            self.log_count_event(line, color)
+            self.bus.publish("counts", line.name)
+            
+            self.log("Detecciones", f"Color detectado: {color}", line)
+            self.log("Conteo", f"Caja {color} contada (Total: {line.total_count})", line)
+    
+    def log_count_event(self, line, color):
+        """Registra un evento de conteo en el historial"""
+        counts = line.counts()
+        self.history.append(time.time(), color, counts, line.name)
+        self.bus.publish("count", line.name, (color, counts, 1))
+    
+    # ---------- Decodificador ----------
+    
+    def register_message(self, msg_type, handler, **fields):
+        """Registra el handler de un tipo de mensaje JSON
+        
+        fields: nombre → tipo (o tupla de tipos) esperado, o función que valida el valor; los
+        campos ausentes no se validan.
+        """
+        self.message_handlers[msg_type] = (handler, tuple(fields.items()))
+    
+    def register_text(self, prefix, handler):
+        """Registra el handler de los mensajes de texto que contienen prefix
+        
+        El handler recibe la línea y el texto que sigue al prefijo. Los prefijos se prueban
+        en el orden de registro.
+        """
+        self.text_handlers[prefix] = handler
+    
+    def _register_protocol(self):
+        number = (int, float)
+        
+        def count(value):
+            # Los contadores van al historial en array("I"): ni decimales ni negativos
+            return isinstance(value, int) and value >= 0
+        
+        text = str
+        self.register_message("init", self._on_init, stm32=number, speed=number, status=number, detections=count)
+        self.register_message("data", self._on_data, red=count, green=count, blue=count, other=count,
+                              total=count, detections=count, color=text, seq=int)
+        self.register_message("update", self._on_update, red=count, green=count, blue=count, other=count,
+                              total=count, detections=count, speed=number, status=number, last_color=text,
+                              seq=int)
+        self.register_message("delta", self._on_delta, seq=int, color=text)
+        self.register_message("status", self._on_status, stm32=number, speed=number, detections=count)
+        self.register_message("ok", self._on_ok, cmd=text)
+        self.register_message("alert", self._on_alert, msg=text)
+        self.register_message("proto", self._on_proto, mode=text)
+        self.register_message("ping_sent", self._on_ping_sent)
+        self.register_message("error", self._on_error, msg=text)
+        
+        self.register_text("DETECTADO", self._on_detected_text)
+        self.register_text("Color:", self._on_color_text)
+    
+    def dispatch_message(self, line, json_data):
+        """Pasa un mensaje (JSON o trama decodificada) a su handler y completa la solicitud que responde
+        
+        Devuelve el tipo de mensaje, o None si no hay handler registrado.
+        """
+        msg_type = json_data.get("type", "")
+        entry = self.message_handlers.get(msg_type)
+        if entry is None:
+            return None
+        handler, fields = entry
+        if not fields or self.valid_message(line, json_data, fields):
+            handler(line, json_data)
+        if line.requests:
+            self._match_reply(line, f"ok:{json_data.get('cmd', '')}" if msg_type == "ok" else msg_type)
+        return msg_type
+    
+    def valid_message(self, line, json_data, fields):
+        for field, kind in fields:
+            if field not in json_data:
+                continue
+            value = json_data[field]
+            if not (isinstance(value, kind) if isinstance(kind, (type, tuple)) else kind(value)):
+                self.log("Errores", f"Mensaje '{json_data['type']}' inválido: campo '{field}' = {value!r}", line)
+                return False
+        return True
+    
+    # ---------- Mensajes de texto ----------
+    
+    def _on_detected_text(self, line, rest):
+        self.process_detection(line)
+        self.log("Detección", "Objeto detectado", line)
+    
+    def _on_color_text(self, line, rest):
+        color = rest.split(":")[0].strip()
+        self.accumulate_count(line, color)
+        self.log("Color", f"Color detectado: {color}", line)
+    
+    # ---------- Mensajes JSON ----------
+    
+    def _on_init(self, line, json_data):
+        stm32_status = json_data.get("stm32", 0)
+        
+        line.stm32_connected = stm32_status == 1
+        line.conveyor_speed = json_data.get("speed", 75)
+        line.esp_status = json_data.get("status", 0)
+        self.device_detections(line, json_data.get("detections", 0))
+        self.bus.publish("status", line.name)
+        
+        self.log("Comunicación", f"ESP32: Inicializado - STM32: {'Conectado' if stm32_status else 'Desconectado'}", line)
+        self.info(f"ESP32 inicializado\nSTM32: {'Conectado' if stm32_status else 'Desconectado'}\n", line)
+    
+    COUNT_FIELDS = ("red", "green", "blue", "other", "total", "detections")  # Orden de los snapshots
+    
+    @classmethod
+    def json_counts(cls, json_data):
+        return tuple(json_data.get(field, 0) for field in cls.COUNT_FIELDS)
+    
+    def _on_data(self, line, json_data):
+        # Usar los valores directamente del ESP32
+        self.apply_snapshot(line, self.json_counts(json_data), json_data.get("color", "NINGUNO"),
+                            seq=json_data.get("seq"))
+    
+    def _on_update(self, line, json_data):
+        self.apply_snapshot(line, self.json_counts(json_data), json_data.get("last_color", "NINGUNO"),
+                            json_data.get("speed", 75), json_data.get("status", 0), json_data.get("seq"))
+    
+    def _on_delta(self, line, json_data):
+        if "seq" not in json_data:
+            self.log("Errores", "Mensaje 'delta' sin secuencia", line)
+            return
+        self.apply_delta(line, json_data["seq"], json_data.get("color", "NINGUNO"))
+    
+    def _on_status(self, line, json_data):
+        line.conveyor_speed = json_data.get("speed", 75)
+        line.stm32_connected = json_data.get("stm32", 0) == 1
+        self.device_detections(line, json_data.get("detections", 0))
+        self.bus.publish("status", line.name)
+        self.bus.publish("counts", line.name)
+    
+    def _on_ok(self, line, json_data):
+        handler = self.ack_handlers.get(json_data.get("cmd", ""))
+        if handler is not None:
+            handler(line)
+    
+    def _ack_start(self, line):
+        line.system_running = True
+        self.bus.publish("status", line.name)
+        self.log("Sistema", "Sistema iniciado", line)
+        self.info("Sistema iniciado\n", line)
+    
+    def _ack_stop(self, line):
+        line.system_running = False
+        self.bus.publish("status", line.name)
+        self.log("Sistema", "Sistema detenido", line)
+        self.info("Sistema detenido\n", line)
+    
+    def _ack_reset(self, line):
+        # Resetear contadores locales (y en tiempo real también)
+        line.reset_counts()
+        line.set_color("NINGUNO")
+        
+        # Resetear historial (con varias líneas se conserva el de las demás)
+        if len(self.lines) == 1:
+            self.history.clear()
+        
+        self.bus.publish("counts", line.name)
+        self.log("Sistema", "Contadores reseteados", line)
+        self.info("Contadores reseteados\n", line)
+    
+    def _ack_subscribe(self, line):
+        line.push = True
+        self._cancel_poll(line.name)
+        self.log("Comunicación", "Suscripción activa: la ESP32 envía los cambios", line)
+    
+    def _ack_delta(self, line):
+        # La ESP32 envía a continuación el snapshot base de la secuencia
+        line.delta = True
+        line.seq = None
+        line.sync_pending = False
+        self._cancel_poll(line.name)
+        self.log("Comunicación", "Sincronización por eventos activa: la ESP32 envía cada detección numerada", line)
+    
+    def _on_alert(self, line, json_data):
+        msg = self.line_label(line, json_data.get("msg", ""))
+        self.log("Alerta", msg)
+        self.alarm(f"{msg}\n", line)
+    
+    def _on_proto(self, line, json_data):
+        if json_data.get("mode") == BINARY_MODE:
+            self.transport.set_binary(line.name)
+            line.protocol = BINARY_MODE
+            self.log("Comunicación", "Protocolo binario activado", line)
+    
+    def _on_ping_sent(self, line, json_data):
+        self.log("Comunicación", "Ping enviado a STM32", line)
+    
+    def _on_error(self, line, json_data):
+        error_msg = self.line_label(line, f"Error: {json_data.get('msg', 'Error desconocido')}")
+        self.log("Errores", error_msg)
+        self.alarm(f"{error_msg}\n", line)
+    
+    def apply_snapshot(self, line, counts, last_color, speed=None, status=None, seq=None):
+        """Aplica los contadores completos enviados por la ESP32 (update/data) a la línea
+        
+        counts: (rojo, verde, azul, otro, total, detecciones); speed y status solo vienen en update.
+        seq: secuencia del último evento incluido, en la sincronización por eventos.
+        """
+        missed = False
+        if line.delta:
+            if seq is None:
+                # Sin secuencia no se puede ordenar respecto de los eventos: solo el estado
+                if status is not None:
+                    line.conveyor_speed = speed
+                    line.esp_status = status
+                    self.bus.publish("status", line.name)
+                return
+            if line.seq is not None and seq < line.seq:
+                self.metrics.inc("sincronizacion", "obsoleto")
+                self.log("Comunicación", f"Snapshot obsoleto descartado (secuencia {seq}, aplicada {line.seq})", line)
+                return
+            if line.sync_pending:
+                self.metrics.inc("sincronizacion", "resincronizado")
+                self.log("Comunicación", f"Secuencia resincronizada en {seq}", line)
+            # Con una base previa, lo que el snapshot tenga de más son eventos que no llegaron
+            missed = line.seq is not None
+            line.seq = seq
+            line.sync_pending = False
+        
+        if line.resync:
+            line.resync = False
+            self.reconcile(line, counts)
+        elif missed:
+            self.reconcile(line, counts, "cuyos eventos no llegaron")
+        if any(line.count_offset):
+            counts = tuple(count + offset for count, offset in zip(counts, line.count_offset))
+        
+        red, green, blue, other, total, detections = counts
+        line.box_count["ROJO"] = red
+        line.box_count["VERDE"] = green
+        line.box_count["AZUL"] = blue
+        line.box_count["OTRO"] = other
+        line.total_count = total
+        line.detection_count = detections
+        
+        # Contadores en tiempo real con los valores acumulados
+        for color in COUNT_COLORS:
+            line.realtime_counts[color] = line.box_count[color]
+        line.realtime_detections = detections
+        
+        if status is not None:
+            line.conveyor_speed = speed
+            line.esp_status = status
+        
+        line.set_color(last_color)
+        if last_color != "NINGUNO":
+            self.log("Detecciones", f"Color detectado: {last_color}", line)
+        
+        self.bus.publish("counts", line.name)
+        if status is not None:
+            self.bus.publish("status", line.name)
+    
+    def device_detections(self, line, detections):
+        """Detecciones informadas por init/status, con la misma base que los snapshots
+        
+        No se tocan mientras falta conciliar tras un corte (el snapshot decide si la ESP32
+        reinició sus contadores) ni con eventos numerados, que ya las cuentan una a una.
+        """
+        if line.resync or line.delta:
+            return
+        line.detection_count = detections + line.count_offset[5]
+    
+    def reconcile(self, line, counts, cause="contadas durante la desconexión"):
+        """Primer snapshot tras una reconexión: registra las cajas contadas durante el corte
+        
+        Si la ESP32 devuelve menos de lo que ya se contó, reinició sus contadores: los
+        locales se conservan como base y lo que reporte se suma encima. También concilia
+        los snapshots tras un hueco en la sincronización por eventos.
+        """
+        local = line.counts()
+        if line.resync_base is not None:
+            # Lo contado al cortarse la conexión es la base aunque algo lo haya pisado después
+            local = tuple(max(base, count) for base, count in zip(line.resync_base, local))
+            line.resync_base = None
+        device = tuple(count + offset for count, offset in zip(counts, line.count_offset))
+        if any(d < l for d, l in zip(device, local)):
+            line.count_offset = local
+            device = tuple(count + offset for count, offset in zip(counts, local))
+            self.log("Sistema", "La ESP32 reinició sus contadores; se conservan los conteos locales", line)
+        
+        # Una fila de historial por color con cajas perdidas, con los acumulados resultantes
+        box = dict(line.box_count)
+        total = line.total_count
+        now = time.time()
+        recovered = 0
+        for i, color in enumerate(COUNT_COLORS):
+            missed = device[i] - local[i]
+            if missed > 0:
+                box[color] += missed
+                total += missed
+                recovered += missed
+                counts = (box["ROJO"], box["VERDE"], box["AZUL"], box["OTRO"], total, device[5])
+                self.history.append(now, color, counts, line.name)
+                self.bus.publish("count", line.name, (color, counts, missed))
+        if recovered:
+            self.log("Conteo", f"Recuperadas {recovered} cajas {cause}", line)
+    
+    def apply_delta(self, line, seq, color):
+        """Aplica un evento numerado: una detección y, si trae color, una caja contada
+        
+        Los repetidos se descartan. Ante un hueco se pide un snapshot y se ignoran los eventos
+        hasta recibirlo: por el orden del flujo, el snapshot ya incluye los recibidos antes.
+        """
+        if line.sync_pending:
+            return
+        if line.seq is not None and seq <= line.seq:
+            self.metrics.inc("sincronizacion", "repetido")
+            return
+        if line.seq is None or seq != line.seq + 1:
+            line.sync_pending = True
+            self.metrics.inc("sincronizacion", "hueco")
+            if line.seq is None:
+                self.log("Comunicación", f"Evento {seq} sin snapshot base: se pide un snapshot", line)
+            else:
+                self.log("Comunicación", f"Hueco en la secuencia de eventos: faltan {seq - line.seq - 1} "
+                         f"desde el {line.seq + 1}; se pide un snapshot", line)
+            self._send_command("GET_DATA", [line.name])
+            return
+        
+        line.seq = seq
+        self.process_detection(line)
+        self.log("Detección", "Objeto detectado", line)
+        if color != "NINGUNO":
+            self.accumulate_count(line, color)
+            self.log("Color", f"Color detectado: {color}", line)
+    
+    def handle_frame(self, name, frame_type, buf, offset, length):
+        """Procesa una trama binaria; los datos se decodifican directamente del buffer de recepción"""
+        line = self.lines.get(name)
+        if line is None:
+            return
+        
+        started = time.perf_counter()
+        try:
+            # Las tramas con equivalente JSON pasan por los mismos handlers registrados
+            if frame_type == FRAME_UPDATE:
+                *counts, status, speed, color = UPDATE_FRAME.unpack_from(buf, offset)
+                message = self.frame_counts("update", counts)
+                message.update(status=status, speed=speed, last_color=self.color_name(color))
+                self.dispatch_message(line, message)
+            elif frame_type == FRAME_DATA:
+                *counts, color = DATA_FRAME.unpack_from(buf, offset)
+                message = self.frame_counts("data", counts)
+                message["color"] = self.color_name(color)
+                self.dispatch_message(line, message)
+            elif frame_type == FRAME_DELTA:
+                seq, color = DELTA_FRAME.unpack_from(buf, offset)
+                self.dispatch_message(line, {"type": "delta", "seq": seq, "color": self.color_name(color)})
+            elif frame_type == FRAME_SNAPSHOT:
+                seq, *counts, color = SNAPSHOT_FRAME.unpack_from(buf, offset)
+                message = self.frame_counts("data", counts)
+                message.update(seq=seq, color=self.color_name(color))
+                self.dispatch_message(line, message)
+            elif frame_type == FRAME_STATUS:
+                stm32, speed, detections = STATUS_FRAME.unpack_from(buf, offset)
+                self.dispatch_message(line, {"type": "status", "stm32": stm32, "speed": speed,
+                                             "detections": detections})
+            elif frame_type == FRAME_DETECTION:
+                self.process_detection(line)
+                self.log("Detección", "Objeto detectado", line)
+            elif frame_type == FRAME_COLOR:
+                color = self.color_name(COLOR_FRAME.unpack_from(buf, offset)[0])
+                self.accumulate_count(line, color)
+                self.log("Color", f"Color detectado: {color}", line)
+            elif frame_type == FRAME_TEXT:
+                text = str(buf[offset:offset + length], "utf-8", "ignore").strip()
+                if text:
+                    self.handle_line(name, text)
+            else:
+                self.log("Comunicación", f"Trama binaria desconocida: tipo {frame_type}", line)
+        except struct.error as e:
+            self.log("Errores", f"Trama binaria inválida (tipo {frame_type}): {str(e)}", line)
+        finally:
+            # Las tramas de texto ya se miden en handle_line
+            if frame_type != FRAME_TEXT:
+                self.metrics.observe("parseo", time.perf_counter() - started)
+            self.metrics.inc("tramas", FRAME_NAMES.get(frame_type, "desconocida"))
+    
+    def frame_counts(self, msg_type, counts):
+        """Mensaje equivalente a una trama con contadores, con los nombres de campo del JSON"""
+        message = dict(zip(self.COUNT_FIELDS, counts))
+        message["type"] = msg_type
+        return message
+    
+    @staticmethod
+    def color_name(code):
+        if code < len(COUNT_COLORS):
+            return COUNT_COLORS[code]
+        return "NINGUNO" if code == NO_COLOR_CODE else "OTRO"
+
+# ========== SERVICIO SIN INTERFAZ ==========
+
+def parse_line_spec(spec):
+    """Convierte "NOMBRE=HOST:PUERTO" (o "HOST:PUERTO") en (nombre, host, puerto)"""
+    name, _, address = spec.rpartition("=")
+    host, _, port = address.partition(":")
+    return (name or None, host, int(port or 8080))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servicio de conteo de la cinta transportadora (sin interfaz)")
+    parser.add_argument("--line", action="append", default=[], metavar="NOMBRE=HOST:PUERTO",
+                        help="Línea a conectar (se puede repetir)")
+    parser.add_argument("--config", help="config.json guardado desde la GUI")
+    parser.add_argument("--interval", type=int, default=None, help="Intervalo inicial de GET_DATA en ms (0 lo desactiva)")
+    parser.add_argument("--export", action="store_true", help="Exportar los conteos a CSV al terminar")
+    parser.add_argument("--binary", action="store_true", help="Negociar el protocolo binario con las ESP32")
+    parser.add_argument("--push", action="store_true", help="Pedir a las ESP32 que envíen los cambios (suscripción)")
+    parser.add_argument("--delta", action="store_true",
+                        help="Pedir a las ESP32 eventos numerados en lugar de snapshots completos")
+    parser.add_argument("--store", default=STORE_FILENAME, help="Base SQLite de eventos (vacío la desactiva)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Puerto local del endpoint /metrics para Prometheus (0 lo desactiva)")
+    parser.add_argument("--log-file", default=LOG_FILENAME, help="Archivo de log rotativo (vacío lo desactiva)")
+    parser.add_argument("--capture", help="Grabar lo recibido de las ESP32 en este archivo")
+    parser.add_argument("--replay", help="Reproducir una captura en lugar de conectar con las ESP32")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="Velocidad de la reproducción (1 = tiempo real, 0 = máxima)")
+    args = parser.parse_args(argv)
+    
+    lines = []
+    interval = 1000
+    if args.config:
+        with open(args.config, "r") as f:
+            config = json.load(f)
+        lines = [(entry["name"], entry.get("host", "192.168.4.1"), int(entry.get("port", 8080)))
+                 for entry in config.get("lines", [])]
+        if not lines:
+            lines = [("Línea 1", config.get("tcp_host", "192.168.4.1"), int(config.get("tcp_port", 8080)))]
+        interval = int(config.get("update_interval", 1000)) if config.get("auto_update", True) else 0
+        args.binary = args.binary or config.get("binary_protocol", False)
+        args.push = args.push or config.get("push_updates", False)
+        args.delta = args.delta or config.get("delta_sync", False)
+    for spec in args.line:
+        name, host, port = parse_line_spec(spec)
+        lines.append((name or f"Línea {len(lines) + 1}", host, port))
+    if not lines:
+        lines = [("Línea 1", "192.168.4.1", 8080)]
+    if args.interval is not None:
+        interval = args.interval
+    
+    engine = ConveyorEngine()
+    engine.binary_protocol = args.binary
+    engine.push_updates = args.push
+    engine.delta_sync = args.delta
+    stop = threading.Event()
+    
+    # La consola y el archivo se escriben desde el hilo del sink, nunca desde el loop
+    log_sink = LogFileSink(args.log_file or None, echo=sys.stdout)
+    
+    def print_event(event):
+        if event.kind == "log":
+            category, message = event.data
+            log_sink.record(LogRecord(time.time(), category, message))
+    
+    engine.bus.subscribe(print_event)
+    
+    store = None
+    if args.store:
+        store = EventStore(args.store)
+        store.attach(engine)
+    
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = MetricsServer(engine.metrics, port=args.metrics_port)
+    
+    signal.signal(signal.SIGINT, lambda *a: stop.set())
+    signal.signal(signal.SIGTERM, lambda *a: stop.set())
+    
+    if args.replay:
+        # Sin conexiones: la captura alimenta el motor y el servicio termina al acabar
+        replay = engine.replay(args.replay, args.replay_speed)
+        replay.add_done_callback(lambda f: stop.set())
+        stop.wait()
+        engine.cancel_replay()
+    else:
+        if args.capture:
+            engine.start_capture(args.capture)
+        for name, host, port in lines:
+            engine.add_line(name, host, port)
+            engine.connect(name)
+        engine.set_polling(max(POLL_MIN_MS, interval) if interval else None)
+        stop.wait()
+    
+    if args.export and engine.history:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        history = engine.snapshot_history()
+        summary, per_line = engine.summaries()
+        try:
+            write_count_csv(history, f"conteo_datos_{timestamp}.csv")
+        finally:
+            history.close()
+        write_count_summary(summary, f"conteo_resumen_{timestamp}.txt", per_line if len(per_line) > 1 else ())
+    
+    engine.shutdown()
+    if store is not None:
+        store.close()
+    if metrics_server is not None:
+        metrics_server.close()
+    log_sink.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,381 @@
+import time
+STARTED = time.perf_counter()  # Referencia del tiempo de arranque, tomada antes de importar Tk
+
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
+from tkinter import font as tkfont
 from datetime import datetime
-import socket
 import threading
-import time
 import json
 import queue
-from collections import defaultdict
+import os
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+from conveyor_core import (
+    ConveyorEngine, IndexedLogBuffer, LineState, LogFileSink, LogRecord, MetricsServer, ThroughputHistory,
+    LOG_FILENAME, LOG_RETENTION, METRICS_HISTOGRAMS, METRICS_PORT, PLANT_VIEW, POLL_MIN_MS, decimate_minmax,
+    write_count_csv, write_count_summary,
+)
+from conveyor_store import EventStore, STORE_FILENAME
+
+# Despacho por cuadros de los datos recibidos (~30 Hz)
+FRAME_INTERVAL_MS = 33
+FRAME_BUDGET_S = 0.012  # Tiempo máximo de procesamiento por cuadro
+FRAME_CLOCK_CHECK = 32  # Mensajes procesados entre consultas al reloj
+
+# Cola de eventos del motor hacia la GUI: los redibujados se colapsan (uno pendiente por
+# línea) y las cajas se acumulan por línea y color; pasado INGEST_MAX_EVENTS se descartan
+# los mensajes informativos y pasado INGEST_HARD_MAX todo lo demás (con aviso)
+INGEST_MAX_EVENTS = 20000
+INGEST_HARD_MAX = 100000
+INGEST_COLLAPSED = frozenset(("counts", "status", "detection", "count"))
+INGEST_SHEDDABLE = frozenset(("info", "log"))
+INGEST_KEPT_CATEGORIES = frozenset(("Errores", "Alerta"))  # Logs que no se descartan
+
+# Tiempo que el indicador de detección permanece activo
+DETECTION_HOLD_S = 0.5
+
+# Filtros del visor de logs
+LOG_CATEGORIES = ("Errores", "Alerta", "Conteo", "Detección", "Detecciones", "Color", "Comunicación",
+                  "Sistema", "Exportación")
+LOG_PERIODS = (("Todo", None), ("Últimos 15 min", 15 * 60), ("Última hora", 3600), ("Últimas 24 h", 24 * 3600))
+ALL_CATEGORIES = "Todas"
+
+# Gráfico de caudal: ventanas disponibles (segundos) y período de redibujado
+CHART_SPANS = (("10 min", 600), ("1 h", 3600), ("8 h", 8 * 3600), ("24 h", 24 * 3600), ("7 días", 7 * 24 * 3600))
+CHART_REFRESH_MS = 1000
+CHART_COLORS = {"ROJO": "#D62828", "VERDE": "#2A9D8F", "AZUL": "#1D4E89", "OTRO": "#812E58"}
+
+# Pestaña de diagnóstico: período de actualización mientras está visible
+DIAG_REFRESH_MS = 1000
+
+# Arranque: los servicios se inician tras el primer dibujado de la ventana (o, si nunca se
+# expone, pasado este tiempo)
+STARTUP_FALLBACK_MS = 2000
+
+class VirtualLogView(ttk.Frame):
+    """Visor de logs que solo dibuja las líneas visibles del buffer"""
+    
+    def __init__(self, master, buffer, height=25, width=100):
+        super().__init__(master)
+        self.buffer = buffer
+        self.height = height
+        self.top_seq = 0  # Secuencia del primer registro visible
+        self.follow = True  # Seguir el final del log
+        self.highlight = None
+        self.dirty = True
+        
+        # Filtro activo: secuencias de los registros que coinciden, ampliadas al llegar nuevos
+        self.search = None
+        self.matches = None
+        self.matched_to = 0
+        
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+        
+        self.text = tk.Text(self, height=height, width=width, wrap="none", state="disabled")
+        self.text.pack(side="left", fill="both", expand=True)
+        self.text.tag_config("highlight", background="#F8DAEB", foreground="#C33B80")
+        self.line_height = max(1, tkfont.Font(font=self.text.cget("font")).metrics("linespace"))
+        
+        self.text.bind("<Configure>", lambda e: self.mark_dirty())
+        self.text.bind("<MouseWheel>", self._on_mousewheel)
+        self.text.bind("<Button-4>", lambda e: self._scroll_units(-3))
+        self.text.bind("<Button-5>", lambda e: self._scroll_units(3))
+    
+    def mark_dirty(self):
+        self.dirty = True
+    
+    def set_highlight(self, term):
+        self.highlight = term
+        self.mark_dirty()
+        self.refresh()
+    
+    def set_filter(self, search, highlight=None):
+        """Muestra solo los registros que devuelve search(since); None vuelve al log completo"""
+        self.search = search
+        self.matches = None if search is None else search(None)
+        self.matched_to = self.buffer.next_seq
+        self.follow = True
+        self.set_highlight(highlight)
+    
+    def _update_matches(self):
+        """Descarta coincidencias ya fuera del buffer y busca solo en los registros nuevos"""
+        if self.matches and self.matches[0] < self.buffer.first_seq:
+            del self.matches[:bisect_left(self.matches, self.buffer.first_seq)]
+        if self.matched_to < self.buffer.next_seq:
+            self.matches.extend(self.search(self.matched_to))
+            self.matched_to = self.buffer.next_seq
+    
+    def _total(self):
+        return len(self.buffer) if self.matches is None else len(self.matches)
+    
+    def _position(self, seq):
+        if self.matches is None:
+            return seq - self.buffer.first_seq
+        return bisect_left(self.matches, seq)
+    
+    def _seq_at(self, offset):
+        if self.matches is None:
+            return self.buffer.first_seq + offset
+        return self.matches[offset] if offset < len(self.matches) else self.buffer.next_seq
+    
+    def _records(self, offset, rows):
+        if self.matches is None:
+            return self.buffer.slice(offset, offset + rows)
+        return [self.buffer.get(seq) for seq in self.matches[offset:offset + rows]]
+    
+    def visible_rows(self):
+        height = self.text.winfo_height()
+        if height <= 1:
+            return self.height
+        return max(1, height // self.line_height)
+    
+    def _offset(self, rows):
+        max_offset = max(0, self._total() - rows)
+        if self.follow:
+            return max_offset
+        return min(max(0, self._position(self.top_seq)), max_offset)
+    
+    def _scroll_to(self, offset, rows):
+        max_offset = max(0, self._total() - rows)
+        offset = min(max(0, offset), max_offset)
+        self.follow = offset >= max_offset
+        self.top_seq = self._seq_at(offset)
+        self.mark_dirty()
+        self.refresh()
+    
+    def _scroll_units(self, units):
+        rows = self.visible_rows()
+        self._scroll_to(self._offset(rows) + units, rows)
+        return "break"
+    
+    def _on_mousewheel(self, event):
+        return self._scroll_units(-3 if event.delta > 0 else 3)
+    
+    def _on_scrollbar(self, *args):
+        rows = self.visible_rows()
+        offset = self._offset(rows)
+        if args[0] == "moveto":
+            offset = int(float(args[1]) * self._total())
+        elif args[0] == "scroll":
+            step = int(args[1])
+            offset += step * rows if args[2] == "pages" else step
+        self._scroll_to(offset, rows)
+    
+    def refresh(self):
+        """Redibuja la ventana visible si hubo cambios"""
+        if not self.dirty:
+            return
+        self.dirty = False
+        if self.matches is not None:
+            self._update_matches()
+        
+        rows = self.visible_rows()
+        offset = self._offset(rows)
+        records = self._records(offset, rows)
+        lines = [record.format() for record in records]
+        
+        self.text.config(state="normal")
+        self.text.delete("1.0", "end")
+        self.text.insert("1.0", "\n".join(lines))
+        
+        if self.highlight:
+            term = self.highlight.upper()
+            for row, line in enumerate(lines, start=1):
+                col = line.upper().find(term)
+                while col != -1:
+                    self.text.tag_add("highlight", f"{row}.{col}", f"{row}.{col + len(term)}")
+                    col = line.upper().find(term, col + len(term))
+        
+        self.text.config(state="disabled")
+        
+        total = self._total()
+        if total:
+            self.scrollbar.set(offset / total, min(1.0, (offset + len(records)) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+class ThroughputChart(ttk.Frame):
+    """Gráfico de cajas/min por color; los ítems del canvas se crean una vez y se mueven con coords"""
+    
+    MARGIN_LEFT = 70
+    MARGIN = 10
+    
+    def __init__(self, master, height=160, width=900):
+        super().__init__(master)
+        self.canvas = tk.Canvas(self, height=height, width=width, bg="#FFFFFF", highlightthickness=0)
+        self.canvas.pack(fill="both", expand=True)
+        self.height = height
+        self.width = width
+        
+        c = self.canvas
+        self.axis = c.create_line(0, 0, 0, 0, fill="#812E58")
+        self.peak_label = c.create_text(4, self.MARGIN, anchor="nw", fill="#812E58", font=("Arial", 8))
+        self.span_label = c.create_text(4, height - self.MARGIN, anchor="sw", fill="#812E58", font=("Arial", 8))
+        self.lines = {color: c.create_line(0, 0, 0, 0, fill=fill, width=2, state="hidden")
+                      for color, fill in CHART_COLORS.items()}
+        
+        # Leyenda fija
+        for i, (color, fill) in enumerate(CHART_COLORS.items()):
+            c.create_text(4, height // 2 - 24 + i * 14, anchor="w", text=color, fill=fill, font=("Arial", 8, "bold"))
+    
+    def draw(self, history, span, span_text):
+        c = self.canvas
+        width = c.winfo_width()
+        height = c.winfo_height()
+        if width <= 1:
+            width, height = self.width, self.height  # Aún sin dibujar en pantalla
+        left = self.MARGIN_LEFT
+        top = self.MARGIN
+        bottom = height - self.MARGIN
+        plot_width = max(1, width - left - self.MARGIN)
+        plot_height = max(1, bottom - top)
+        
+        # Cubetas de la resolución elegida (acotadas) y escala a cajas/min
+        level = history.level_for(span)
+        last = int(time.time() // level.seconds)
+        first = last - max(1, span // level.seconds) + 1
+        per_minute = 60 / level.seconds
+        series = {color: level.series(color, first, last) for color in CHART_COLORS}
+        peak = max(1, max(max(values) for values in series.values())) * per_minute
+        
+        x_step = plot_width / max(1, last - first)
+        y_scale = plot_height / peak * per_minute
+        for color, values in series.items():
+            coords = []
+            for i, value in decimate_minmax(values, plot_width):
+                coords.append(left + i * x_step)
+                coords.append(bottom - value * y_scale)
+            if len(coords) >= 4:
+                c.coords(self.lines[color], *coords)
+                c.itemconfig(self.lines[color], state="normal")
+            else:
+                c.itemconfig(self.lines[color], state="hidden")
+        
+        c.coords(self.axis, left, top, left, bottom, left + plot_width, bottom)
+        c.itemconfig(self.peak_label, text=f"{peak:.0f} cajas/min")
+        c.itemconfig(self.span_label, text=f"últimos {span_text}")
+
+class WidgetRenderer:
+    """Aplica a los widgets solo las opciones que cambiaron desde el último dibujado"""
+    
+    def __init__(self):
+        self.rendered = {}  # (widget, ítem del canvas) → opciones aplicadas
+        self.calls = 0  # Llamadas de configuración hechas a Tk
+    
+    def config(self, widget, **options):
+        if widget is not None:
+            self._apply(widget, None, options)
+    
+    def itemconfig(self, canvas, item, **options):
+        self._apply(canvas, item, options)
+    
+    def _apply(self, widget, item, options):
+        last = self.rendered.setdefault((str(widget), item), {})
+        changed = {key: value for key, value in options.items() if last.get(key) != value}
+        if not changed:
+            return
+        
+        if item is None:
+            widget.config(**changed)
+        else:
+            widget.itemconfig(item, **changed)
+        last.update(changed)
+        self.calls += 1
+
+class IngestQueue:
+    """Cola acotada de eventos del motor hacia la GUI, con descarte por prioridad
+    
+    put se llama desde el hilo del motor y get_nowait desde el de Tk. Solo se descartan
+    los mensajes informativos. Los redibujados y las cajas se colapsan en una entrada
+    pendiente por línea (y color), que lleva las repeticiones (en los "count", la suma
+    de sus cajas). Por encima de hard_max los errores, alertas y demás eventos tampoco
+    se pierden: se agrupan por tipo y línea, y la entrada guarda el más reciente.
+    """
+    
+    def __init__(self, metrics, max_events=INGEST_MAX_EVENTS, hard_max=INGEST_HARD_MAX):
+        self.metrics = metrics
+        self.max_events = max_events
+        self.hard_max = hard_max
+        self.lock = threading.Lock()
+        self.items = deque()  # [hora de llegada, evento, repeticiones, clave de colapso]
+        self.pending = {}  # clave de colapso → entrada pendiente en items
+        self.collapsed = 0
+        self.dropped = 0
+        self.grouped = 0  # Errores, alertas y demás eventos agrupados por superar hard_max
+        self.merged = 0  # Los agrupados aún sin avisar
+    
+    def qsize(self):
+        return len(self.items)
+    
+    def put(self, event):
+        kind = event.kind
+        if kind in INGEST_COLLAPSED:
+            if kind == "count":
+                key = (kind, event.line, event.data[0])
+                repeats = event.data[2]
+            else:
+                key = (kind, event.line, None)
+                repeats = 1
+            with self.lock:
+                entry = self.pending.get(key)
+                if entry is not None:
+                    entry[2] += repeats
+                    self.collapsed += 1
+                    self.metrics.inc("ingesta_colapsados", kind)
+                    return
+                entry = self.pending[key] = [time.perf_counter(), event, repeats, key]
+                self.items.append(entry)
+            return
+        
+        sheddable = kind in INGEST_SHEDDABLE and not self.essential(event)
+        with self.lock:
+            size = len(self.items)
+            if sheddable and size >= self.max_events:
+                self.dropped += 1
+                self.metrics.inc("ingesta_descartados", kind)
+                return
+            if size < self.hard_max:
+                self.items.append([time.perf_counter(), event, 1, None])
+                return
+            
+            # Cola saturada: una entrada pendiente por tipo y línea (y categoría del log)
+            key = (kind, event.line, event.data.category if kind == "log" else None)
+            entry = self.pending.get(key)
+            if entry is not None:
+                entry[1] = event
+                entry[2] += 1
+                self.grouped += 1
+                self.merged += 1
+                self.metrics.inc("ingesta_agrupados", kind)
+                return
+            entry = self.pending[key] = [time.perf_counter(), event, 1, key]
+            self.items.append(entry)
+    
+    @staticmethod
+    def essential(event):
+        if event.kind != "log":
+            return False
+        record = event.data
+        return record.category in INGEST_KEPT_CATEGORIES or "ERROR" in record.message.upper()
+    
+    def get_nowait(self):
+        """(hora de llegada, evento, repeticiones) del evento más antiguo"""
+        with self.lock:
+            if not self.items:
+                raise queue.Empty
+            queued, event, repeats, key = self.items.popleft()
+            if key is not None:
+                del self.pending[key]
+        return queued, event, repeats
+    
+    def take_merged(self):
+        with self.lock:
+            merged, self.merged = self.merged, 0
+        return merged
 
 class ConveyorControlGUI:
     def __init__(self, root):
@@ -15,45 +384,170 @@ class ConveyorControlGUI:
         self.root.geometry("1200x800")
         
         # Variables del sistema
-        self.system_running = False
-        self.connected = False
-        self.current_color = "NINGUNO"
-        self.box_count = {"ROJO": 0, "VERDE": 0, "AZUL": 0, "OTRO": 0}
-        self.total_count = 0
-        self.detection_count = 0
-        self.conveyor_speed = 75
-        self.stm32_connected = False
-        self.esp_status = 0
         self.last_detection_time = 0
         
-        # Historial de conteos para exportación
-        self.count_history = []  # Lista para almacenar historial de conteos
+        # Registros de log acotados en memoria, copiados a un archivo rotativo en segundo plano
+        self.log_buffer = IndexedLogBuffer(LOG_RETENTION)
+        try:
+            self.log_sink = LogFileSink(LOG_FILENAME)
+            log_sink_error = None
+        except OSError as e:
+            self.log_sink = None
+            log_sink_error = str(e)
+        
+        # Exportación de conteos en segundo plano
+        self.export_thread = None
+        self.export_cancel = None
+        
+        # Reproducción de una captura en curso
+        self.replaying = False
         
-        # Acumulador de datos en tiempo real (ahora acumulativo)
-        self.realtime_counts = defaultdict(int)  # Esto mantendrá los valores acumulados
-        self.realtime_detections = 0
         self.last_update_time = time.time()
         self.update_interval = 1.0
         
         # Configuración de comunicación TCP
         self.tcp_host = "192.168.4.1"  # IP del ESP32 en modo AP
         self.tcp_port = 8080
-        self.socket = None
-        
-        self.receive_thread = None
-        self.data_queue = queue.Queue()
-        self.data_timer = None
         
-        # Crear widgets
+        # Motor sin interfaz: líneas, protocolo, contadores e historial
+        self.engine = ConveyorEngine()
+        self.engine.add_line("Línea 1", self.tcp_host, self.tcp_port)
+        self.view_name = "Línea 1"  # Línea mostrada, o PLANT_VIEW para la planta completa
+        
+        # Registro persistente y endpoint de métricas: se abren en start_services
+        self.store = None
+        self.metrics_server = None
+        self.started = False
+        self.startup_ms = None
+        
+        # La GUI se suscribe a los eventos del motor y los despacha por cuadros; cada evento
+        # lleva la hora de llegada para medir la espera en la cola
+        self.data_queue = IngestQueue(self.engine.metrics)
+        self.engine.bus.subscribe(self.ingest_event)
+        
+        # Métricas por etapa (ver pestaña Diagnóstico) y endpoint local para Prometheus
+        self.metrics = self.engine.metrics
+        self.metrics.gauge("cola_gui", "Eventos pendientes en la cola de la GUI", self.data_queue.qsize)
+        self.diag_previous = None  # (hora, contadores) de la última actualización del diagnóstico
+        self.detection_timer = None
+        self.detection_active = False
+        
+        # Caudal por línea y de la planta completa, alimentado por los eventos "count"
+        self.throughput = {}
+        self.plant_throughput = ThroughputHistory()
+        
+        # Capa de dibujado: las secciones sucias se redibujan una vez por cuadro
+        self.renderer = WidgetRenderer()
+        self.dirty = set()
+        
+        # Valores de configuración: existen antes de que se construya la pestaña que los edita
+        self.init_config_vars()
+        
+        # Crear widgets (solo la pestaña principal; el resto al seleccionarlas)
         self.setup_gui()
         
-        # Iniciar thread para procesar datos recibidos
-        self.process_thread = threading.Thread(target=self.process_received_data, daemon=True)
-        self.process_thread.start()
+        # Actualización automática de datos según la configuración
+        self.apply_polling()
+        
+        if log_sink_error is not None:
+            self.log_event("Errores", f"No se pudo abrir el archivo de log {LOG_FILENAME}: {log_sink_error}")
+        
+        # Timers, base de eventos y métricas después del primer dibujado de la ventana
+        self.tab_control.bind("<Expose>", lambda e: self.root.after_idle(self.start_services))
+        self.root.after(STARTUP_FALLBACK_MS, self.start_services)
+        
+    def init_config_vars(self):
+        self.ip_var = tk.StringVar(value=self.tcp_host)
+        self.port_var = tk.StringVar(value=str(self.tcp_port))
+        self.interval_var = tk.StringVar(value="1000")
+        self.retention_var = tk.StringVar(value=str(LOG_RETENTION))
+        self.replay_file_var = tk.StringVar(value="")
+        self.replay_speed_var = tk.StringVar(value="1")
+        self.binary_var = tk.BooleanVar(value=False)
+        self.auto_update_var = tk.BooleanVar(value=True)
+        self.push_var = tk.BooleanVar(value=False)
+        self.delta_var = tk.BooleanVar(value=False)
+        self.log_compress_var = tk.BooleanVar(value=True)
+        
+        # Widgets de las pestañas diferidas; None hasta su primera selección
+        self.log_view = None
+        self.log_filter_status = None
+        self.export_progress = None
+        self.export_status = None
+        self.export_cancel_button = None
+        self.connect_button = None
+        self.capture_button = None
+        self.replay_button = None
+        self.diag_endpoint_label = None
+        self.diag_text = None
+    
+    def start_services(self):
+        """Arranca lo que no hace falta para mostrar la ventana; se llama una sola vez"""
+        if self.started:
+            return
+        self.started = True
+        self.tab_control.unbind("<Expose>")
+        self.startup_ms = (time.perf_counter() - STARTED) * 1000
+        self.metrics.gauge("arranque_ms", "Tiempo desde el arranque hasta el primer dibujado (ms)",
+                           lambda: round(self.startup_ms, 1))
+        
+        self.setup_menus()
+        
+        # Iniciar despacho por cuadros de los datos recibidos
+        self.start_dispatch_timer()
         
         # Iniciar timer para acumulación de tiempo real
         self.start_realtime_timer()
         
+        # Redibujado periódico del gráfico de caudal
+        self.root.after(CHART_REFRESH_MS, self._update_chart)
+        
+        # Actualización de la pestaña de diagnóstico
+        self.root.after(DIAG_REFRESH_MS, self._update_diagnostics)
+        
+        # Registro persistente de conteos, detecciones, alarmas y cambios de estado
+        try:
+            self.store = EventStore(STORE_FILENAME)
+            self.store.attach(self.engine)
+            self.metrics.gauge("almacen_pendientes", "Eventos pendientes de escribir en la base",
+                               self.store.queue.qsize)
+        except Exception as e:
+            self.store = None
+            self.log_event("Errores", f"No se pudo abrir la base de eventos {STORE_FILENAME}: {str(e)}")
+        
+        # Endpoint local para Prometheus
+        try:
+            self.metrics_server = MetricsServer(self.metrics, port=METRICS_PORT)
+        except OSError as e:
+            self.metrics_server = None
+            self.log_event("Errores", f"No se pudo abrir el endpoint de métricas en el puerto {METRICS_PORT}: {str(e)}")
+        
+        self.log_event("Sistema", f"Ventana lista en {self.startup_ms:.0f} ms")
+    
+    def setup_menus(self):
+        menubar = tk.Menu(self.root, bg="#F8DAEB", fg="#C33B80")
+        self.root.config(menu=menubar)
+        
+        file_menu = tk.Menu(menubar, tearoff=0, bg="#F8DAEB", fg="#C33B80")
+        menubar.add_cascade(label="Archivo", menu=file_menu)
+        file_menu.add_command(label="Exportar Logs", command=self.export_logs)
+        file_menu.add_command(label="Exportar Datos de Conteo", command=self.export_count_data)
+        file_menu.add_command(label="Guardar Configuración", command=self.save_config)
+        file_menu.add_separator()
+        file_menu.add_command(label="Salir", command=self.on_closing)
+        
+        system_menu = tk.Menu(menubar, tearoff=0, bg="#F8DAEB", fg="#C33B80")
+        menubar.add_cascade(label="Sistema", menu=system_menu)
+        system_menu.add_command(label="Conectar ESP32", command=self.connect_to_esp32)
+        system_menu.add_command(label="Desconectar ESP32", command=self.disconnect_from_esp32)
+        system_menu.add_separator()
+        system_menu.add_command(label="Iniciar Sistema", command=self.start_system)
+        system_menu.add_command(label="Detener Sistema", command=self.stop_system)
+        system_menu.add_command(label="Resetear Contadores", command=self.reset_counters)
+        system_menu.add_separator()
+        system_menu.add_command(label="Actualizar Datos", command=self.request_data)
+        system_menu.add_command(label="Obtener Estado", command=self.get_status)
+    
     def setup_gui(self):
         # Crear pestañas
         self.tab_control = ttk.Notebook(self.root)
@@ -70,12 +564,31 @@ class ConveyorControlGUI:
         self.tab_config_frame = ttk.Frame(self.tab_control)
         self.tab_control.add(self.tab_config_frame, text='Configuración')
         
+        # Pestaña 4: Diagnóstico
+        self.tab_diag_frame = ttk.Frame(self.tab_control)
+        self.tab_control.add(self.tab_diag_frame, text='Diagnóstico')
+        
         self.tab_control.pack(expand=1, fill="both")
         
-        # Configurar cada pestaña
+        # La pestaña principal se construye ya; las demás la primera vez que se seleccionan
         self.setup_control_tab()
-        self.setup_logs_tab()
-        self.setup_config_tab()
+        self.tab_builders = {
+            str(self.tab_logs_frame): self.setup_logs_tab,
+            str(self.tab_config_frame): self.setup_config_tab,
+            str(self.tab_diag_frame): self.setup_diag_tab,
+        }
+        self.tab_control.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        
+    def on_tab_changed(self, event=None):
+        builder = self.tab_builders.pop(self.tab_control.select(), None)
+        if builder is None:
+            return
+        builder()
+        
+        # Los widgets nuevos toman el estado actual en el próximo cuadro
+        self.refresh_view()
+        if self.log_view is not None:
+            self.log_view.mark_dirty()
         
     def setup_control_tab(self):
         # Marco superior - Estado del sistema
@@ -94,6 +607,17 @@ class ConveyorControlGUI:
         self.stm32_indicator = tk.Label(conn_frame, text="DESCONECTADO", fg="#C33B80", font=("Arial", 10, "bold"))
         self.stm32_indicator.pack(side="left", padx=20)
         
+        # Selector de línea mostrada
+        tk.Label(conn_frame, text="Vista:", font=("Arial", 10), fg="#812E58").pack(side="left", padx=5)
+        self.view_selector = ttk.Combobox(conn_frame, state="readonly", width=18)
+        self.view_selector.pack(side="left", padx=5)
+        self.view_selector.bind("<<ComboboxSelected>>", lambda e: self.select_view(self.view_selector.get()))
+        self.update_view_selector()
+        
+        # Eventos descartados por saturación de la cola (vacío mientras no se descarte nada)
+        self.ingest_label = tk.Label(status_frame, text="", fg="#C33B80", font=("Arial", 9))
+        self.ingest_label.pack()
+        
         # Marco izquierdo - Control y visualización
         left_frame = ttk.LabelFrame(self.tab_control_frame, text="Control y Visualización", padding=15)
         left_frame.grid(row=1, column=0, padx=10, pady=10, sticky="nsew")
@@ -137,7 +661,7 @@ class ConveyorControlGUI:
         color_frame = ttk.LabelFrame(left_frame, text="COLOR DETECTADO", padding=10)
         color_frame.pack(pady=10, fill="x")
         
-        self.color_display = tk.Label(color_frame, text=self.current_color, 
+        self.color_display = tk.Label(color_frame, text="NINGUNO", 
                                       font=("Arial", 24, "bold"), 
                                       bg="#D691B4", width=15, height=2, fg="#F8EAF2")
         self.color_display.pack()
@@ -150,8 +674,9 @@ class ConveyorControlGUI:
                            padx=10, pady=10)
         count_frame.pack(pady=20, fill="x")
         
-        # Contadores en tiempo real
+        # Contadores en tiempo real (etiquetas deshabilitadas en el diseño actual)
         self.realtime_labels = {}
+        self.detection_realtime_label = None
         colors = ["ROJO", "VERDE", "AZUL", "OTRO"]
         
         # Detecciones en tiempo real
@@ -181,7 +706,9 @@ class ConveyorControlGUI:
                            padx=10, pady=10)
         total_count_frame.pack(pady=20, fill="x")
         
-        # Detecciones totales
+        # Detecciones totales (deshabilitadas en el diseño actual, igual que el total)
+        self.detection_total_label = None
+        self.total_label = None
         #det_total_frame = ttk.Frame(total_count_frame)
         #det_total_frame.pack(fill="x", pady=2)
         #tk.Label(det_total_frame, text="DETECCIONES:", width=12, anchor="w", fg="#812E58").pack(side="left")
@@ -229,13 +756,14 @@ class ConveyorControlGUI:
             frame.pack(fill="x", pady=5)
             
             led = tk.Canvas(frame, width=20, height=20)
-            led.create_oval(2, 2, 18, 18, fill=default_color)
+            oval = led.create_oval(2, 2, 18, 18, fill=default_color)
             led.pack(side="left", padx=10)
             
             label = tk.Label(frame, text=led_text, fg="#812E58")
             label.pack(side="left")
             
-            self.leds[led_name] = (led, label)
+            # El óvalo se conserva y se recolorea con itemconfig
+            self.leds[led_name] = (led, oval, label)
         
         # Información del sistema
         info_frame = ttk.LabelFrame(right_frame, text="Información del Sistema", padding=10)
@@ -255,6 +783,22 @@ class ConveyorControlGUI:
         self.alarm_text.insert("1.0", "No hay alarmas activas.\n")
         self.alarm_text.config(state="disabled")
         
+        # Gráfico de caudal
+        chart_frame = ttk.LabelFrame(self.tab_control_frame, text="Caudal (cajas/min)", padding=10)
+        chart_frame.grid(row=2, column=0, columnspan=2, padx=10, pady=10, sticky="ew")
+        
+        span_frame = ttk.Frame(chart_frame)
+        span_frame.pack(fill="x")
+        tk.Label(span_frame, text="Ventana:", fg="#812E58").pack(side="left")
+        self.span_selector = ttk.Combobox(span_frame, state="readonly", width=10,
+                                          values=[text for text, _ in CHART_SPANS])
+        self.span_selector.set(CHART_SPANS[0][0])
+        self.span_selector.pack(side="left", padx=5)
+        self.span_selector.bind("<<ComboboxSelected>>", lambda e: self.draw_chart())
+        
+        self.chart = ThroughputChart(chart_frame)
+        self.chart.pack(fill="x", pady=5)
+        
         # Configurar grid weights
         self.tab_control_frame.columnconfigure(0, weight=1)
         self.tab_control_frame.columnconfigure(1, weight=1)
@@ -265,9 +809,37 @@ class ConveyorControlGUI:
         logs_frame = ttk.Frame(self.tab_logs_frame, padding=10)
         logs_frame.pack(fill="both", expand=True)
         
-        # Área de texto para historial
-        self.log_text = scrolledtext.ScrolledText(logs_frame, height=25, width=100)
-        self.log_text.pack(fill="both", expand=True)
+        # Filtros por categoría, texto y período (resueltos con el índice del buffer)
+        filter_bar = ttk.Frame(logs_frame)
+        filter_bar.pack(fill="x", pady=5)
+        
+        tk.Label(filter_bar, text="Categoría:", fg="#812E58").pack(side="left")
+        self.log_category = ttk.Combobox(filter_bar, state="readonly", width=14,
+                                         values=(ALL_CATEGORIES,) + LOG_CATEGORIES)
+        self.log_category.set(ALL_CATEGORIES)
+        self.log_category.pack(side="left", padx=5)
+        
+        tk.Label(filter_bar, text="Texto:", fg="#812E58").pack(side="left")
+        self.log_text_filter = ttk.Entry(filter_bar, width=25)
+        self.log_text_filter.pack(side="left", padx=5)
+        self.log_text_filter.bind("<Return>", lambda e: self.apply_log_filter())
+        
+        tk.Label(filter_bar, text="Período:", fg="#812E58").pack(side="left")
+        self.log_period = ttk.Combobox(filter_bar, state="readonly", width=14,
+                                       values=[text for text, _ in LOG_PERIODS])
+        self.log_period.set(LOG_PERIODS[0][0])
+        self.log_period.pack(side="left", padx=5)
+        
+        tk.Button(filter_bar, text="Filtrar", command=self.apply_log_filter,
+                 bg="#D691B4", fg="#F8EAF2").pack(side="left", padx=5)
+        tk.Button(filter_bar, text="Quitar Filtro", command=self.clear_log_filter,
+                 bg="#D691B4", fg="#F8EAF2").pack(side="left", padx=5)
+        self.log_filter_status = tk.Label(filter_bar, text="", fg="#812E58")
+        self.log_filter_status.pack(side="left", padx=10)
+        
+        # Área de texto para historial (solo se dibujan las líneas visibles)
+        self.log_view = VirtualLogView(logs_frame, self.log_buffer, height=25, width=100)
+        self.log_view.pack(fill="both", expand=True)
         
         # Barra de herramientas para logs
         toolbar = ttk.Frame(logs_frame)
@@ -282,6 +854,27 @@ class ConveyorControlGUI:
         tk.Button(toolbar, text="Buscar Error", command=self.search_errors,
                  bg="#D691B4", fg="#F8EAF2").pack(side="left", padx=5)
         
+        # Progreso de la exportación de conteos
+        self.export_cancel_button = tk.Button(toolbar, text="Cancelar Exportación", command=self.cancel_export,
+                                              bg="#D691B4", fg="#F8EAF2", state="disabled")
+        self.export_cancel_button.pack(side="right", padx=5)
+        self.export_progress = ttk.Progressbar(toolbar, length=200, mode="determinate")
+        self.export_progress.pack(side="right", padx=5)
+        self.export_status = tk.Label(toolbar, text="", fg="#812E58")
+        self.export_status.pack(side="right", padx=5)
+        
+    def setup_diag_tab(self):
+        diag_frame = ttk.Frame(self.tab_diag_frame, padding=10)
+        diag_frame.pack(fill="both", expand=True)
+        
+        self.diag_endpoint_label = tk.Label(diag_frame, text=self.metrics_endpoint_text(), fg="#812E58")
+        self.diag_endpoint_label.pack(anchor="w", pady=5)
+        
+        # Tablas de latencias, contadores y medidores (texto de ancho fijo)
+        self.diag_text = tk.Text(diag_frame, height=30, width=100, wrap="none", state="disabled",
+                                 font=("Courier", 10))
+        self.diag_text.pack(fill="both", expand=True)
+        
     def setup_config_tab(self):
         config_frame = ttk.Frame(self.tab_config_frame, padding=20)
         config_frame.pack(fill="both", expand=True)
@@ -291,36 +884,95 @@ class ConveyorControlGUI:
         conn_frame.pack(fill="x", pady=10)
         
         ttk.Label(conn_frame, text="IP ESP32:").grid(row=0, column=0, sticky="w", pady=5)
-        self.ip_entry = ttk.Entry(conn_frame, width=20)
+        self.ip_entry = ttk.Entry(conn_frame, width=20, textvariable=self.ip_var)
         self.ip_entry.grid(row=0, column=1, padx=10, pady=5)
-        self.ip_entry.insert(0, self.tcp_host)
         
         ttk.Label(conn_frame, text="Puerto:").grid(row=1, column=0, sticky="w", pady=5)
-        self.port_entry = ttk.Entry(conn_frame, width=10)
+        self.port_entry = ttk.Entry(conn_frame, width=10, textvariable=self.port_var)
         self.port_entry.grid(row=1, column=1, padx=10, pady=5)
-        self.port_entry.insert(0, str(self.tcp_port))
         
         self.connect_button = tk.Button(conn_frame, text="Conectar", 
                                        command=self.toggle_connection, 
                                        bg="#D691B4", fg="#F8EAF2")
         self.connect_button.grid(row=0, column=2, rowspan=2, padx=20)
         
+        # Líneas adicionales (la IP y el puerto de arriba corresponden a la línea mostrada)
+        ttk.Label(conn_frame, text="Nombre de línea:").grid(row=2, column=0, sticky="w", pady=5)
+        self.line_name_entry = ttk.Entry(conn_frame, width=20)
+        self.line_name_entry.grid(row=2, column=1, padx=10, pady=5)
+        
+        lines_buttons = ttk.Frame(conn_frame)
+        lines_buttons.grid(row=2, column=2, padx=20)
+        tk.Button(lines_buttons, text="Agregar Línea", command=self.add_line_from_entries,
+                 bg="#D691B4", fg="#F8EAF2").pack(side="left", padx=5)
+        tk.Button(lines_buttons, text="Eliminar Línea", command=self.remove_viewed_line,
+                 bg="#D691B4", fg="#F8EAF2").pack(side="left", padx=5)
+        
+        tk.Checkbutton(conn_frame, text="Protocolo binario (si la ESP32 lo soporta)",
+                      variable=self.binary_var, command=self.toggle_binary_protocol,
+                      fg="#812E58").grid(row=3, column=0, columnspan=3, pady=5, sticky="w")
+        
         # Configuración de actualización
         update_frame = ttk.LabelFrame(config_frame, text="Configuración de Actualización", padding=15)
         update_frame.pack(fill="x", pady=20)
         
         ttk.Label(update_frame, text="Intervalo de actualización (ms):").grid(row=0, column=0, sticky="w", pady=5)
-        self.interval_entry = ttk.Entry(update_frame, width=10)
+        self.interval_entry = ttk.Entry(update_frame, width=10, textvariable=self.interval_var)
         self.interval_entry.grid(row=0, column=1, padx=10, pady=5)
-        self.interval_entry.insert(0, "1000")
+        self.interval_entry.bind("<Return>", self.apply_polling)
+        self.interval_entry.bind("<FocusOut>", self.apply_polling)
         
-        self.auto_update_var = tk.BooleanVar(value=True)
         self.auto_update_cb = tk.Checkbutton(update_frame, text="Actualización automática", 
                                             variable=self.auto_update_var,
                                             command=self.toggle_auto_update,
                                             fg="#812E58")
         self.auto_update_cb.grid(row=1, column=0, columnspan=2, pady=5, sticky="w")
         
+        # Con suscripción la ESP32 envía los cambios; sin ella el intervalo se adapta al flujo de cajas
+        tk.Checkbutton(update_frame, text="Suscripción a cambios (si la ESP32 lo soporta)",
+                      variable=self.push_var, command=self.toggle_push_updates,
+                      fg="#812E58").grid(row=2, column=0, columnspan=2, pady=5, sticky="w")
+        
+        # Eventos numerados: el tráfico sigue a las cajas contadas y los contadores no retroceden
+        tk.Checkbutton(update_frame, text="Sincronización por eventos numerados (si la ESP32 lo soporta)",
+                      variable=self.delta_var, command=self.toggle_delta_sync,
+                      fg="#812E58").grid(row=3, column=0, columnspan=2, pady=5, sticky="w")
+        
+        # Configuración de logs
+        logs_frame = ttk.LabelFrame(config_frame, text="Configuración de Logs", padding=15)
+        logs_frame.pack(fill="x", pady=10)
+        
+        ttk.Label(logs_frame, text="Retención de logs (líneas):").grid(row=0, column=0, sticky="w", pady=5)
+        self.retention_entry = ttk.Entry(logs_frame, width=10, textvariable=self.retention_var)
+        self.retention_entry.grid(row=0, column=1, padx=10, pady=5)
+        
+        # Copia en disco: conveyor.log rota por tamaño o cada día
+        tk.Checkbutton(logs_frame, text=f"Comprimir los segmentos cerrados de {LOG_FILENAME} (gzip)",
+                      variable=self.log_compress_var, command=self.toggle_log_compress,
+                      fg="#812E58").grid(row=1, column=0, columnspan=2, pady=5, sticky="w")
+        
+        # Grabación de lo recibido y reproducción de capturas (para reproducir fallas de campo)
+        capture_frame = ttk.LabelFrame(config_frame, text="Captura y Reproducción", padding=15)
+        capture_frame.pack(fill="x", pady=10)
+        
+        self.capture_button = tk.Button(capture_frame, text="Grabar Captura", command=self.toggle_capture,
+                                        bg="#D691B4", fg="#F8EAF2")
+        if self.engine.capture is not None:
+            self.capture_button.config(text="Detener Grabación", bg="#C33B80")
+        self.capture_button.grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        
+        ttk.Label(capture_frame, text="Archivo:").grid(row=1, column=0, sticky="w", pady=5)
+        self.replay_file_entry = ttk.Entry(capture_frame, width=30, textvariable=self.replay_file_var)
+        self.replay_file_entry.grid(row=1, column=1, padx=10, pady=5)
+        
+        ttk.Label(capture_frame, text="Velocidad (0 = máxima):").grid(row=2, column=0, sticky="w", pady=5)
+        self.replay_speed_entry = ttk.Entry(capture_frame, width=10, textvariable=self.replay_speed_var)
+        self.replay_speed_entry.grid(row=2, column=1, padx=10, pady=5, sticky="w")
+        
+        self.replay_button = tk.Button(capture_frame, text="Reproducir", command=self.toggle_replay,
+                                       bg="#D691B4", fg="#F8EAF2")
+        self.replay_button.grid(row=1, column=2, rowspan=2, padx=20)
+        
         # Botón de prueba STM32
         stm32_frame = ttk.LabelFrame(config_frame, text="Prueba STM32", padding=15)
         stm32_frame.pack(fill="x", pady=20)
@@ -347,235 +999,219 @@ class ConveyorControlGUI:
                  command=self.test_connection,
                  bg="#C33B80", fg="#F8EAF2").pack(side="left", padx=10)
     
-    # ========== FUNCIONES DE CONEXIÓN ==========
+    # ========== LÍNEAS (CINTAS) ==========
     
-    def toggle_connection(self):
-        if not self.connected:
-            self.connect_to_esp32()
-        else:
-            self.disconnect_from_esp32()
+    def view(self):
+        """Estado mostrado: la línea seleccionada o la combinación de todas"""
+        if self.view_name == PLANT_VIEW:
+            return LineState.combine(list(self.engine.lines.values()))
+        return self.engine.lines[self.view_name]
     
-    def connect_to_esp32(self):
-        if self.connected:
+    def in_view(self, name):
+        return name is None or self.view_name == PLANT_VIEW or self.view_name == name
+    
+    def target_lines(self):
+        """Nombres de las líneas a las que se dirigen los comandos según la vista"""
+        if self.view_name == PLANT_VIEW:
+            return list(self.engine.lines)
+        return [self.view_name]
+    
+    def update_view_selector(self):
+        self.view_selector["values"] = list(self.engine.lines) + [PLANT_VIEW]
+        self.view_selector.set(self.view_name)
+    
+    def select_view(self, name):
+        if name != PLANT_VIEW and name not in self.engine.lines:
             return
-            
-        self.connect_button.config(state="disabled", text="Conectando...")
+        self.view_name = name
         
-        host = self.ip_entry.get()
-        port = int(self.port_entry.get())
+        # La IP y el puerto de configuración corresponden a la línea mostrada
+        if name != PLANT_VIEW:
+            line = self.engine.lines[name]
+            self.ip_var.set(line.host)
+            self.port_var.set(str(line.port))
         
-        threading.Thread(target=self._connect_thread, args=(host, port), daemon=True).start()
+        self.update_view_selector()
+        self.refresh_view()
+        self.draw_chart()
     
-    def _connect_thread(self, host, port):
+    def add_line_from_entries(self):
+        name = self.line_name_entry.get().strip() or f"Línea {len(self.engine.lines) + 1}"
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)
-            
-            self.root.after(0, lambda: self.log_event("Comunicación", f"Conectando a {host}:{port}..."))
-            
-            sock.connect((host, port))
-            sock.settimeout(1)
-            
-            self.root.after(0, self._connection_successful, sock, host, port)
-            
-        except socket.timeout:
-            self.root.after(0, self._connection_failed, f"Timeout: No se pudo conectar a {host}:{port}")
-        except ConnectionRefusedError:
-            self.root.after(0, self._connection_failed, f"Conexión rechazada por {host}")
-        except Exception as e:
-            self.root.after(0, self._connection_failed, f"Error conectando a {host}: {str(e)}")
-    
-    def _connection_successful(self, sock, host, port):
-        self.socket = sock
-        self.connected = True
-        self.tcp_host = host
-        self.tcp_port = port
-        
-        self.connect_button.config(state="normal", text="Desconectar", bg="#C33B80", fg="#F8EAF2")
-        self.esp_indicator.config(text="CONECTADO", fg="#C33B80")
-        self.update_led("Comunicación", "#C33B80", "CONECTADO")
+            port = int(self.port_var.get())
+            self.engine.add_line(name, self.ip_var.get(), port)
+        except ValueError as e:
+            messagebox.showwarning("Advertencia", str(e))
+            return
         
-        self.log_event("Comunicación", f"¡Conectado a ESP32 en {host}:{port}!")
-        self.update_info_text(f"Conexión establecida con ESP32\nIP: {host}:{port}\n")
+        self.line_name_entry.delete(0, tk.END)
+        self.log_event("Sistema", f"Línea agregada: {name} ({self.ip_var.get()}:{port})")
+        self.select_view(name)
+    
+    def remove_viewed_line(self):
+        if self.view_name == PLANT_VIEW or len(self.engine.lines) == 1:
+            messagebox.showwarning("Advertencia", "Selecciona una línea (debe quedar al menos una)")
+            return
         
-        self.receive_thread = threading.Thread(target=self.receive_data, daemon=True)
-        self.receive_thread.start()
+        name = self.view_name
+        self.engine.remove_line(name)
+        self.throughput.pop(name, None)
+        self.log_event("Sistema", f"Línea eliminada: {name}")
+        self.select_view(next(iter(self.engine.lines)))
+    
+    # ========== FUNCIONES DE CONEXIÓN ==========
+    
+    def toggle_connection(self):
+        view = self.view()
+        if not view.connected and not view.reconnecting:
+            self.connect_to_esp32()
+        else:
+            self.disconnect_from_esp32()
+    
+    def connect_to_esp32(self):
+        targets = [name for name in self.target_lines() if not self.engine.lines[name].connected]
+        if not targets:
+            return
         
-        # Iniciar actualización automática de datos
-        if self.auto_update_var.get():
-            self.start_auto_update()
+        self.renderer.config(self.connect_button, state="disabled", text="Conectando...")
         
-        # Solicitar estado inicial
-        self.send_command("GET_STATUS")
-    
-    def _connection_failed(self, error_msg):
-        self.connect_button.config(state="normal", text="Conectar", bg="#D691B4", fg="#F8EAF2")
-        self.esp_indicator.config(text="DESCONECTADO", fg="#C33B80")
+        # La línea mostrada toma la IP y el puerto de la configuración
+        if self.view_name != PLANT_VIEW:
+            self.engine.connect(self.view_name, self.ip_var.get(), int(self.port_var.get()))
+            return
         
-        self.log_event("Errores", error_msg)
-        messagebox.showerror("Error de Conexión", error_msg)
+        for name in targets:
+            self.engine.connect(name)
     
     def disconnect_from_esp32(self):
-        try:
-            if self.socket:
-                self.socket.close()
-                self.socket = None
-            
-            self.connected = False
-            self.system_running = False
-            self.stm32_connected = False
-            self.connect_button.config(text="Conectar", bg="#D691B4", fg="#F8EAF2")
-            self.esp_indicator.config(text="DESCONECTADO", fg="#C33B80")
-            self.stm32_indicator.config(text="DESCONECTADO", fg="#C33B80")
-            self.update_led("Comunicación", "#D691B4", "DESCONECTADO")
-            self.update_led("Cinta", "#D691B4", "DETENIDA")
-            self.update_led("Sensor", "#D691B4", "SENSOR INACTIVO")
-            
-            self.log_event("Comunicación", "Desconectado de ESP32")
-            self.update_info_text("Desconectado de ESP32\n")
-            
-            # Detener actualización automática
-            self.stop_auto_update()
-            
-            # Deshabilitar botones
-            self.start_button.config(state="normal", bg="#D691B4")
-            self.stop_button.config(state="disabled", bg="#D691B4")
-            
-        except Exception as e:
-            self.log_event("Errores", f"Error al desconectar: {str(e)}")
+        for name in self.target_lines():
+            self.engine.disconnect(name)
     
     def test_connection(self):
-        host = self.ip_entry.get()
-        port = int(self.port_entry.get())
-        
-        def test():
-            try:
-                test_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                test_sock.settimeout(3)
-                test_sock.connect((host, port))
-                test_sock.close()
+        host = self.ip_var.get()
+        port = int(self.port_var.get())
+        
+        def report(future):
+            error = future.result()
+            if error is None:
                 self.root.after(0, lambda: messagebox.showinfo("Prueba Exitosa", 
                     f"Conexión exitosa a {host}:{port}"))
-            except Exception as e:
+            else:
                 self.root.after(0, lambda: messagebox.showerror("Prueba Fallida", 
-                    f"No se pudo conectar a {host}:{port}\nError: {str(e)}"))
+                    f"No se pudo conectar a {host}:{port}\nError: {error}"))
         
-        threading.Thread(target=test, daemon=True).start()
+        self.engine.probe(host, port).add_done_callback(report)
     
-    # ========== RECEPCIÓN DE DATOS ==========
+    # ========== EVENTOS DEL MOTOR ==========
     
-    def receive_data(self):
-        buffer = ""
-        while self.connected and self.socket:
-            try:
-                data = self.socket.recv(1024)
-                if not data:
-                    break
-                    
-                data_str = data.decode('utf-8', errors='ignore')
-                if data_str:
-                    buffer += data_str
-                    
-                    while '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
-                        line = line.strip()
-                        if line:
-                            self.data_queue.put(line)
-                            
-            except socket.timeout:
-                continue
-            except (ConnectionResetError, BrokenPipeError):
-                break
-            except Exception as e:
-                if self.connected:
-                    self.root.after(0, lambda: self.log_event("Errores", f"Error recepción: {str(e)}"))
-                break
-        
-        if self.connected:
-            self.root.after(0, self.disconnect_from_esp32)
+    # Los eventos llegan a data_queue desde el hilo del motor
+    
+    def ingest_event(self, event):
+        """Hilo del motor: los logs se copian al archivo aquí, así la cola puede descartar su copia"""
+        if event.kind == "log":
+            category, message = event.data
+            record = LogRecord(time.time(), category, message)
+            if self.log_sink is not None:
+                self.log_sink.record(record)
+            event = event._replace(data=record)
+        self.data_queue.put(event)
+    
+    def start_dispatch_timer(self):
+        """Inicia el despacho por cuadros de los eventos recibidos"""
+        self.root.after(FRAME_INTERVAL_MS, self.process_received_data)
     
     def process_received_data(self):
-        while True:
-            try:
-                data = self.data_queue.get(timeout=0.1)
-                self.root.after(0, self.handle_esp_data, data)
-            except queue.Empty:
-                continue
-    
-    def handle_esp_data(self, data):
+        """Procesa en bloque los eventos pendientes, con un presupuesto de tiempo por cuadro"""
+        started = time.perf_counter()
+        deadline = started + FRAME_BUDGET_S
+        processed = 0
+        observe = self.metrics.observe
         try:
-            if data.startswith('{'):
-                json_data = json.loads(data)
-                self.process_json_data(json_data)
-            else:
-                # Procesar mensaje de DETECCIÓN
-                if "DETECTADO" in data:
-                    self.process_detection()
-                    self.log_event("Detección", "Objeto detectado")
-                # Procesar mensaje directo de color
-                elif "Color:" in data:
-                    color = data.split(":")[1].strip()
-                    self.accumulate_realtime_count(color)
-                    self.log_event("Color", f"Color detectado: {color}")
-                else:
-                    self.log_event("Comunicación", f"Mensaje ESP32: {data}")
+            while True:
+                try:
+                    queued, event, repeats = self.data_queue.get_nowait()
+                except queue.Empty:
+                    break
                 
-        except json.JSONDecodeError:
-            # Procesar mensaje directo
-            if "DETECTADO" in data:
-                self.process_detection()
-                self.log_event("Detección", "Objeto detectado")
-            elif "Color:" in data:
-                color = data.split(":")[1].strip()
-                self.accumulate_realtime_count(color)
-                self.log_event("Color", f"Color detectado: {color}")
-            else:
-                self.log_event("Comunicación", f"Datos recibidos: {data}")
+                # Espera hasta el inicio del cuadro; el resto se mide como despacho
+                observe("cola", max(0.0, started - queued))
+                self.handle_event(event, repeats)
+                processed += 1
+                
+                # Lo que no alcance a procesarse queda en la cola para el siguiente cuadro
+                if processed % FRAME_CLOCK_CHECK == 0 and time.perf_counter() >= deadline:
+                    break
+            
+            dispatched = time.perf_counter()
+            if processed:
+                observe("despacho", dispatched - started)
+            
+            # Un solo redibujado por cuadro de los indicadores y del log
+            log_dirty = self.log_view is not None and self.log_view.dirty
+            if self.dirty or log_dirty:
+                self.render()
+                if log_dirty:
+                    self.log_view.refresh()
+                observe("dibujado", time.perf_counter() - dispatched)
+        finally:
+            self.root.after(FRAME_INTERVAL_MS, self.process_received_data)
+    
+    def handle_event(self, event, repeats=1):
+        kind, name, data = event
+        try:
+            if kind == "log":
+                self.show_log_record(data)
+                if repeats > 1:
+                    self.show_log_record(LogRecord(data.timestamp, data.category,
+                                                   f"(agrupado con {repeats - 1} mensajes anteriores: cola saturada)"))
+            elif kind == "info":
+                self.update_info_text(data)
+            elif kind == "alarm":
+                if repeats > 1:
+                    data = f"{data.rstrip()} (y {repeats - 1} alertas anteriores agrupadas)\n"
+                self.update_alarm_text(data)
+            elif kind == "connection":
+                state, message = data
+                if self.in_view(name):
+                    self.refresh_view()
+                if state == "failed":
+                    messagebox.showerror("Error de Conexión", message)
+            elif kind == "count":
+                self.record_throughput(name, data[0], repeats)
+            elif kind == "replay":
+                self.replay_event(name, data)
+            elif not self.in_view(name):
+                return
+            elif kind == "counts":
+                self.dirty.add("counts")
+            elif kind == "detection":
+                self.show_detection()
+            elif kind == "status":
+                self.dirty.add("status")
         except Exception as e:
             self.log_event("Errores", f"Error procesando datos ESP32: {str(e)}")
     
-    def process_detection(self):
-        """Procesa una detección de objeto"""
-        self.detection_count += 1
-        self.realtime_detections += 1
+    def show_detection(self):
+        """Muestra una detección de objeto"""
         self.last_detection_time = time.time()
+        self.detection_active = True
+        self.dirty.update(("detection", "status", "counts"))
         
-        # Actualizar indicador visual
-        self.detection_indicator.config(text="OBJETO DETECTADO", bg="#C33B80", fg="#F8EAF2")
-        self.update_led("Sensor", "#C33B80", "SENSOR ACTIVO")
-        
-        # Programar regreso a estado normal después de 500ms
-        self.root.after(500, self.reset_detection_indicator)
-        
-        # Actualizar etiquetas
-        self.detection_total_label.config(text=str(self.detection_count))
-        
-        # Actualizar LED de detección si el sistema está corriendo
-        if self.system_running:
-            self.update_led("Sensor", "#C33B80", "SENSOR ACTIVO")
+        # Programar regreso a estado normal después de 500ms (un solo timer pendiente)
+        if self.detection_timer is None:
+            self.detection_timer = self.root.after(int(DETECTION_HOLD_S * 1000), self.reset_detection_indicator)
     
     def reset_detection_indicator(self):
         """Regresa el indicador de detección a estado normal"""
-        self.detection_indicator.config(text="NO DETECTADO", bg="#D691B4", fg="#F8EAF2")
-    
-    def accumulate_realtime_count(self, color):
-        """Acumula conteo en tiempo real (acumulativo)"""
-        if color in self.realtime_counts:
-            self.realtime_counts[color] += 1
-        else:
-            self.realtime_counts[color] = 1
-        
-        # Contar siempre (sin verificar tiempo)
-        if color in self.box_count:
-            self.box_count[color] += 1
-            self.total_count += 1
-            self.update_counters()
-            self.update_color_display(color)
-            
-            # Registrar en el historial de conteos
-            self.log_count_event(color)
-            
-            self.log_event("Conteo", f"Caja {color} contada (Total: {self.total_count})")
+        # Si hubo detecciones recientes, esperar lo que falta desde la última
+        remaining = self.last_detection_time + DETECTION_HOLD_S - time.time()
+        if remaining > 0:
+            self.detection_timer = self.root.after(max(1, int(remaining * 1000)), self.reset_detection_indicator)
+            return
+        
+        self.detection_timer = None
+        self.detection_active = False
+        self.dirty.update(("detection", "status"))
     
     def start_realtime_timer(self):
         """Inicia el timer para actualizar contadores en tiempo real cada 1 segundo"""
@@ -585,11 +1221,8 @@ class ConveyorControlGUI:
         """Actualiza contadores en tiempo real SIN resetearlos"""
         try:
             # Actualizar etiquetas de tiempo real con valores acumulados
-            self.detection_realtime_label.config(text=str(self.realtime_detections))
-            
-            for color in ["ROJO", "VERDE", "AZUL", "OTRO"]:
-                count = self.realtime_counts.get(color, 0)
-                self.realtime_labels[color].config(text=str(count))
+            self.dirty.add("counts")
+            self.update_ingest_status()
             
             # NO resetear conteos - mantener acumulado
             # Los valores se mantienen acumulados hasta que se reseteen manualmente
@@ -601,299 +1234,295 @@ class ConveyorControlGUI:
             self.log_event("Errores", f"Error actualizando contadores tiempo real: {str(e)}")
             self.root.after(1000, self._update_realtime_counts)
     
-    def process_json_data(self, json_data):
-        msg_type = json_data.get("type", "")
-        
-        if msg_type == "init":
-            stm32_status = json_data.get("stm32", 0)
-            speed = json_data.get("speed", 75)
-            status = json_data.get("status", 0)
-            detections = json_data.get("detections", 0)
-            
-            self.stm32_connected = stm32_status == 1
-            self.conveyor_speed = speed
-            self.esp_status = status
-            self.detection_count = detections
-            
-            self.update_stm32_indicator()
-            self.detection_total_label.config(text=str(self.detection_count))
-            
-            self.log_event("Comunicación", f"ESP32: Inicializado - STM32: {'Conectado' if stm32_status else 'Desconectado'}")
-            self.update_info_text(f"ESP32 inicializado\nSTM32: {'Conectado' if stm32_status else 'Desconectado'}\n")
-            
-        elif msg_type == "data":
-            red = json_data.get("red", 0)
-            green = json_data.get("green", 0)
-            blue = json_data.get("blue", 0)
-            other = json_data.get("other", 0)
-            total = json_data.get("total", 0)
-            last_color = json_data.get("color", "NINGUNO")
-            detections = json_data.get("detections", 0)
-            
-            # Usar los valores directamente del ESP32
-            self.box_count["ROJO"] = red
-            self.box_count["VERDE"] = green
-            self.box_count["AZUL"] = blue
-            self.box_count["OTRO"] = other
-            self.total_count = total
-            self.detection_count = detections
-            
-            self.update_counters()
-            self.update_color_display(last_color)
-            self.detection_total_label.config(text=str(self.detection_count))
-            
-            # Actualizar contadores en tiempo real con los valores acumulados
-            self.realtime_counts["ROJO"] = red
-            self.realtime_counts["VERDE"] = green
-            self.realtime_counts["AZUL"] = blue
-            self.realtime_counts["OTRO"] = other
-            self.realtime_detections = detections
-            
-            # Actualizar etiquetas de tiempo real
-            self._update_realtime_display()
-            
-        elif msg_type == "update":
-            red = json_data.get("red", 0)
-            green = json_data.get("green", 0)
-            blue = json_data.get("blue", 0)
-            other = json_data.get("other", 0)
-            total = json_data.get("total", 0)
-            last_color = json_data.get("last_color", "NINGUNO")
-            speed = json_data.get("speed", 75)
-            status = json_data.get("status", 0)
-            detections = json_data.get("detections", 0)
-            
-            # Usar los valores directamente del ESP32
-            self.box_count["ROJO"] = red
-            self.box_count["VERDE"] = green
-            self.box_count["AZUL"] = blue
-            self.box_count["OTRO"] = other
-            self.total_count = total
-            self.conveyor_speed = speed
-            self.esp_status = status
-            self.detection_count = detections
-            
-            self.update_counters()
-            self.update_color_display(last_color)
-            self.detection_total_label.config(text=str(self.detection_count))
-            
-            # Actualizar contadores en tiempo real
-            self.realtime_counts["ROJO"] = red
-            self.realtime_counts["VERDE"] = green
-            self.realtime_counts["AZUL"] = blue
-            self.realtime_counts["OTRO"] = other
-            self.realtime_detections = detections
-            
-            # Actualizar etiquetas de tiempo real
-            self._update_realtime_display()
-            
-            if status == 1:
-                self.update_led("Cinta", "#C33B80", "CINTA EN MOVIMIENTO")
-                self.update_led("Sensor", "#C33B80", "SENSOR ACTIVO")
-                self.update_led("Clasificación", "#C33B80", "CLASIFICACIÓN ACTIVA")
-            elif status == 0:
-                self.update_led("Cinta", "#D691B4", "CINTA DETENIDA")
-                self.update_led("Sensor", "#D691B4", "SENSOR INACTIVO")
-                self.update_led("Clasificación", "#D691B4", "CLASIFICACIÓN INACTIVA")
-            
-        elif msg_type == "status":
-            speed = json_data.get("speed", 75)
-            stm32 = json_data.get("stm32", 0)
-            detections = json_data.get("detections", 0)
-            
-            self.conveyor_speed = speed
-            self.stm32_connected = stm32 == 1
-            self.detection_count = detections
-            
-            self.update_stm32_indicator()
-            self.detection_total_label.config(text=str(self.detection_count))
-            
-        elif msg_type == "ok":
-            cmd = json_data.get("cmd", "")
-            if cmd == "start":
-                self.system_running = True
-                self.start_button.config(state="disabled", bg="#812E58")
-                self.stop_button.config(state="normal", bg="#C33B80")
-                self.update_led("Sensor", "#C33B80", "SENSOR ACTIVO")
-                self.log_event("Sistema", "Sistema iniciado")
-                self.update_info_text("Sistema iniciado\n")
-            elif cmd == "stop":
-                self.system_running = False
-                self.start_button.config(state="normal", bg="#D691B4")
-                self.stop_button.config(state="disabled", bg="#D691B4")
-                self.update_led("Sensor", "#D691B4", "SENSOR INACTIVO")
-                self.log_event("Sistema", "Sistema detenido")
-                self.update_info_text("Sistema detenido\n")
-            elif cmd == "reset":
-                # Resetear contadores locales
-                for color in self.box_count:
-                    self.box_count[color] = 0
-                self.total_count = 0
-                self.detection_count = 0
-                
-                # Resetear contadores en tiempo real también
-                self.realtime_counts.clear()
-                self.realtime_detections = 0
-                
-                # Resetear historial
-                self.count_history = []
-                
-                self.update_counters()
-                self.update_color_display("NINGUNO")
-                self.detection_total_label.config(text="0")
-                self._update_realtime_display()  # Actualizar display de tiempo real
-                self.log_event("Sistema", "Contadores reseteados")
-                self.update_info_text("Contadores reseteados\n")
-                
-        elif msg_type == "alert":
-            msg = json_data.get("msg", "")
-            self.log_event("Alerta", msg)
-            self.update_alarm_text(f"{msg}\n")
-            
-        elif msg_type == "ping_sent":
-            self.log_event("Comunicación", "Ping enviado a STM32")
-            
-        elif msg_type == "error":
-            error_msg = json_data.get("msg", "Error desconocido")
-            self.log_event("Errores", f"Error: {error_msg}")
-            self.update_alarm_text(f"Error: {error_msg}\n")
+    def update_ingest_status(self):
+        merged = self.data_queue.take_merged()
+        if merged:
+            self.log_event("Errores", f"Cola de eventos saturada: {merged} errores o alertas agrupados "
+                                      f"(el archivo de log los conserva todos)")
+        dropped = self.data_queue.dropped
+        grouped = self.data_queue.grouped
+        text = ""
+        if grouped:
+            text = f"Cola saturada: {grouped} errores o alertas agrupados, {dropped} mensajes descartados"
+        elif dropped:
+            text = f"Cola saturada: {dropped} mensajes descartados"
+        # Los errores agrupados se resaltan: su detalle solo queda en el archivo de log
+        self.renderer.config(self.ingest_label, text=text, fg="#812E58" if grouped else "#C33B80",
+                             font=("Arial", 9, "bold" if grouped else "normal"))
     
     def _update_realtime_display(self):
         """Actualiza las etiquetas de tiempo real inmediatamente"""
-        self.detection_realtime_label.config(text=str(self.realtime_detections))
+        view = self.view()
+        self.renderer.config(self.detection_realtime_label, text=str(view.realtime_detections))
         for color in ["ROJO", "VERDE", "AZUL", "OTRO"]:
-            count = self.realtime_counts.get(color, 0)
-            self.realtime_labels[color].config(text=str(count))
-    
-    # ========== REGISTRO DE CONTEO EN LOGS ==========
-    
-    def log_count_event(self, color):
-        """Registra un evento de conteo en el historial"""
-        timestamp = datetime.now()
-        count_entry = {
-            "timestamp": timestamp,
-            "color": color,
-            "counts": {
-                "ROJO": self.box_count["ROJO"],
-                "VERDE": self.box_count["VERDE"],
-                "AZUL": self.box_count["AZUL"],
-                #"OTRO": self.box_count["OTRO"],
-                #"TOTAL": self.total_count,
-                #"DETECCIONES": self.detection_count
-            }
-        }
-        self.count_history.append(count_entry)
+            count = view.realtime_counts.get(color, 0)
+            self.renderer.config(self.realtime_labels.get(color), text=str(count))
+    
+    # ========== CAUDAL ==========
+    
+    def record_throughput(self, name, color, n=1):
+        now = time.time()
+        if name not in self.throughput:
+            self.throughput[name] = ThroughputHistory()
+        self.throughput[name].add(now, color, n)
+        self.plant_throughput.add(now, color, n)
+    
+    def draw_chart(self):
+        if self.view_name == PLANT_VIEW:
+            history = self.plant_throughput
+        else:
+            history = self.throughput.setdefault(self.view_name, ThroughputHistory())
+        span_text = self.span_selector.get()
+        span = dict(CHART_SPANS).get(span_text, CHART_SPANS[0][1])
+        self.chart.draw(history, span, span_text)
+    
+    def _update_chart(self):
+        try:
+            self.draw_chart()
+        except Exception as e:
+            self.log_event("Errores", f"Error dibujando el gráfico de caudal: {str(e)}")
+        self.root.after(CHART_REFRESH_MS, self._update_chart)
+    
+    # ========== DIAGNÓSTICO ==========
+    
+    def _update_diagnostics(self):
+        try:
+            if self.diag_text is not None and self.tab_control.select() == str(self.tab_diag_frame):
+                self.draw_diagnostics()
+        except Exception as e:
+            self.log_event("Errores", f"Error actualizando el diagnóstico: {str(e)}")
+        self.root.after(DIAG_REFRESH_MS, self._update_diagnostics)
+    
+    def metrics_endpoint_text(self):
+        if self.metrics_server is not None:
+            return f"Métricas para Prometheus en {self.metrics_server.url}"
+        if not self.started:
+            return "Endpoint de métricas: iniciando..."
+        return "Endpoint de métricas desactivado"
+    
+    def draw_diagnostics(self):
+        """Latencias por etapa, mensajes por tipo (con su tasa) y medidores"""
+        self.renderer.config(self.diag_endpoint_label, text=self.metrics_endpoint_text())
+        metrics = self.metrics
+        now = time.time()
+        counters = dict(metrics.counters)
+        previous_time, previous = self.diag_previous or (metrics.started, {})
+        elapsed = max(1e-6, now - previous_time)
+        self.diag_previous = (now, counters)
+        
+        def ms(value):
+            return "-" if value is None else f"{value * 1000:.3f}"
+        
+        rows = [f"{'Etapa':<12}{'Eventos':>12}{'p50 ms':>12}{'p99 ms':>12}{'Máx ms':>12}{'Media ms':>12}"]
+        for stage, _ in METRICS_HISTOGRAMS:
+            histogram = metrics.histograms[stage]
+            mean = histogram.total / histogram.count if histogram.count else None
+            rows.append(f"{stage:<12}{histogram.count:>12}{ms(histogram.quantile(0.5)):>12}"
+                        f"{ms(histogram.quantile(0.99)):>12}{ms(histogram.max if histogram.count else None):>12}"
+                        f"{ms(mean):>12}")
+        
+        rows.append("")
+        rows.append(f"{'Contador':<16}{'Tipo':<16}{'Total':>14}{'Por segundo':>14}")
+        for (name, label), value in sorted(counters.items()):
+            rate = (value - previous.get((name, label), 0)) / elapsed
+            rows.append(f"{name:<16}{label:<16}{value:>14}{rate:>14.1f}")
+        
+        rows.append("")
+        rows.append(f"{'Medidor':<24}{'Valor':>14}")
+        for name, value in sorted(metrics.read_gauges().items()):
+            rows.append(f"{name:<24}{'-' if value is None else value:>14}")
+        
+        self.diag_text.config(state="normal")
+        self.diag_text.delete("1.0", tk.END)
+        self.diag_text.insert("1.0", "\n".join(rows))
+        self.diag_text.config(state="disabled")
     
     # ========== ENVÍO DE COMANDOS ==========
     
     def send_command(self, command):
-        if self.connected and self.socket:
-            try:
-                self.socket.sendall(f"{command}\n".encode('utf-8'))
-                self.log_event("Comunicación", f"Comando enviado: {command}")
-            except Exception as e:
-                self.log_event("Errores", f"Error enviando comando: {str(e)}")
-                self.disconnect_from_esp32()
+        """Envía un comando a las líneas de la vista actual"""
+        self.engine.send_command(command, self.target_lines())
     
     def request_data(self):
-        if self.connected:
-            self.send_command("GET_DATA")
+        self.send_command("GET_DATA")
     
     def get_status(self):
-        if self.connected:
-            self.send_command("GET_STATUS")
+        self.send_command("GET_STATUS")
     
     def ping_stm32(self):
-        if self.connected:
-            self.send_command("PING_STM32")
+        self.send_command("PING_STM32")
     
     def start_system(self):
-        if not self.connected:
+        targets = [name for name in self.target_lines() if self.engine.lines[name].connected]
+        if not targets:
             messagebox.showwarning("Advertencia", "Conecta primero con la ESP32")
             return
         
-        self.send_command("START")
-        self.system_running = True
-        self.start_button.config(state="disabled", bg="#812E58")
-        self.stop_button.config(state="normal", bg="#C33B80")
+        self.engine.start(targets)
         
     def stop_system(self):
-        if self.connected:
-            self.send_command("STOP")
-        self.system_running = False
-        self.start_button.config(state="normal", bg="#D691B4")
-        self.stop_button.config(state="disabled", bg="#D691B4")
+        self.engine.stop(self.target_lines())
     
     def reset_counters(self):
-        if self.connected:
-            self.send_command("RESET_COUNTERS")
-        else:
-            # Reset local
-            for color in self.box_count:
-                self.box_count[color] = 0
-            self.total_count = 0
-            self.detection_count = 0
-            
-            # Resetear contadores en tiempo real también
-            self.realtime_counts.clear()
-            self.realtime_detections = 0
-            
-            # Resetear historial
-            self.count_history = []
-            
-            self.update_counters()
-            self.update_color_display("NINGUNO")
-            self.detection_total_label.config(text="0")
-            self._update_realtime_display()  # Actualizar display de tiempo real
-            self.detection_indicator.config(text="NO DETECTADO", bg="#D691B4")
-            self.log_event("Sistema", "Contadores y detecciones reseteados localmente")
+        self.engine.reset(self.target_lines())
+        self.last_detection_time = 0
+        self.detection_active = False
+        self.dirty.add("detection")
     
     # ========== ACTUALIZACIÓN AUTOMÁTICA ==========
     
-    def start_auto_update(self):
-        if self.connected and self.auto_update_var.get():
-            try:
-                interval = int(self.interval_entry.get())
-            except ValueError:
-                interval = 1000
-                
-            interval = max(100, interval)  # Mínimo 100ms
-            self.data_timer = self.root.after(interval, self._auto_update)
-    
-    def _auto_update(self):
-        if self.connected and self.auto_update_var.get():
-            self.request_data()
-            try:
-                interval = int(self.interval_entry.get())
-            except ValueError:
-                interval = 1000
-                
-            interval = max(100, interval)
-            self.data_timer = self.root.after(interval, self._auto_update)
+    def apply_polling(self, event=None):
+        """Configura en el motor la consulta periódica de GET_DATA"""
+        if not self.auto_update_var.get():
+            self.engine.set_polling(None)
+            return
+        
+        try:
+            interval = int(self.interval_var.get())
+        except ValueError:
+            interval = 1000
+        
+        self.engine.set_polling(max(POLL_MIN_MS, interval))
+    
+    def toggle_binary_protocol(self):
+        """Se aplica en la próxima conexión de cada línea"""
+        self.engine.binary_protocol = self.binary_var.get()
+    
+    def toggle_push_updates(self):
+        """Se aplica en la próxima conexión de cada línea"""
+        self.engine.push_updates = self.push_var.get()
     
-    def stop_auto_update(self):
-        if self.data_timer:
-            self.root.after_cancel(self.data_timer)
-            self.data_timer = None
+    def toggle_delta_sync(self):
+        """Se aplica en la próxima conexión de cada línea"""
+        self.engine.delta_sync = self.delta_var.get()
     
     def toggle_auto_update(self):
-        if self.auto_update_var.get():
-            self.start_auto_update()
-        else:
-            self.stop_auto_update()
+        self.apply_polling()
+    
+    def toggle_log_compress(self):
+        """Se aplica en la próxima rotación del archivo de log"""
+        if self.log_sink is not None:
+            self.log_sink.compress = self.log_compress_var.get()
+    
+    def toggle_capture(self):
+        """Graba lo recibido de todas las líneas en captura_<fecha>.cap, o termina la grabación"""
+        if self.engine.capture is not None:
+            path = self.engine.stop_capture()
+            self.capture_button.config(text="Grabar Captura", bg="#D691B4")
+            if path:
+                self.replay_file_var.set(path)
+            return
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        try:
+            self.engine.start_capture(f"captura_{timestamp}.cap")
+        except OSError as e:
+            self.log_event("Errores", f"No se pudo crear la captura: {str(e)}")
+            return
+        self.capture_button.config(text="Detener Grabación", bg="#C33B80")
+    
+    def toggle_replay(self):
+        """Reproduce la captura indicada por el mismo camino que los datos recibidos"""
+        if self.replaying:
+            self.engine.cancel_replay()
+            return
+        
+        path = self.replay_file_var.get().strip()
+        try:
+            speed = float(self.replay_speed_var.get())
+        except ValueError:
+            messagebox.showwarning("Advertencia", "Velocidad inválida")
+            return
+        if not path or not os.path.exists(path):
+            messagebox.showwarning("Advertencia", "Indica un archivo de captura existente")
+            return
+        
+        self.replaying = True
+        self.replay_button.config(text="Detener Reproducción", bg="#C33B80")
+        self.engine.replay(path, max(0.0, speed))
+    
+    def replay_event(self, name, state):
+        if state == "line":
+            # Línea de la captura que no existía: se agrega al selector
+            self.update_view_selector()
+            return
+        self.replaying = False
+        self.replay_button.config(text="Reproducir", bg="#D691B4")
+        self.refresh_view()
     
     # ========== ACTUALIZACIÓN GUI ==========
     
-    def update_counters(self):
-        for color in self.box_count:
-            self.count_labels[color].config(text=str(self.box_count[color]))
-        self.total_label.config(text=str(self.total_count))
-        self.detection_total_label.config(text=str(self.detection_count))
+    def refresh_view(self):
+        """Marca todos los indicadores para redibujarlos con el estado de la vista actual"""
+        self.dirty.update(("connection", "status", "counts", "detection"))
     
-    def update_color_display(self, color):
-        self.current_color = color
-        self.color_display.config(text=color)
+    def render(self):
+        """Redibuja las secciones sucias; el renderer solo envía a Tk lo que cambió"""
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        
+        view = self.view()
+        if "connection" in dirty or "status" in dirty:
+            # El estado incluye la salud del enlace (tiempo de respuesta y timeouts)
+            self.update_connection_widgets(view)
+        if "status" in dirty:
+            self.update_stm32_indicator(view)
+            self.update_system_buttons(view)
+            self.update_status_leds(view)
+        if "counts" in dirty:
+            self.update_counters(view)
+            self.update_color_display(view.current_color)
+            self._update_realtime_display()
+        if "detection" in dirty:
+            self.update_detection_indicator()
+    
+    def update_connection_widgets(self, view):
+        if view.connected:
+            self.renderer.config(self.connect_button, state="normal", text="Desconectar", bg="#C33B80", fg="#F8EAF2")
+            self.renderer.config(self.esp_indicator, text=self.link_text(view), fg="#C33B80")
+            if view.unanswered:
+                self.update_led("Comunicación", "#812E58", "SIN RESPUESTA")
+            else:
+                self.update_led("Comunicación", "#C33B80", "CONECTADO")
+        elif view.reconnecting:
+            # Reintentando tras un corte: el botón detiene la reconexión
+            self.renderer.config(self.connect_button, state="normal", text="Desconectar", bg="#C33B80", fg="#F8EAF2")
+            self.renderer.config(self.esp_indicator, text="RECONECTANDO...", fg="#C33B80")
+            self.update_led("Comunicación", "#D691B4", "RECONECTANDO...")
+        else:
+            self.renderer.config(self.connect_button, state="normal", text="Conectar", bg="#D691B4", fg="#F8EAF2")
+            self.renderer.config(self.esp_indicator, text="DESCONECTADO", fg="#C33B80")
+            self.update_led("Comunicación", "#D691B4", "DESCONECTADO")
+    
+    def update_system_buttons(self, view):
+        if view.system_running:
+            self.renderer.config(self.start_button, state="disabled", bg="#812E58")
+            self.renderer.config(self.stop_button, state="normal", bg="#C33B80")
+        else:
+            self.renderer.config(self.start_button, state="normal", bg="#D691B4")
+            self.renderer.config(self.stop_button, state="disabled", bg="#D691B4")
+    
+    def update_status_leds(self, view):
+        if view.esp_status == 1:
+            self.update_led("Cinta", "#C33B80", "CINTA EN MOVIMIENTO")
+            self.update_led("Clasificación", "#C33B80", "CLASIFICACIÓN ACTIVA")
+        else:
+            self.update_led("Cinta", "#D691B4", "CINTA DETENIDA")
+            self.update_led("Clasificación", "#D691B4", "CLASIFICACIÓN INACTIVA")
         
+        if view.esp_status == 1 or view.system_running or self.detection_active:
+            self.update_led("Sensor", "#C33B80", "SENSOR ACTIVO")
+        else:
+            self.update_led("Sensor", "#D691B4", "SENSOR INACTIVO")
+    
+    def update_counters(self, view):
+        for color in view.box_count:
+            self.renderer.config(self.count_labels[color], text=str(view.box_count[color]))
+        self.renderer.config(self.total_label, text=str(view.total_count))
+        self.renderer.config(self.detection_total_label, text=str(view.detection_count))
+    
+    def update_color_display(self, color):
         color_map = {
             "ROJO": "#C33B80",
             "VERDE": "#C33B80", 
@@ -905,23 +1534,34 @@ class ConveyorControlGUI:
         bg_color = color_map.get(color, "#D691B4")
         fg_color = "#F8EAF2"
         
-        self.color_display.config(bg=bg_color, fg=fg_color)
-        
-        if color != "NINGUNO":
-            self.log_event("Detecciones", f"Color detectado: {color}")
+        self.renderer.config(self.color_display, text=color, bg=bg_color, fg=fg_color)
     
-    def update_stm32_indicator(self):
-        if self.stm32_connected:
-            self.stm32_indicator.config(text="CONECTADO", fg="#C33B80")
+    def update_detection_indicator(self):
+        if self.detection_active:
+            self.renderer.config(self.detection_indicator, text="OBJETO DETECTADO", bg="#C33B80", fg="#F8EAF2")
         else:
-            self.stm32_indicator.config(text="DESCONECTADO", fg="#C33B80")
+            self.renderer.config(self.detection_indicator, text="NO DETECTADO", bg="#D691B4", fg="#F8EAF2")
+    
+    def update_stm32_indicator(self, view):
+        if view.stm32_connected:
+            # Lo informa la ESP32: no hay respuesta que mida el tramo hasta el STM32
+            self.renderer.config(self.stm32_indicator, text="CONECTADO", fg="#C33B80")
+        else:
+            self.renderer.config(self.stm32_indicator, text="DESCONECTADO", fg="#C33B80")
+    
+    @staticmethod
+    def link_text(view):
+        """Estado del enlace con la mediana del tiempo de respuesta reciente"""
+        if view.unanswered:
+            return f"SIN RESPUESTA ({view.unanswered})"
+        rtt = view.rtt_ms()
+        return "CONECTADO" if rtt is None else f"CONECTADO ({rtt:.0f} ms)"
     
     def update_led(self, led_name, color, text):
         if led_name in self.leds:
-            canvas, label = self.leds[led_name]
-            canvas.delete("all")
-            canvas.create_oval(2, 2, 18, 18, fill=color)
-            label.config(text=text, fg="#812E58")
+            canvas, oval, label = self.leds[led_name]
+            self.renderer.itemconfig(canvas, oval, fill=color)
+            self.renderer.config(label, text=text, fg="#812E58")
     
     def update_info_text(self, message):
         self.info_text.config(state="normal")
@@ -936,23 +1576,25 @@ class ConveyorControlGUI:
         self.alarm_text.config(state="disabled")
     
     def log_event(self, event_type, message):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] [{event_type}] {message}\n"
-        
-        self.log_text.config(state="normal")
-        self.log_text.insert("end", log_entry)
-        self.log_text.see("end")
-        self.log_text.config(state="disabled")
-        
-        if event_type == "Errores" or "ERROR" in message.upper():
-            self.update_alarm_text(f"{message}\n")
+        record = LogRecord(time.time(), event_type, message)
+        if self.log_sink is not None:
+            self.log_sink.record(record)
+        self.show_log_record(record)
+    
+    def show_log_record(self, record):
+        # El visor se redibuja una vez por cuadro en process_received_data
+        self.log_buffer.append(record)
+        if self.log_view is not None:
+            self.log_view.mark_dirty()
+        
+        if record.category == "Errores" or "ERROR" in record.message.upper():
+            self.update_alarm_text(f"{record.message}\n")
     
     # ========== FUNCIONES ADICIONALES ==========
     
     def clear_logs(self):
-        self.log_text.config(state="normal")
-        self.log_text.delete("1.0", "end")
-        self.log_text.config(state="disabled")
+        self.log_buffer.clear()
+        self.clear_log_filter()
         self.log_event("Sistema", "Logs limpiados")
     
     def export_logs(self):
@@ -961,8 +1603,7 @@ class ConveyorControlGUI:
             filename = f"logs_conveyor_{timestamp}.txt"
             
             with open(filename, "w", encoding='utf-8') as f:
-                logs = self.log_text.get("1.0", "end")
-                f.write(logs)
+                f.writelines(f"{record.format()}\n" for record in self.log_buffer)
             
             self.log_event("Sistema", f"Logs exportados a {filename}")
             messagebox.showinfo("Éxito", f"Logs exportados a {filename}")
@@ -970,78 +1611,142 @@ class ConveyorControlGUI:
             self.log_event("Errores", f"Error exportando logs: {str(e)}")
     
     def export_count_data(self):
-        """Exporta los datos de conteo en formato CSV"""
+        """Exporta los datos de conteo en formato CSV (en segundo plano)"""
+        if self.export_thread is not None:
+            messagebox.showinfo("Exportación en Curso", "Ya hay una exportación de conteo en curso.")
+            return
+        
+        if not self.engine.history:
+            messagebox.showinfo("Sin Datos", "No hay datos de conteo para exportar.")
+            return
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"conteo_datos_{timestamp}.csv"
+        summary_filename = f"conteo_resumen_{timestamp}.txt"
+        
+        # Instantánea del historial y de los totales: el conteo sigue durante la exportación
+        history = self.engine.snapshot_history()
+        summary, per_line = self.engine.summaries()
+        if len(per_line) == 1:
+            per_line = []
+        
+        self.export_cancel = threading.Event()
+        self.renderer.config(self.export_progress, maximum=max(1, len(history)), value=0)
+        self.renderer.config(self.export_status, text="Exportando...")
+        self.renderer.config(self.export_cancel_button, state="normal")
+        
+        self.export_thread = threading.Thread(
+            target=self._export_count_thread,
+            args=(history, summary, per_line, filename, summary_filename, self.export_cancel),
+            daemon=True)
+        self.export_thread.start()
+    
+    def _export_count_thread(self, history, summary, per_line, filename, summary_filename, cancel_event):
         try:
-            if not self.count_history:
-                messagebox.showinfo("Sin Datos", "No hay datos de conteo para exportar.")
-                return
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"conteo_datos_{timestamp}.csv"
-            
-            with open(filename, "w", encoding='utf-8') as f:
-                # Escribir encabezados
-                f.write("FECHA_HORA,COLOR,ROJO,VERDE,AZUL,OTRO,TOTAL,DETECCIONES\n")
-                
-                # Escribir datos
-                for entry in self.count_history:
-                    ts = entry["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
-                    color = entry["color"]
-                    counts = entry["counts"]
-                    
-                    f.write(f"{ts},{color},{counts['ROJO']},{counts['VERDE']},{counts['AZUL']},{counts['OTRO']},{counts['TOTAL']},{counts['DETECCIONES']}\n")
+            completed = write_count_csv(
+                history, filename, cancel_event,
+                lambda written, total: self.root.after(0, self._export_count_progress, written, total))
             
-            # Exportar también un resumen final
-            summary_filename = f"conteo_resumen_{timestamp}.txt"
-            with open(summary_filename, "w", encoding='utf-8') as f:
-                f.write("=== RESUMEN FINAL DE CONTEO ===\n")
-                f.write(f"Fecha y hora: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write("=" * 40 + "\n")
-                f.write(f"Rojo: {self.box_count['ROJO']}\n")
-                f.write(f"Verde: {self.box_count['VERDE']}\n")
-                f.write(f"Azul: {self.box_count['AZUL']}\n")
-                f.write(f"Otro: {self.box_count['OTRO']}\n")
-                f.write(f"Total: {self.total_count}\n")
-                f.write(f"Detecciones: {self.detection_count}\n")
-                f.write("=" * 40 + "\n")
+            if completed:
+                write_count_summary(summary, summary_filename, per_line)
+            else:
+                os.remove(filename)
             
+            self.root.after(0, self._export_count_finished, filename, summary_filename, completed, None)
+        except Exception as e:
+            self.root.after(0, self._export_count_finished, filename, summary_filename, False, str(e))
+        finally:
+            history.close()
+    
+    def _export_count_progress(self, written, total):
+        self.renderer.config(self.export_progress, maximum=max(1, total), value=written)
+        self.renderer.config(self.export_status, text=f"Exportando... {written}/{total}")
+    
+    def _export_count_finished(self, filename, summary_filename, completed, error):
+        self.export_thread = None
+        self.export_cancel = None
+        self.renderer.config(self.export_cancel_button, state="disabled")
+        
+        if error:
+            self.renderer.config(self.export_status, text="Error en exportación")
+            self.log_event("Errores", f"Error exportando datos de conteo: {error}")
+            messagebox.showerror("Error", f"Error exportando datos: {error}")
+        elif not completed:
+            self.renderer.config(self.export_progress, value=0)
+            self.renderer.config(self.export_status, text="Exportación cancelada")
+            self.log_event("Exportación", "Exportación de datos de conteo cancelada")
+        else:
+            self.renderer.config(self.export_status, text="Exportación completa")
             self.log_event("Exportación", f"Datos de conteo exportados a {filename} y {summary_filename}")
             messagebox.showinfo("Éxito", f"Datos exportados:\n{filename}\n{summary_filename}")
-            
-        except Exception as e:
-            self.log_event("Errores", f"Error exportando datos de conteo: {str(e)}")
-            messagebox.showerror("Error", f"Error exportando datos: {str(e)}")
     
-    def search_errors(self):
-        logs = self.log_text.get("1.0", "end")
-        error_count = logs.upper().count("ERROR")
-        
-        self.log_text.config(state="normal")
-        self.log_text.tag_remove("error", "1.0", "end")
+    def cancel_export(self):
+        if self.export_cancel is not None:
+            self.export_cancel.set()
+    
+    def apply_log_filter(self):
+        category = self.log_category.get()
+        category = None if category == ALL_CATEGORIES else category
+        text = self.log_text_filter.get().strip() or None
+        period = dict(LOG_PERIODS).get(self.log_period.get())
+        start = time.time() - period if period else None
+        
+        if category is None and text is None and start is None:
+            self.clear_log_filter()
+            return
         
-        start_idx = "1.0"
-        while True:
-            start_idx = self.log_text.search("ERROR", start_idx, stopindex="end", nocase=True)
-            if not start_idx:
-                break
-            end_idx = f"{start_idx}+{len('ERROR')}c"
-            self.log_text.tag_add("error", start_idx, end_idx)
-            start_idx = end_idx
+        def search(since):
+            return self.log_buffer.search(category, text, start, since=since)
         
-        self.log_text.tag_config("error", background="#F8DAEB", foreground="#C33B80")
-        self.log_text.config(state="disabled")
+        self.log_view.set_filter(search, text)
+        self.log_filter_status.config(text=f"{len(self.log_view.matches)} registros")
+    
+    def clear_log_filter(self):
+        self.log_view.set_filter(None)
+        self.log_filter_status.config(text="")
+    
+    def search_errors(self):
+        """Muestra los registros de la categoría Errores o que mencionan ERROR"""
+        def search(since):
+            by_category = self.log_buffer.search("Errores", since=since)
+            by_text = self.log_buffer.search(text="ERROR", since=since)
+            return array("q", sorted(set(by_category).union(by_text)))
+        
+        self.log_category.set(ALL_CATEGORIES)
+        self.log_text_filter.delete(0, tk.END)
+        self.log_view.set_filter(search, "ERROR")
+        error_count = len(self.log_view.matches)
+        self.log_filter_status.config(text=f"{error_count} registros")
         
         messagebox.showinfo("Búsqueda de Errores", f"Se encontraron {error_count} errores en los logs")
     
     def save_config(self):
         try:
+            lines = self.engine.lines
+            if self.view_name != PLANT_VIEW and not lines[self.view_name].connected:
+                lines[self.view_name].host = self.ip_var.get()
+                lines[self.view_name].port = int(self.port_var.get())
+            
+            first = next(iter(lines.values()))
             config = {
-                "tcp_host": self.ip_entry.get(),
-                "tcp_port": int(self.port_entry.get()),
+                "tcp_host": first.host,
+                "tcp_port": first.port,
+                "lines": [{"name": line.name, "host": line.host, "port": line.port}
+                          for line in lines.values()],
                 "auto_update": self.auto_update_var.get(),
-                "update_interval": self.interval_entry.get()
+                "update_interval": self.interval_var.get(),
+                "binary_protocol": self.binary_var.get(),
+                "push_updates": self.push_var.get(),
+                "delta_sync": self.delta_var.get(),
+                "log_retention": int(self.retention_var.get()),
+                "log_compress": self.log_compress_var.get()
             }
             
+            self.log_buffer.resize(config["log_retention"])
+            if self.log_view is not None:
+                self.log_view.mark_dirty()
+            self.apply_polling()
+            
             with open("config.json", "w") as f:
                 json.dump(config, f, indent=4)
             
@@ -1056,16 +1761,42 @@ class ConveyorControlGUI:
             with open("config.json", "r") as f:
                 config = json.load(f)
             
-            self.ip_entry.delete(0, tk.END)
-            self.ip_entry.insert(0, config.get("tcp_host", "192.168.4.1"))
+            # Líneas: se actualizan las existentes y se agregan las nuevas
+            lines = config.get("lines") or [{"name": next(iter(self.engine.lines)),
+                                             "host": config.get("tcp_host", "192.168.4.1"),
+                                             "port": config.get("tcp_port", 8080)}]
+            for entry in lines:
+                host = entry.get("host", "192.168.4.1")
+                port = int(entry.get("port", 8080))
+                line = self.engine.lines.get(entry["name"])
+                if line is None:
+                    self.engine.add_line(entry["name"], host, port)
+                elif not line.connected:
+                    line.host = host
+                    line.port = port
             
-            self.port_entry.delete(0, tk.END)
-            self.port_entry.insert(0, str(config.get("tcp_port", 8080)))
+            self.select_view(self.view_name)
             
-            self.interval_entry.delete(0, tk.END)
-            self.interval_entry.insert(0, str(config.get("update_interval", "1000")))
+            self.interval_var.set(str(config.get("update_interval", "1000")))
             
             self.auto_update_var.set(config.get("auto_update", True))
+            self.apply_polling()
+            
+            self.binary_var.set(config.get("binary_protocol", False))
+            self.toggle_binary_protocol()
+            self.push_var.set(config.get("push_updates", False))
+            self.toggle_push_updates()
+            self.delta_var.set(config.get("delta_sync", False))
+            self.toggle_delta_sync()
+            
+            retention = int(config.get("log_retention", LOG_RETENTION))
+            self.retention_var.set(str(retention))
+            self.log_buffer.resize(retention)
+            if self.log_view is not None:
+                self.log_view.mark_dirty()
+            
+            self.log_compress_var.set(config.get("log_compress", True))
+            self.toggle_log_compress()
             
             self.log_event("Sistema", "Configuración restaurada")
             messagebox.showinfo("Éxito", "Configuración restaurada")
@@ -1076,8 +1807,14 @@ class ConveyorControlGUI:
             self.log_event("Errores", f"Error restaurando configuración: {str(e)}")
     
     def on_closing(self):
-        if self.connected:
-            self.disconnect_from_esp32()
+        self.cancel_export()
+        self.engine.shutdown()
+        if self.store is not None:
+            self.store.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.log_sink is not None:
+            self.log_sink.close()
         self.root.destroy()
 
 def main():
@@ -1085,30 +1822,6 @@ def main():
     app = ConveyorControlGUI(root)
     
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
-    
-    menubar = tk.Menu(root, bg="#F8DAEB", fg="#C33B80")
-    root.config(menu=menubar)
-    
-    file_menu = tk.Menu(menubar, tearoff=0, bg="#F8DAEB", fg="#C33B80")
-    menubar.add_cascade(label="Archivo", menu=file_menu)
-    file_menu.add_command(label="Exportar Logs", command=app.export_logs)
-    file_menu.add_command(label="Exportar Datos de Conteo", command=app.export_count_data)
-    file_menu.add_command(label="Guardar Configuración", command=app.save_config)
-    file_menu.add_separator()
-    file_menu.add_command(label="Salir", command=app.on_closing)
-    
-    system_menu = tk.Menu(menubar, tearoff=0, bg="#F8DAEB", fg="#C33B80")
-    menubar.add_cascade(label="Sistema", menu=system_menu)
-    system_menu.add_command(label="Conectar ESP32", command=app.connect_to_esp32)
-    system_menu.add_command(label="Desconectar ESP32", command=app.disconnect_from_esp32)
-    system_menu.add_separator()
-    system_menu.add_command(label="Iniciar Sistema", command=app.start_system)
-    system_menu.add_command(label="Detener Sistema", command=app.stop_system)
-    system_menu.add_command(label="Resetear Contadores", command=app.reset_counters)
-    system_menu.add_separator()
-    system_menu.add_command(label="Actualizar Datos", command=app.request_data)
-    system_menu.add_command(label="Obtener Estado", command=app.get_status)
-    
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+"""Almacenamiento persistente de eventos del sistema de cinta transportadora
+
+Guarda en SQLite (modo WAL) los conteos, detecciones, alarmas y cambios de estado que
+publica el motor, para que el historial sobreviva a un cierre inesperado de la GUI o del
+servicio. Las inserciones se hacen en un hilo propio, agrupadas por transacción.
+"""
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+STORE_FILENAME = "conveyor_events.db"
+STORE_BATCH_ROWS = 2000  # Máximo de eventos por transacción
+STORE_FLUSH_S = 0.5  # Espera máxima de un evento antes de confirmarse (como mucho se pierde un lote)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    line TEXT,
+    kind TEXT NOT NULL,
+    color TEXT,
+    total INTEGER,
+    data TEXT,
+    n INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS events_kind_ts ON events (kind, ts);
+"""
+
+INSERT = "INSERT INTO events (ts, line, kind, color, total, data, n) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+class EventStore:
+    """Registro de eventos en SQLite alimentado por el bus del motor
+    
+    record() solo encola y se puede llamar desde cualquier hilo; el escritor confirma
+    los eventos en lotes. Las consultas abren su propia conexión de lectura.
+    """
+    
+    def __init__(self, path=STORE_FILENAME):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.error = None  # Último error del escritor
+        self.written = 0
+        self._status = {}  # línea → último estado registrado
+        self._engine = None
+        self._callback = None
+        
+        # El esquema se crea antes de arrancar el escritor para que los errores lleguen al llamador
+        conn = self._open()
+        conn.executescript(SCHEMA)
+        conn.close()
+        
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+    
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    # ---------- Escritura ----------
+    
+    def record(self, kind, line=None, color=None, total=None, data=None, ts=None, n=1):
+        self.queue.put((ts or time.time(), line, kind, color, total,
+                        None if data is None else json.dumps(data, ensure_ascii=False), n))
+    
+    def attach(self, engine):
+        """Se suscribe al bus del motor; los eventos se reciben en el hilo del motor"""
+        self._engine = engine
+        self._callback = engine.bus.subscribe(self._on_event)
+    
+    def _on_event(self, event):
+        kind, name, data = event
+        if kind == "count":
+            # Un evento por caja, o por las cajas de un color recuperadas tras un corte
+            color, counts, n = data
+            self.record("count", name, color, counts[4], counts, n=n)
+        elif kind == "detection":
+            line = self._engine.lines.get(name)
+            self.record("detection", name, total=line.detection_count if line else None)
+        elif kind == "alarm":
+            self.record("alarm", name, data=data.strip())
+        elif kind == "connection":
+            state, message = data
+            self.record("connection", name, data={"state": state, "message": message})
+        elif kind == "status":
+            # Solo se registran las transiciones, no cada mensaje de estado
+            line = self._engine.lines.get(name)
+            if line is None:
+                return
+            status = {"running": line.system_running, "stm32": line.stm32_connected,
+                      "esp_status": line.esp_status}
+            if self._status.get(name) != status:
+                self._status[name] = status
+                self.record("status", name, data=status)
+    
+    def _writer(self):
+        conn = self._open()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + STORE_FLUSH_S
+            while len(batch) < STORE_BATCH_ROWS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # None indica cierre: se confirma lo pendiente y se termina
+            if None in batch:
+                running = False
+                batch = [row for row in batch if row is not None]
+            
+            try:
+                with conn:
+                    conn.executemany(INSERT, batch)
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                self.error = str(e)
+        conn.close()
+    
+    def close(self):
+        if self._engine is not None:
+            self._engine.bus.unsubscribe(self._callback)
+            self._engine = None
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+    
+    # ---------- Consultas ----------
+    
+    def query(self, start=None, end=None, kind=None, line=None, limit=None):
+        """Eventos en el rango [start, end) ordenados por tiempo: (ts, línea, tipo, color, n, total, datos)
+        
+        n es el número de cajas del evento: más de una en los conteos recuperados tras un corte.
+        """
+        where = []
+        params = []
+        if kind is not None:
+            where.append("kind = ?")
+            params.append(kind)
+        if start is not None:
+            where.append("ts >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("ts < ?")
+            params.append(end)
+        if line is not None:
+            where.append("line = ?")
+            params.append(line)
+        
+        sql = "SELECT ts, line, kind, color, n, total, data FROM events"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            return [(ts, name, kind, color, n, total, None if data is None else json.loads(data))
+                    for ts, name, kind, color, n, total, data in conn.execute(sql, params)]
+        finally:
+            conn.close()
+    
+    def count_totals(self, start=None, end=None, line=None):
+        """Cajas contadas por color en el rango [start, end)"""
+        sql = "SELECT color, SUM(n) FROM events WHERE kind = 'count' AND ts >= ? AND ts < ?"
+        params = [start if start is not None else 0, end if end is not None else float("inf")]
+        if line is not None:
+            sql += " AND line = ?"
+            params.append(line)
+        sql += " GROUP BY color"
+        
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            return dict(conn.execute(sql, params))
+        finally:
+            conn.close()
@@ -0,0 +1,322 @@
+"""Simulador local de la ESP32 de la cinta y generador de carga
+
+Habla el mismo protocolo que el firmware (mensajes JSON init/update/data/status/ok/alert/
+error y líneas DETECTADO / Color:) y responde a START, STOP, RESET_COUNTERS, GET_DATA,
+GET_STATUS y PING_STM32, además de SUBSCRIBE, SYNC DELTA y PROTO BIN1. Permite probar la
+GUI y el servicio sin la cinta física:
+
+    python esp32_simulator.py --rate 20 --autostart
+    python esp32_simulator.py --lines 3 --rate 20000 --burst 5,5 --drop-every 30 --malformed 0.01
+    python esp32_simulator.py --rate 200 --autostart --lose-events 0.001
+
+y luego conectar la GUI a 127.0.0.1:8080 (y 8081, 8082... con --lines).
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from conveyor_core import (
+    BINARY_HELLO, BINARY_MODE, COLOR_FRAME, COUNT_COLORS, DATA_FRAME, DELTA_FRAME, DELTA_SYNC_COMMAND,
+    FRAME_COLOR, FRAME_DATA, FRAME_DELTA, FRAME_DETECTION, FRAME_HEADER, FRAME_SNAPSHOT, FRAME_STATUS,
+    FRAME_TEXT, FRAME_UPDATE, NO_COLOR_CODE, SNAPSHOT_FRAME, STATUS_FRAME, SUBSCRIBE_COMMAND, UPDATE_FRAME,
+)
+
+TICK_S = 0.01  # Período del generador de eventos
+STATS_INTERVAL_S = 5
+
+# Líneas corruptas o incompletas que se intercalan con --malformed
+MALFORMED_LINES = (
+    b'{"type": "update", "red": ',
+    b'{"type":"data","red":"x","total":null}',
+    b"Color:",
+    b"\xff\xfe\x00basura",
+    b"}{",
+)
+
+class SimulatedClient:
+    """Conexión de la GUI con el simulador"""
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.binary = False
+        self.subscribed = False
+        self.delta = False  # Eventos numerados en lugar de DETECTADO/Color y updates de conteo
+    
+    def send_json(self, message):
+        data = json.dumps(message).encode("utf-8")
+        if self.binary:
+            self.writer.write(FRAME_HEADER.pack(len(data), FRAME_TEXT) + data)
+        else:
+            self.writer.write(data + b"\n")
+    
+    def send_frame(self, frame_type, payload=b""):
+        self.writer.write(FRAME_HEADER.pack(len(payload), frame_type) + payload)
+
+class SimulatedESP32:
+    """Estado de una ESP32 (contadores, cinta, STM32) con sus clientes conectados"""
+    
+    def __init__(self, port, args):
+        self.port = port
+        self.args = args
+        self.clients = []
+        self.running = args.autostart
+        self.speed = 75
+        self.box_count = {color: 0 for color in COUNT_COLORS}
+        self.total = 0
+        self.detections = 0
+        self.last_color = "NINGUNO"
+        self.sent_events = 0
+        self.seq = 0  # Secuencia de la última detección (sincronización por eventos)
+        self.changed = False
+        self.status_changed = False  # Cambios de marcha, que también reciben los clientes delta
+    
+    # ---------- Mensajes ----------
+    
+    def counts(self):
+        return (self.box_count["ROJO"], self.box_count["VERDE"], self.box_count["AZUL"],
+                self.box_count["OTRO"], self.total, self.detections)
+    
+    def color_code(self):
+        if self.last_color in COUNT_COLORS:
+            return COUNT_COLORS.index(self.last_color)
+        return NO_COLOR_CODE
+    
+    def send_data(self, client):
+        if client.binary and client.delta:
+            client.send_frame(FRAME_SNAPSHOT, SNAPSHOT_FRAME.pack(self.seq, *self.counts(), self.color_code()))
+            return
+        if client.binary:
+            client.send_frame(FRAME_DATA, DATA_FRAME.pack(*self.counts(), self.color_code()))
+            return
+        red, green, blue, other, total, detections = self.counts()
+        message = {"type": "data", "red": red, "green": green, "blue": blue, "other": other,
+                   "total": total, "detections": detections, "color": self.last_color}
+        if client.delta:
+            message["seq"] = self.seq
+        client.send_json(message)
+    
+    def send_update(self, client):
+        status = 1 if self.running else 0
+        if client.binary:
+            client.send_frame(FRAME_UPDATE, UPDATE_FRAME.pack(*self.counts(), status, self.speed, self.color_code()))
+            return
+        red, green, blue, other, total, detections = self.counts()
+        message = {"type": "update", "red": red, "green": green, "blue": blue, "other": other,
+                   "total": total, "detections": detections, "status": status,
+                   "speed": self.speed, "last_color": self.last_color}
+        if client.delta:
+            message["seq"] = self.seq
+        client.send_json(message)
+    
+    def send_status(self, client):
+        if client.binary:
+            client.send_frame(FRAME_STATUS, STATUS_FRAME.pack(1, self.speed, self.detections))
+            return
+        client.send_json({"type": "status", "stm32": 1, "speed": self.speed, "detections": self.detections})
+    
+    def handle_command(self, client, command):
+        if command == "GET_DATA":
+            self.send_data(client)
+        elif command == "GET_STATUS":
+            self.send_status(client)
+        elif command == "START":
+            self.running = True
+            self.changed = True
+            self.status_changed = True
+            client.send_json({"type": "ok", "cmd": "start"})
+        elif command == "STOP":
+            self.running = False
+            self.changed = True
+            self.status_changed = True
+            client.send_json({"type": "ok", "cmd": "stop"})
+        elif command == "RESET_COUNTERS":
+            self.reset()
+            client.send_json({"type": "ok", "cmd": "reset"})
+        elif command == "PING_STM32":
+            client.send_json({"type": "ping_sent"})
+        elif command == SUBSCRIBE_COMMAND and not self.args.no_push:
+            client.subscribed = True
+            client.send_json({"type": "ok", "cmd": "subscribe"})
+        elif command == DELTA_SYNC_COMMAND and not self.args.no_delta:
+            # Confirmación y snapshot base; desde ahí solo eventos numerados
+            client.send_json({"type": "ok", "cmd": "delta"})
+            client.delta = True
+            self.send_data(client)
+        elif command == BINARY_HELLO and not self.args.no_binary:
+            # La respuesta va en texto; lo que sigue ya son tramas
+            client.send_json({"type": "proto", "mode": BINARY_MODE})
+            client.binary = True
+        else:
+            client.send_json({"type": "error", "msg": f"Comando desconocido: {command}"})
+    
+    def reset(self):
+        for color in self.box_count:
+            self.box_count[color] = 0
+        self.total = 0
+        self.detections = 0
+        self.last_color = "NINGUNO"
+        self.changed = True
+    
+    # ---------- Servidor ----------
+    
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_client, self.args.host, self.port)
+        print(f"ESP32 simulada en {self.args.host}:{self.port}", flush=True)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.generate(), self.disturb())
+    
+    async def handle_client(self, reader, writer):
+        client = SimulatedClient(writer)
+        self.clients.append(client)
+        client.send_json({"type": "init", "stm32": 1, "speed": self.speed,
+                          "status": 1 if self.running else 0, "detections": self.detections})
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode("utf-8", "ignore").strip()
+                if command:
+                    self.handle_command(client, command)
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if client in self.clients:
+                self.clients.remove(client)
+            writer.close()
+    
+    async def generate(self):
+        """Genera cajas a la tasa configurada (con ráfagas) y las envía a todos los clientes"""
+        args = self.args
+        pending = 0.0
+        start = last = time.monotonic()
+        while True:
+            await asyncio.sleep(TICK_S)
+            now = time.monotonic()
+            elapsed, last = now - last, now
+            if self.running and self.in_burst(now - start):
+                pending += args.rate * elapsed
+                boxes = int(pending)
+                pending -= boxes
+                if boxes:
+                    self.emit(boxes)
+            else:
+                pending = 0.0
+            
+            for client in list(self.clients):
+                if client.subscribed and (self.status_changed if client.delta else self.changed):
+                    self.send_update(client)
+                try:
+                    await client.writer.drain()
+                except ConnectionError:
+                    pass
+            self.changed = False
+            self.status_changed = False
+    
+    def in_burst(self, elapsed):
+        if not self.args.burst:
+            return True
+        on, off = self.args.burst
+        return elapsed % (on + off) < on
+    
+    def emit(self, boxes):
+        """Cuenta boxes cajas y envía sus eventos en un solo bloque por cliente"""
+        text = []
+        frames = []
+        delta_text = []
+        delta_frames = []
+        for _ in range(boxes):
+            color = random.choice(COUNT_COLORS)
+            self.box_count[color] += 1
+            self.total += 1
+            self.detections += 1
+            self.seq += 1
+            self.last_color = color
+            text.append(f"DETECTADO\nColor: {color}\n".encode("utf-8"))
+            frames.append(FRAME_HEADER.pack(0, FRAME_DETECTION) + FRAME_HEADER.pack(COLOR_FRAME.size, FRAME_COLOR)
+                          + COLOR_FRAME.pack(COUNT_COLORS.index(color)))
+            # Evento perdido: el número se consume igual y el cliente ve el hueco
+            if not (self.args.lose_events and random.random() < self.args.lose_events):
+                delta_text.append(f'{{"type":"delta","seq":{self.seq},"color":"{color}"}}\n'.encode("utf-8"))
+                delta_frames.append(FRAME_HEADER.pack(DELTA_FRAME.size, FRAME_DELTA)
+                                    + DELTA_FRAME.pack(self.seq, COUNT_COLORS.index(color)))
+            if self.args.malformed and random.random() < self.args.malformed:
+                text.append(random.choice(MALFORMED_LINES) + b"\n")
+        self.sent_events += 2 * boxes
+        self.changed = True
+        
+        streams = {(False, False): b"".join(text), (True, False): b"".join(frames),
+                   (False, True): b"".join(delta_text), (True, True): b"".join(delta_frames)}
+        for client in self.clients:
+            client.writer.write(streams[client.binary, client.delta])
+    
+    async def disturb(self):
+        """Alertas periódicas y cortes de conexión simulados"""
+        args = self.args
+        next_alert = time.monotonic() + args.alert_every if args.alert_every else None
+        next_drop = time.monotonic() + args.drop_every if args.drop_every else None
+        while True:
+            await asyncio.sleep(0.1)
+            now = time.monotonic()
+            if next_alert is not None and now >= next_alert:
+                next_alert = now + args.alert_every
+                for client in self.clients:
+                    client.send_json({"type": "alert", "msg": "Atasco simulado en la cinta"})
+            if next_drop is not None and now >= next_drop:
+                next_drop = now + args.drop_every
+                print(f"[{self.port}] Corte de conexión simulado", flush=True)
+                for client in list(self.clients):
+                    client.writer.transport.abort()
+                if args.reset_on_drop:
+                    self.reset()
+
+async def report(devices):
+    last = {device.port: 0 for device in devices}
+    while True:
+        await asyncio.sleep(STATS_INTERVAL_S)
+        for device in devices:
+            rate = (device.sent_events - last[device.port]) / STATS_INTERVAL_S
+            last[device.port] = device.sent_events
+            print(f"[{device.port}] {rate:.0f} eventos/s, total {device.total} cajas, "
+                  f"{len(device.clients)} clientes", flush=True)
+
+async def run(args):
+    devices = [SimulatedESP32(args.port + i, args) for i in range(args.lines)]
+    await asyncio.gather(report(devices), *(device.serve() for device in devices))
+
+def parse_burst(value):
+    on, _, off = value.partition(",")
+    return (float(on), float(off or on))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulador de ESP32 de la cinta transportadora")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="Puerto de la primera ESP32")
+    parser.add_argument("--lines", type=int, default=1, help="ESP32 simuladas (puertos consecutivos)")
+    parser.add_argument("--rate", type=float, default=5, help="Cajas por segundo con la cinta en marcha")
+    parser.add_argument("--burst", type=parse_burst, metavar="ON,OFF",
+                        help="Ráfagas: segundos generando y segundos en pausa")
+    parser.add_argument("--autostart", action="store_true", help="Arrancar la cinta sin esperar START")
+    parser.add_argument("--malformed", type=float, default=0, help="Probabilidad de línea corrupta por caja")
+    parser.add_argument("--alert-every", type=float, default=0, help="Segundos entre alertas (0: ninguna)")
+    parser.add_argument("--drop-every", type=float, default=0, help="Segundos entre cortes de conexión (0: ninguno)")
+    parser.add_argument("--reset-on-drop", action="store_true", help="Reiniciar los contadores en cada corte")
+    parser.add_argument("--no-push", action="store_true", help="Rechazar SUBSCRIBE como un firmware antiguo")
+    parser.add_argument("--no-binary", action="store_true", help="Rechazar el protocolo binario")
+    parser.add_argument("--no-delta", action="store_true", help="Rechazar la sincronización por eventos")
+    parser.add_argument("--lose-events", type=float, default=0,
+                        help="Probabilidad de perder un evento numerado (provoca huecos en la secuencia)")
+    args = parser.parse_args(argv)
+    
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+"""Suite de benchmarks con cargas mínimas: todos corren y se pueden comparar"""
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import bench_conveyor
+from conveyor_core import CaptureWriter
+
+class BenchSuiteTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.dir.cleanup()
+    
+    def run_main(self, *argv):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(bench_conveyor.main(list(argv)), 0)
+        return out.getvalue()
+    
+    def test_save_and_compare(self):
+        saved = os.path.join(self.dir.name, "base.json")
+        capture = os.path.join(self.dir.name, "planta.cap")
+        writer = CaptureWriter(capture)
+        for i in range(50):
+            writer.line("L", "DETECTADO" if i % 2 else "Color: VERDE")
+        writer.close()
+        
+        self.run_main("--sizes", "300", "--export-rows", "500", "--capture", capture, "--save", saved)
+        with open(saved, encoding="utf-8") as f:
+            results = json.load(f)["results"]
+        self.assertEqual(len(results), len(bench_conveyor.BENCHMARKS) + 2)
+        self.assertIn("reproduccion_captura", {r["benchmark"] for r in results})
+        for r in results:
+            self.assertGreater(r["ops_per_s"], 0, r["benchmark"])
+            self.assertLessEqual(r["p50_us"], r["p99_us"], r["benchmark"])
+        
+        output = self.run_main("--sizes", "300", "--only", "conteo", "--compare", saved)
+        self.assertIn("vs base", output)
+        self.assertRegex(output.splitlines()[-1], r"x$")
+
+if __name__ == "__main__":
+    unittest.main()
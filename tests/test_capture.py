@@ -0,0 +1,88 @@
+"""Grabación del flujo recibido y reproducción por el mismo camino de parseo"""
+
+import os
+import tempfile
+import unittest
+
+from conveyor_core import (
+    COLOR_FRAME, CaptureReader, CaptureWriter, ConveyorEngine, DATA_FRAME, FRAME_COLOR, FRAME_DATA, FRAME_DETECTION,
+)
+
+class CaptureReplayTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "planta.cap")
+        self.engines = []
+    
+    def tearDown(self):
+        for engine in self.engines:
+            engine.shutdown()
+        self.dir.cleanup()
+    
+    def engine(self):
+        engine = ConveyorEngine()
+        self.engines.append(engine)
+        return engine
+    
+    def receive(self, engine):
+        for name in ("Norte", "Sur"):
+            engine.add_line(name, "127.0.0.1", 1)
+        for i in range(30):
+            engine.run_sync(engine.receive_line, "Norte", "DETECTADO")
+            engine.run_sync(engine.receive_line, "Norte", f"Color: {('ROJO', 'VERDE', 'AZUL')[i % 3]}")
+            frame = COLOR_FRAME.pack(i % 4)
+            engine.run_sync(engine.receive_frame, "Sur", FRAME_DETECTION, b"", 0, 0)
+            engine.run_sync(engine.receive_frame, "Sur", FRAME_COLOR, frame, 0, len(frame))
+        frame = bytearray(b"xx" + DATA_FRAME.pack(10, 8, 7, 5, 30, 30, 3))
+        engine.run_sync(engine.receive_frame, "Sur", FRAME_DATA, frame, 2, DATA_FRAME.size)
+    
+    def test_round_trip_gives_same_counts(self):
+        live = self.engine()
+        live.start_capture(self.path)
+        self.receive(live)
+        self.assertEqual(live.stop_capture(), self.path)
+        self.assertIsNone(live.stop_capture())
+        
+        replayed = self.engine()
+        records, _ = replayed.replay(self.path, 0).result(10)
+        self.assertEqual(records, 121)
+        for name in ("Norte", "Sur"):
+            self.assertEqual(replayed.run_sync(replayed.lines[name].counts), live.run_sync(live.lines[name].counts),
+                             name)
+        self.assertEqual(len(replayed.history), len(live.history))
+    
+    def test_interrupted_capture_is_readable(self):
+        writer = CaptureWriter(self.path)
+        writer.line("L", "DETECTADO")
+        writer.line("L", "Color: ROJO")
+        writer.close()
+        with open(self.path, "ab") as f:
+            f.write(b"\x00" * 9)  # Registro a medio escribir
+        
+        reader = CaptureReader(self.path)
+        try:
+            self.assertEqual([(name, kind, bytes(buf[offset:offset + length]))
+                              for _, name, kind, buf, offset, length in reader],
+                             [("L", 0, b"DETECTADO"), ("L", 0, b"Color: ROJO")])
+        finally:
+            reader.close()
+    
+    def test_replay_rejects_connected_line_and_bad_files(self):
+        writer = CaptureWriter(self.path)
+        writer.line("L", "DETECTADO")
+        writer.close()
+        engine = self.engine()
+        engine.add_line("L", "127.0.0.1", 1)
+        engine.run_sync(setattr, engine.lines["L"], "connected", True)
+        with self.assertRaises(ValueError):
+            engine.replay(self.path, 0).result(10)
+        
+        other = os.path.join(self.dir.name, "otro.cap")
+        with open(other, "wb") as f:
+            f.write(b"no es una captura de la cinta")
+        with self.assertRaises(ValueError):
+            CaptureReader(other)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,393 @@
+"""Motor sin interfaz: líneas, decodificador, sincronización y solicitudes"""
+
+import json
+import socket
+import unittest
+
+from conveyor_core import (
+    Connection, ConveyorEngine, DATA_FRAME, FRAME_DATA, FRAME_STATUS, FRAME_TEXT, LineState, NO_COLOR_CODE, PLANT_VIEW, POLL_IDLE_MS, POLL_MIN_MS,
+    REQUEST_TIMEOUT_S, STATUS_FRAME,
+)
+
+class EngineTestCase(unittest.TestCase):
+    """Motor con líneas marcadas como conectadas; todo corre en el hilo del loop
+    
+    Cada línea tiene una conexión sin escritor: lo enviado queda en su cola.
+    """
+    
+    LINES = ("L",)
+    
+    def setUp(self):
+        self.engine = ConveyorEngine()
+        for name in self.LINES:
+            self.engine.add_line(name, "127.0.0.1", 1)
+        self.line = self.engine.lines[self.LINES[0]]
+        self.events = []
+        self.engine.bus.subscribe(self.events.append)
+        self.run_sync(self._connect)
+    
+    def tearDown(self):
+        self.engine.shutdown()
+    
+    def _connect(self):
+        for line in self.engine.lines.values():
+            line.connected = True
+            line.wanted = True
+            self.engine.transport.connections[line.name] = Connection(socket.socket(), None, None)
+    
+    def run_sync(self, fn, *args):
+        return self.engine.run_sync(fn, *args)
+    
+    def send(self, message, name="L"):
+        if not isinstance(message, str):
+            message = json.dumps(message)
+        self.run_sync(self.engine.handle_line, name, message)
+    
+    def frame(self, frame_type, payload, name="L"):
+        buf = bytearray(b"..." + payload)  # Desplazado: se decodifica en su sitio del buffer
+        self.run_sync(self.engine.handle_frame, name, frame_type, buf, 3, len(payload))
+    
+    def outbox(self, name="L"):
+        return list(self.engine.transport.connections[name].outbox)
+    
+    def urgent(self, name="L"):
+        return list(self.engine.transport.connections[name].urgent)
+    
+    def flush(self, name="L"):
+        """Lo que haría el escritor: enviar todo lo encolado"""
+        conn = self.engine.transport.connections[name]
+        sent = list(conn.urgent) + list(conn.outbox)
+        self.run_sync(conn.urgent.clear)
+        self.run_sync(conn.outbox.clear)
+        self.run_sync(conn.queued.clear)
+        return sent
+    
+    def command(self, command, name="L"):
+        self.run_sync(self.engine._send_command, command, [name])
+    
+    def counter(self, name, label):
+        return self.engine.metrics.counters.get((name, label), 0)
+    
+    def logs(self, category=None):
+        return [event.data[1] for event in self.events
+                if event.kind == "log" and category in (None, event.data[0])]
+
+class MultiLineTest(EngineTestCase):
+    
+    LINES = ("A", "B")
+    
+    def test_messages_count_on_their_line(self):
+        self.send("Color: ROJO", "A")
+        self.send({"type": "data", "red": 2, "green": 5, "blue": 0, "other": 0, "total": 7, "detections": 9,
+                   "color": "VERDE"}, "B")
+        
+        a, b = self.engine.lines["A"], self.engine.lines["B"]
+        self.assertEqual(a.counts(), (1, 0, 0, 0, 1, 0))
+        self.assertEqual(b.counts(), (2, 5, 0, 0, 7, 9))
+        self.assertEqual({(event.kind, event.line) for event in self.events if event.kind == "count"},
+                         {("count", "A")})
+        self.assertEqual([row[-1] for row in self.engine.history.iter_rows()], ["A"])
+    
+    def test_plant_view_sums_lines(self):
+        self.send("Color: ROJO", "A")
+        self.send("Color: AZUL", "B")
+        self.send({"type": "status", "stm32": 0, "speed": 75, "detections": 4}, "B")
+        
+        plant = self.run_sync(LineState.combine, list(self.engine.lines.values()))
+        self.assertEqual(plant.name, PLANT_VIEW)
+        self.assertEqual(plant.counts(), (1, 0, 1, 0, 2, 4))
+        self.assertFalse(plant.stm32_connected)
+        summary, per_line = self.engine.summaries()
+        self.assertEqual(summary["TOTAL"], 2)
+        self.assertEqual([name for name, _ in per_line], ["A", "B"])
+    
+    def test_logs_name_the_line(self):
+        self.send("Color: VERDE", "B")
+        self.assertIn("B: Color detectado: VERDE", self.logs("Detecciones"))
+    
+    def test_line_names_are_unique(self):
+        with self.assertRaises(ValueError):
+            self.engine.add_line("A")
+        with self.assertRaises(ValueError):
+            self.engine.add_line(PLANT_VIEW)
+        
+        self.engine.remove_line("A")
+        self.assertEqual(list(self.engine.lines), ["B"])
+        self.send("Color: ROJO", "A")  # Mensajes tardíos de una línea quitada se ignoran
+        self.assertEqual(self.engine.lines["B"].total_count, 0)
+
+class DecoderTest(EngineTestCase):
+    
+    def test_invalid_counters_are_dropped(self):
+        base = {"type": "data", "red": 1, "green": 0, "blue": 0, "other": 0, "total": 1, "detections": 1}
+        self.send(base)
+        for field, value in (("red", 2.5), ("total", -1), ("detections", "7")):
+            self.send(dict(base, **{field: value}))
+        
+        self.assertEqual(self.line.counts(), (1, 0, 0, 0, 1, 1))
+        errors = self.logs("Errores")
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(errors[1], "Mensaje 'data' inválido: campo 'total' = -1")
+    
+    def test_text_precedence(self):
+        # Como el protocolo original: DETECTADO se prueba antes que Color:
+        self.send("Color: ROJO DETECTADO")
+        self.assertEqual(self.line.detection_count, 1)
+        self.assertEqual(self.line.total_count, 0)
+        
+        self.send("Sensor >> Color: VERDE: 0.93")
+        self.assertEqual(self.line.box_count["VERDE"], 1)
+        self.send("hola")
+        self.assertIn("Mensaje ESP32: hola", self.logs("Comunicación"))
+        self.assertEqual(self.counter("mensajes", "DETECTADO"), 1)
+        self.assertEqual(self.counter("mensajes", "Color:"), 1)
+        self.assertEqual(self.counter("mensajes", "texto"), 1)
+
+class BinaryFrameTest(EngineTestCase):
+    
+    def test_data_frame_matches_json(self):
+        self.frame(FRAME_DATA, DATA_FRAME.pack(3, 1, 0, 2, 6, 8, 0))
+        self.assertEqual(self.line.counts(), (3, 1, 0, 2, 6, 8))
+        self.assertEqual(self.line.current_color, "ROJO")
+        self.assertEqual(self.counter("tramas", "data"), 1)
+        
+        self.frame(FRAME_DATA, DATA_FRAME.pack(3, 1, 0, 2, 6, 9, NO_COLOR_CODE))
+        self.assertEqual(self.line.detection_count, 9)
+        self.assertEqual(self.line.current_color, "NINGUNO")
+    
+    def test_status_frame_goes_through_json_handler(self):
+        self.run_sync(self.engine._send_command, "GET_STATUS", ["L"])
+        self.assertEqual(len(self.line.requests), 1)
+        
+        self.frame(FRAME_STATUS, STATUS_FRAME.pack(1, 60, 12))
+        self.assertTrue(self.line.stm32_connected)
+        self.assertEqual(self.line.conveyor_speed, 60)
+        self.assertEqual(self.line.detection_count, 12)
+        # La trama responde a la consulta igual que su JSON
+        self.assertFalse(self.line.requests)
+        self.assertEqual(len(self.line.rtt), 1)
+        
+        # Con eventos numerados las detecciones no se pisan con las del estado
+        self.line.delta = True
+        self.frame(FRAME_STATUS, STATUS_FRAME.pack(1, 60, 40))
+        self.assertEqual(self.line.detection_count, 12)
+    
+    def test_text_and_invalid_frames(self):
+        self.frame(FRAME_TEXT, b"Color: AZUL\n")
+        self.assertEqual(self.line.box_count["AZUL"], 1)
+        
+        self.frame(FRAME_DATA, b"\x01\x02")
+        self.assertTrue(any(message.startswith("Trama binaria inválida (tipo 2)") for message in self.logs("Errores")))
+        self.frame(0x42, b"")
+        self.assertIn("Trama binaria desconocida: tipo 66", self.logs("Comunicación"))
+
+class PollingTest(EngineTestCase):
+    
+    def test_subscription_stops_polling(self):
+        self.run_sync(self.engine._set_polling, 1000)
+        self.assertIn("L", self.engine._poll_handles)
+        self.run_sync(self.engine._poll, "L")
+        self.assertEqual(self.outbox(), [b"GET_DATA\n"])
+        
+        self.send({"type": "ok", "cmd": "subscribe"})
+        self.assertTrue(self.line.push)
+        self.assertNotIn("L", self.engine._poll_handles)
+        self.run_sync(self.engine._poll, "L")  # Una consulta ya disparada no vuelve a programarse
+        self.assertEqual(self.outbox(), [b"GET_DATA\n"])
+        self.assertNotIn("L", self.engine._poll_handles)
+    
+    def test_interval_adapts_to_activity(self):
+        line = LineState("L")
+        line.poll_ms = 1000
+        line.system_running = True
+        self.assertEqual(ConveyorEngine.next_poll_interval(line), 2000)  # Primera marca: sin cambios
+        
+        line.total_count += 1
+        self.assertEqual(ConveyorEngine.next_poll_interval(line), 500)
+        line.poll_ms = 150
+        line.detection_count += 1
+        self.assertEqual(ConveyorEngine.next_poll_interval(line), POLL_MIN_MS)
+        
+        line.poll_ms = POLL_IDLE_MS
+        self.assertEqual(ConveyorEngine.next_poll_interval(line), POLL_IDLE_MS)
+        line.system_running = False
+        line.poll_ms = 200
+        self.assertEqual(ConveyorEngine.next_poll_interval(line), POLL_IDLE_MS)
+
+class ReconnectTest(EngineTestCase):
+    
+    def count_boxes(self, color, n):
+        for _ in range(n):
+            self.engine.process_detection(self.line)
+            self.engine.accumulate_count(self.line, color)
+    
+    def drop_and_reconnect(self):
+        self.engine._connection_lost("L", None)
+        self.engine._cancel_reconnect(self.line)
+        self.line.connected = True
+    
+    def test_device_reset_keeps_local_counts(self):
+        self.run_sync(self.count_boxes, "ROJO", 1000)
+        self.run_sync(self.drop_and_reconnect)
+        
+        # La ESP32 reinició: init y status no deben pisar las detecciones antes de conciliar
+        self.send({"type": "init", "stm32": 1, "speed": 75, "status": 1, "detections": 3})
+        self.send({"type": "status", "stm32": 1, "speed": 75, "detections": 3})
+        self.assertEqual(self.line.counts(), (1000, 0, 0, 0, 1000, 1000))
+        
+        self.send({"type": "data", "red": 3, "green": 0, "blue": 0, "other": 0, "total": 3, "detections": 3,
+                   "color": "ROJO"})
+        self.assertEqual(self.line.counts(), (1003, 0, 0, 0, 1003, 1003))
+        self.assertEqual(self.line.count_offset, (1000, 0, 0, 0, 1000, 1000))
+        
+        self.send({"type": "status", "stm32": 1, "speed": 75, "detections": 4})
+        self.assertEqual(self.line.detection_count, 1004)
+    
+    def test_recovered_boxes_carry_their_number(self):
+        self.run_sync(self.count_boxes, "ROJO", 1)
+        self.run_sync(self.drop_and_reconnect)
+        self.send({"type": "data", "red": 51, "green": 0, "blue": 0, "other": 0, "total": 51, "detections": 51,
+                   "color": "ROJO"})
+        
+        counts = [event.data for event in self.events if event.kind == "count"]
+        self.assertEqual([(color, n) for color, _, n in counts], [("ROJO", 1), ("ROJO", 50)])
+        self.assertEqual(counts[-1][1][4], 51)
+        self.assertEqual(len(self.engine.history), 2)
+
+class CommandQueueTest(EngineTestCase):
+    
+    def test_queries_are_coalesced(self):
+        for _ in range(3):
+            self.command("GET_DATA")
+        self.assertEqual(self.outbox(), [b"GET_DATA\n"])
+        self.assertEqual(len(self.line.requests), 1)
+        self.assertEqual(self.counter("comandos_coalescidos", "GET_DATA"), 2)
+        
+        # Mientras espera respuesta tampoco se repite, aunque ya haya salido
+        self.flush()
+        self.command("GET_DATA")
+        self.assertEqual(self.outbox(), [])
+    
+    def test_stop_supersedes_queued_start(self):
+        self.command("GET_DATA")
+        self.command("START")
+        self.command("STOP")
+        
+        self.assertEqual(self.outbox(), [b"GET_DATA\n"])
+        self.assertEqual(self.urgent(), [b"STOP\n"])
+        # El START anulado no queda esperando respuesta ni dispara el aviso de timeout
+        self.assertEqual([request.command for request in self.line.requests], ["GET_DATA", "STOP"])
+        self.assertIn("Comando START descartado sin enviar: lo anula STOP", self.logs("Comunicación"))
+        self.assertEqual(self.counter("comandos_anulados", "START"), 1)
+    
+    def test_sent_start_keeps_its_request(self):
+        self.command("START")
+        self.assertEqual(self.flush(), [b"START\n"])
+        self.command("STOP")
+        
+        self.assertEqual([request.command for request in self.line.requests], ["START", "STOP"])
+        self.send({"type": "ok", "cmd": "start"})
+        self.send({"type": "ok", "cmd": "stop"})
+        self.assertFalse(self.line.requests)
+        self.assertFalse(self.line.system_running)
+
+class RequestTest(EngineTestCase):
+    
+    def expire(self, request):
+        self.run_sync(self.engine._request_timeout, "L", request)
+    
+    def test_replies_match_oldest_request(self):
+        self.command("START")
+        self.command("GET_STATUS")
+        first, second = self.line.requests
+        self.assertEqual((first.reply, second.reply), ("ok:start", "status"))
+        self.assertGreater(second.id, first.id)
+        
+        self.send({"type": "status", "stm32": 1, "speed": 75, "detections": 0})
+        self.assertEqual(list(self.line.requests), [first])
+        self.send({"type": "ok", "cmd": "start"})
+        self.assertFalse(self.line.requests)
+        self.assertEqual(len(self.line.rtt), 2)
+        self.assertEqual(self.engine.metrics.histograms["rtt_esp32"].count, 2)
+        self.assertGreater(self.line.rtt_ms(0.99), 0)
+    
+    def test_timeouts_raise_one_alarm_per_streak(self):
+        for _ in range(3):
+            self.command("START")
+        requests = list(self.line.requests)
+        for request in requests:
+            self.expire(request)
+        self.expire(requests[0])  # Ya vencida: no cuenta dos veces
+        
+        self.assertEqual(self.line.unanswered, 3)
+        self.assertEqual(self.counter("comandos_sin_respuesta", "START"), 3)
+        alarms = [event.data for event in self.events if event.kind == "alarm"]
+        self.assertEqual(alarms, [f"La ESP32 no respondió a START (#{requests[0].id}) en {REQUEST_TIMEOUT_S:g} s\n"])
+        
+        # La respuesta tardía ya no empareja, pero la siguiente cierra la racha
+        self.command("STOP")
+        self.send({"type": "ok", "cmd": "stop"})
+        self.assertEqual(self.line.unanswered, 0)
+        self.assertIn("El enlace responde de nuevo (3 solicitudes sin respuesta)", self.logs("Comunicación"))
+    
+    def test_resync_snapshot_is_requested_again(self):
+        self.line.sync_pending = True
+        self.command("GET_DATA")
+        self.flush()
+        self.expire(self.line.requests[0])
+        self.assertEqual(self.outbox(), [b"GET_DATA\n"])
+        self.assertEqual([request.command for request in self.line.requests], ["GET_DATA"])
+        
+        self.run_sync(self.engine._clear_requests, self.line)
+        self.assertFalse(self.line.requests)
+
+class DeltaSyncTest(EngineTestCase):
+    
+    def setUp(self):
+        super().setUp()
+        self.send({"type": "ok", "cmd": "delta"})
+        self.send({"type": "data", "red": 1, "green": 2, "blue": 3, "other": 4, "total": 10, "detections": 10,
+                   "color": "ROJO", "seq": 100})
+    
+    def delta(self, seq, color):
+        self.send({"type": "delta", "seq": seq, "color": color})
+    
+    def test_consecutive_event_counts_once(self):
+        self.assertTrue(self.line.delta)
+        self.assertEqual(self.line.seq, 100)
+        self.delta(101, "AZUL")
+        self.delta(101, "AZUL")
+        
+        self.assertEqual(self.line.counts(), (1, 2, 4, 4, 11, 11))
+        self.assertEqual(self.line.seq, 101)
+        self.assertEqual(self.counter("sincronizacion", "repetido"), 1)
+    
+    def test_gap_waits_for_snapshot(self):
+        self.delta(103, "ROJO")
+        self.assertTrue(self.line.sync_pending)
+        self.assertEqual(self.counter("sincronizacion", "hueco"), 1)
+        self.assertEqual(self.flush()[-1], b"GET_DATA\n")
+        
+        # Hasta el snapshot los eventos se ignoran: ya vendrán incluidos en él
+        self.delta(104, "ROJO")
+        self.assertEqual(self.line.total_count, 10)
+        
+        self.send({"type": "data", "red": 3, "green": 2, "blue": 3, "other": 4, "total": 12, "detections": 12,
+                   "color": "ROJO", "seq": 104})
+        self.assertFalse(self.line.sync_pending)
+        self.assertEqual(self.line.counts(), (3, 2, 3, 4, 12, 12))
+        self.assertEqual(self.counter("sincronizacion", "resincronizado"), 1)
+        self.delta(105, "VERDE")
+        self.assertEqual(self.line.counts(), (3, 3, 3, 4, 13, 13))
+    
+    def test_stale_snapshot_is_rejected(self):
+        self.delta(101, "AZUL")
+        self.send({"type": "data", "red": 1, "green": 2, "blue": 3, "other": 4, "total": 10, "detections": 10,
+                   "color": "ROJO", "seq": 100})
+        
+        self.assertEqual(self.line.total_count, 11)
+        self.assertEqual(self.line.seq, 101)
+        self.assertEqual(self.counter("sincronizacion", "obsoleto"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,237 @@
+"""Partes de la GUI que no necesitan una ventana: despacho por cuadros, dibujado y cola de ingesta"""
+
+import time
+import unittest
+from types import SimpleNamespace
+
+try:
+    import conveyor_gui as gui
+except ImportError:  # Sin Tkinter no se puede importar la GUI
+    gui = None
+
+from conveyor_core import Event, LogRecord, Metrics
+
+class FakeRoot:
+    """Registra los after() en lugar de programarlos"""
+    
+    def __init__(self):
+        self.scheduled = []
+    
+    def after(self, ms, callback, *args):
+        self.scheduled.append((ms, callback))
+
+class FakeWidget:
+    """Registra las configuraciones que llegarían a Tk"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+    
+    def __str__(self):
+        return self.name
+    
+    def config(self, **options):
+        self.calls.append((None, options))
+    
+    def itemconfig(self, item, **options):
+        self.calls.append((item, options))
+
+@unittest.skipIf(gui is None, "requiere tkinter")
+class FrameDispatchTest(unittest.TestCase):
+    
+    def setUp(self):
+        metrics = Metrics()
+        self.handled = []
+        self.renders = 0
+        self.app = SimpleNamespace(data_queue=gui.IngestQueue(metrics), metrics=metrics, root=FakeRoot(),
+                                   dirty=set(), log_view=None, handle_event=self.handle_event, render=self.render)
+        self.app.process_received_data = self.dispatch
+        self.cost = 0.0
+    
+    def handle_event(self, event, repeats=1):
+        self.handled.append(event)
+        self.app.dirty.add("counts")
+        if self.cost:
+            end = time.perf_counter() + self.cost
+            while time.perf_counter() < end:
+                pass
+    
+    def render(self):
+        self.renders += 1
+        self.app.dirty.clear()
+    
+    def dispatch(self):
+        gui.ConveyorControlGUI.process_received_data(self.app)
+    
+    def test_batch_renders_once(self):
+        for i in range(100):
+            self.app.data_queue.put(Event("info", "L", f"{i}\n"))
+        self.dispatch()
+        
+        self.assertEqual(len(self.handled), 100)
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(self.app.root.scheduled, [(gui.FRAME_INTERVAL_MS, self.dispatch)])
+    
+    def test_budget_leaves_rest_for_next_frame(self):
+        # Cada evento cuesta 1 ms: el reloj se consulta cada FRAME_CLOCK_CHECK eventos
+        self.cost = 0.001
+        for i in range(3 * gui.FRAME_CLOCK_CHECK):
+            self.app.data_queue.put(Event("info", "L", f"{i}\n"))
+        self.dispatch()
+        
+        self.assertEqual(len(self.handled), gui.FRAME_CLOCK_CHECK)
+        self.assertEqual(self.app.data_queue.qsize(), 2 * gui.FRAME_CLOCK_CHECK)
+        self.assertEqual(self.renders, 1)
+        
+        self.dispatch()
+        self.assertEqual(len(self.handled), 2 * gui.FRAME_CLOCK_CHECK)
+        self.assertEqual(self.app.metrics.histograms["despacho"].count, 2)
+    
+    def test_idle_frame_does_not_render(self):
+        self.dispatch()
+        self.assertEqual(self.renders, 0)
+        self.assertEqual(len(self.app.root.scheduled), 1)
+
+@unittest.skipIf(gui is None, "requiere tkinter")
+class RendererTest(unittest.TestCase):
+    
+    def test_only_changes_reach_tk(self):
+        renderer = gui.WidgetRenderer()
+        label = FakeWidget(".contador")
+        renderer.config(label, text="0", fg="#C33B80")
+        renderer.config(label, text="0", fg="#C33B80")
+        renderer.config(label, text="1", fg="#C33B80")
+        renderer.config(None, text="1")  # Widget aún sin construir (pestaña diferida)
+        
+        self.assertEqual(label.calls, [(None, {"text": "0", "fg": "#C33B80"}), (None, {"text": "1"})])
+        self.assertEqual(renderer.calls, 2)
+    
+    def test_canvas_items_are_tracked_apart(self):
+        renderer = gui.WidgetRenderer()
+        canvas = FakeWidget(".leds")
+        for _ in range(2):
+            renderer.itemconfig(canvas, 1, fill="red")
+            renderer.itemconfig(canvas, 2, fill="red")
+        renderer.config(canvas, bg="red")
+        self.assertEqual(canvas.calls, [(1, {"fill": "red"}), (2, {"fill": "red"}), (None, {"bg": "red"})])
+    
+    def test_render_updates_only_dirty_sections(self):
+        updated = []
+        app = SimpleNamespace(dirty={"detection"}, view=lambda: None)
+        for method in ("update_connection_widgets", "update_stm32_indicator", "update_system_buttons",
+                       "update_status_leds", "update_counters", "update_color_display"):
+            setattr(app, method, lambda *args, method=method: updated.append(method))
+        app._update_realtime_display = lambda: updated.append("realtime")
+        app.update_detection_indicator = lambda: updated.append("detection")
+        
+        gui.ConveyorControlGUI.render(app)
+        self.assertEqual(updated, ["detection"])
+        self.assertEqual(app.dirty, set())
+        gui.ConveyorControlGUI.render(app)
+        self.assertEqual(updated, ["detection"])
+
+@unittest.skipIf(gui is None, "requiere tkinter")
+class LazyTabTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.built = []
+        self.refreshes = 0
+        self.selected = ".logs"
+        self.app = SimpleNamespace(tab_control=SimpleNamespace(select=lambda: self.selected), log_view=None,
+                                   refresh_view=self.refresh_view)
+        self.app.tab_builders = {".logs": self.build_logs, ".config": lambda: self.built.append("config")}
+    
+    def build_logs(self):
+        self.built.append("logs")
+        self.app.log_view = SimpleNamespace(dirty=0)
+        self.app.log_view.mark_dirty = lambda: setattr(self.app.log_view, "dirty", self.app.log_view.dirty + 1)
+    
+    def refresh_view(self):
+        self.refreshes += 1
+    
+    def change(self, tab):
+        self.selected = tab
+        gui.ConveyorControlGUI.on_tab_changed(self.app)
+    
+    def test_tabs_are_built_once(self):
+        for tab in (".logs", ".principal", ".logs", ".config", ".logs", ".config"):
+            self.change(tab)
+        
+        self.assertEqual(self.built, ["logs", "config"])
+        self.assertEqual(self.app.tab_builders, {})
+        # Cada pestaña nueva se pone al día con el estado actual una sola vez
+        self.assertEqual(self.refreshes, 2)
+        self.assertEqual(self.app.log_view.dirty, 2)
+
+@unittest.skipIf(gui is None, "requiere tkinter")
+class IngestQueueTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.queue = gui.IngestQueue(Metrics(), max_events=10, hard_max=20)
+    
+    def log(self, category, message, line="L"):
+        self.queue.put(Event("log", line, LogRecord(0.0, category, message)))
+    
+    def drain(self):
+        events = []
+        while self.queue.qsize():
+            _, event, repeats = self.queue.get_nowait()
+            events.append((event, repeats))
+        return events
+    
+    def test_info_is_shed_first(self):
+        for i in range(15):
+            self.queue.put(Event("info", "L", f"{i}\n"))
+        self.log("Errores", "ERROR de lectura")
+        self.log("Sistema", "Fallo: error de escritura")  # Contiene "ERROR": se conserva
+        
+        self.assertEqual(self.queue.dropped, 5)
+        self.assertEqual(self.queue.qsize(), 12)
+    
+    def test_counts_collapse_with_boxes(self):
+        for n in (1, 1, 50):
+            self.queue.put(Event("count", "L", ("ROJO", (), n)))
+        self.queue.put(Event("count", "L", ("AZUL", (), 1)))
+        self.queue.put(Event("counts", "L", None))
+        self.queue.put(Event("counts", "L", None))
+        
+        self.assertEqual([(event.kind, repeats) for event, repeats in self.drain()],
+                         [("count", 52), ("count", 1), ("counts", 2)])
+        self.queue.put(Event("counts", "L", None))  # Ya despachado: entrada nueva
+        self.assertEqual(self.queue.qsize(), 1)
+    
+    def test_alarms_and_errors_collapse_above_hard_max(self):
+        for i in range(20):
+            self.queue.put(Event("connection", f"L{i}", ("lost", "")))
+        for i in range(5):
+            self.queue.put(Event("alarm", "A", f"Atasco {i}\n"))
+            self.log("Errores", f"Error {i}", "A")
+        self.queue.put(Event("alarm", "B", "Atasco B\n"))
+        
+        # Nada importante se descarta: una entrada por tipo y línea con la última y sus repeticiones
+        self.assertEqual(self.queue.dropped, 0)
+        self.assertEqual(self.queue.grouped, 8)
+        self.assertEqual(self.queue.take_merged(), 8)
+        self.assertEqual(self.queue.take_merged(), 0)
+        tail = [(event.kind, event.line, repeats) for event, repeats in self.drain()[20:]]
+        self.assertEqual(tail, [("alarm", "A", 5), ("log", "A", 5), ("alarm", "B", 1)])
+        self.assertEqual(self.queue.pending, {})
+
+@unittest.skipIf(gui is None, "requiere tkinter")
+class GroupedEventTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.alarms = []
+        self.records = []
+        self.app = SimpleNamespace(update_alarm_text=self.alarms.append, show_log_record=self.records.append)
+    
+    def test_repeats_are_shown(self):
+        gui.ConveyorControlGUI.handle_event(self.app, Event("alarm", "A", "Atasco 4\n"), 5)
+        gui.ConveyorControlGUI.handle_event(self.app, Event("log", "A", LogRecord(1.0, "Errores", "Error 4")), 3)
+        
+        self.assertEqual(self.alarms, ["Atasco 4 (y 4 alertas anteriores agrupadas)\n"])
+        self.assertEqual([record.message for record in self.records],
+                         ["Error 4", "(agrupado con 2 mensajes anteriores: cola saturada)"])
+
+if __name__ == "__main__":
+    unittest.main()
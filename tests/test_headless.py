@@ -0,0 +1,67 @@
+"""Servicio sin interfaz: el motor funciona sin Tkinter"""
+
+import glob
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from conveyor_core import CaptureWriter, LogFileSink, LogRecord, parse_line_spec
+
+# Tkinter bloqueado: cualquier import del módulo falla
+HEADLESS_MAIN = "import sys; sys.modules['tkinter'] = None; import conveyor_core; sys.exit(conveyor_core.main(sys.argv[1:]))"
+
+class HeadlessServiceTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.dir.cleanup()
+    
+    def test_replay_and_export_without_tkinter(self):
+        capture = os.path.join(self.dir.name, "cinta.cap")
+        writer = CaptureWriter(capture)
+        for text in ("Color: ROJO", "Color: AZUL", "Color: ROJO"):
+            writer.line("Norte", text)
+        writer.close()
+        
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, "-c", HEADLESS_MAIN, "--replay", capture, "--replay-speed", "0",
+                                 "--store", "", "--metrics-port", "0", "--log-file", "", "--export"],
+                                cwd=self.dir.name, env=dict(os.environ, PYTHONPATH=root),
+                                capture_output=True, text=True, timeout=30)
+        
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("[Detecciones] Color detectado: ROJO", result.stdout)
+        self.assertIn("Reproducción terminada: 3 mensajes", result.stdout)
+        exports = glob.glob(os.path.join(self.dir.name, "conteo_datos_*.csv"))
+        self.assertEqual(len(exports), 1)
+        with open(exports[0], encoding="utf-8") as f:
+            self.assertEqual(len(f.read().splitlines()), 4)
+
+class LogEchoTest(unittest.TestCase):
+    
+    def test_echo_only_sink(self):
+        echo = io.StringIO()
+        sink = LogFileSink(None, echo=echo)
+        now = time.time()
+        for message in ("Conectado", "Sin respuesta", "Sin respuesta", "Sin respuesta", "Desconectado"):
+            sink.record(LogRecord(now, "Sistema", message))
+        sink.close()
+        
+        lines = echo.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].endswith("[Sistema] Sin respuesta"))
+        self.assertEqual(lines[2], "    (mensaje anterior repetido 2 veces más)")
+        self.assertTrue(lines[3].endswith("Desconectado"))
+    
+    def test_parse_line_spec(self):
+        self.assertEqual(parse_line_spec("Norte=10.0.0.5:9000"), ("Norte", "10.0.0.5", 9000))
+        self.assertEqual(parse_line_spec("10.0.0.6"), (None, "10.0.0.6", 8080))
+
+if __name__ == "__main__":
+    unittest.main()
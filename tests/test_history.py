@@ -0,0 +1,108 @@
+"""Historial de conteos en columnas tipadas con volcado a disco"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+from conveyor_core import CountHistory, EXPORT_CHUNK_ROWS, write_count_csv
+
+def fill(history, rows, line="L"):
+    for i in range(rows):
+        history.append(float(i), "ROJO" if i % 2 else "AZUL", (i, 0, i, 0, 2 * i, 2 * i), line)
+
+class SpillTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.history = CountHistory(hot_rows=10, segment_rows=5)
+    
+    def tearDown(self):
+        self.history.close()
+    
+    def test_rows_survive_spill(self):
+        fill(self.history, 32)
+        
+        self.assertEqual(len(self.history.segments), 5)
+        self.assertLess(len(self.history.timestamps), 10)
+        self.assertEqual(len(self.history), 32)
+        rows = list(self.history.iter_rows())
+        self.assertEqual([row[0] for row in rows], [float(i) for i in range(32)])
+        self.assertEqual(rows[7], (7.0, "ROJO", 7, 0, 7, 0, 14, 14, "L"))
+    
+    def test_lines_and_unknown_colors(self):
+        self.history.append(1.0, "VERDE", (0, 1, 0, 0, 1, 1), "Línea 1")
+        self.history.append(2.0, "MORADO", (0, 1, 0, 1, 2, 2), "Línea 2")
+        self.assertEqual([(row[1], row[-1]) for row in self.history.iter_rows()],
+                         [("VERDE", "Línea 1"), ("OTRO", "Línea 2")])
+    
+    def test_clear_removes_segments(self):
+        fill(self.history, 32)
+        paths = [path for path, _ in self.history.segments]
+        self.history.clear()
+        
+        self.assertEqual(len(self.history), 0)
+        self.assertEqual(list(self.history.iter_rows()), [])
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        
+        # Tras vaciarlo se sigue volcando sin reutilizar nombres de segmento
+        fill(self.history, 12)
+        self.assertTrue(set(path for path, _ in self.history.segments).isdisjoint(paths))
+        self.assertEqual(len(list(self.history.iter_rows())), 12)
+    
+    def test_invalid_row_leaves_columns_aligned(self):
+        fill(self.history, 3)
+        for counts, error in (((1, 2, 3, 4, 5, 6.5), TypeError), ((1, 2, 3, 4, 5, -6), OverflowError),
+                              ((1, 2, 3), ValueError)):
+            with self.assertRaises(error):
+                self.history.append(9.0, "ROJO", counts, "L")
+        
+        self.assertEqual(len(self.history), 3)
+        self.assertEqual({len(column) for column in self.history.counts}, {3})
+        self.assertEqual(len(self.history.colors), 3)
+
+class ExportTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.history = CountHistory(hot_rows=1000, segment_rows=500)
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "conteo.csv")
+    
+    def tearDown(self):
+        self.history.close()
+        self.dir.cleanup()
+    
+    def test_snapshot_keeps_segments_after_clear(self):
+        fill(self.history, 3200)
+        snapshot = self.history.snapshot()
+        paths = [path for path, _ in snapshot.segments]
+        spill_dir = self.history.spill_dir
+        
+        # La exportación sigue leyendo mientras el motor resetea y vuelve a volcar
+        self.history.clear()
+        fill(self.history, 1200)
+        self.history.close()
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        self.assertTrue(write_count_csv(snapshot, self.path))
+        
+        snapshot.close()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        self.assertFalse(os.path.exists(spill_dir))
+        with open(self.path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 3201)
+        self.assertEqual(lines[0], "FECHA_HORA,COLOR,ROJO,VERDE,AZUL,OTRO,TOTAL,DETECCIONES,LINEA")
+        self.assertTrue(lines[-1].endswith(",ROJO,3199,0,3199,0,6398,6398,L"))
+    
+    def test_progress_and_cancel(self):
+        fill(self.history, 3 * EXPORT_CHUNK_ROWS)
+        progress = []
+        self.assertTrue(write_count_csv(self.history, self.path, progress=lambda *p: progress.append(p)))
+        self.assertEqual(progress[-1], (3 * EXPORT_CHUNK_ROWS, 3 * EXPORT_CHUNK_ROWS))
+        self.assertEqual(len(progress), 4)
+        
+        cancel = threading.Event()
+        cancel.set()
+        self.assertFalse(write_count_csv(self.history, self.path, cancel))
+
+if __name__ == "__main__":
+    unittest.main()
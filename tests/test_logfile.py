@@ -0,0 +1,62 @@
+"""Archivo de log rotativo escrito desde un hilo propio"""
+
+import glob
+import gzip
+import os
+import tempfile
+import time
+import unittest
+
+from conveyor_core import LogFileSink, LogRecord
+
+class LogFileSinkTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cinta.log")
+    
+    def tearDown(self):
+        self.dir.cleanup()
+    
+    def segments(self):
+        """Segmentos cerrados del más antiguo al más reciente"""
+        return sorted(glob.glob(os.path.join(self.dir.name, "cinta_*.log*")), key=os.path.getmtime)
+    
+    def write_batches(self, sink, batches, size=20):
+        # Lotes escritos directamente: con la cola vacía el hilo escritor solo espera
+        for batch in range(batches):
+            sink._write([LogRecord(time.time(), "Conteo", f"Caja {batch}-{i} contada " + "x" * 40)
+                         for i in range(size)])
+    
+    def test_rotation_compresses_and_prunes(self):
+        sink = LogFileSink(self.path, max_bytes=1000, backups=3)
+        self.write_batches(sink, 6)
+        sink.close()
+        
+        self.assertIsNone(sink.error)
+        segments = self.segments()
+        self.assertEqual(len(segments), 3)
+        self.assertTrue(all(path.endswith(".log.gz") for path in segments))
+        with gzip.open(segments[-1], "rt", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 20)
+        self.assertTrue(lines[0].endswith("[Conteo] Caja 5-0 contada " + "x" * 40))
+        self.assertEqual(os.path.getsize(self.path), 0)
+    
+    def test_uncompressed_segments_and_append(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("línea previa\n")
+        sink = LogFileSink(self.path, max_bytes=10 ** 6, rotate_s=0, compress=False, backups=5)
+        self.write_batches(sink, 2, size=3)
+        sink.close()
+        
+        # rotate_s=0: cada lote cierra un segmento
+        segments = self.segments()
+        self.assertEqual(len(segments), 2)
+        with open(segments[0], encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], "línea previa")
+        self.assertEqual(len(lines), 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Buffer de log acotado, índice de búsqueda y archivo de log"""
+
+import unittest
+
+from conveyor_core import IndexedLogBuffer, LOG_PRUNE_MIN, LOG_TERM, LogRecord, LogRingBuffer
+
+WORDS = ("rojo", "roja", "verde", "caja", "cajas", "total", "conteo")
+
+def message(i):
+    return f"{WORDS[i % 7]} {WORDS[i * 3 % 7]} {i % 1000}"
+
+def record(i, category="Conteo"):
+    return LogRecord(float(i), category, message(i))
+
+class LogRingBufferTest(unittest.TestCase):
+    
+    def test_retention_cap(self):
+        buffer = LogRingBuffer(capacity=5)
+        for i in range(12):
+            buffer.append(record(i))
+        
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual((buffer.first_seq, buffer.next_seq), (7, 12))
+        self.assertEqual([r.timestamp for r in buffer], [7.0, 8.0, 9.0, 10.0, 11.0])
+        self.assertEqual(buffer.get(9).timestamp, 9.0)
+        self.assertEqual([r.timestamp for r in buffer.slice(3, 10)], [10.0, 11.0])
+    
+    def test_resize_keeps_newest(self):
+        buffer = LogRingBuffer(capacity=5)
+        for i in range(8):
+            buffer.append(record(i))
+        buffer.resize(2)
+        self.assertEqual([r.timestamp for r in buffer], [6.0, 7.0])
+        self.assertEqual(buffer.first_seq, 6)
+        
+        buffer.resize(4)
+        buffer.append(record(8))
+        self.assertEqual([r.timestamp for r in buffer], [6.0, 7.0, 8.0])
+    
+    def test_clear_keeps_sequence(self):
+        buffer = LogRingBuffer(capacity=3)
+        for i in range(4):
+            buffer.append(record(i))
+        buffer.clear()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.first_seq, 4)
+        buffer.append(record(4))
+        self.assertEqual(buffer.get(4).timestamp, 4.0)
+
+class LogIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.buffer = IndexedLogBuffer(capacity=300)
+        for i in range(LOG_PRUNE_MIN * 5 + 17):
+            self.buffer.append(record(i, "Conteo" if i % 3 else "Errores"))
+    
+    def scan(self, text, since=None, category=None):
+        """Resultado esperado recorriendo los registros retenidos"""
+        words = LOG_TERM.findall(text.upper())
+        first = self.buffer.first_seq if since is None else max(since, self.buffer.first_seq)
+        result = []
+        for seq in range(first, self.buffer.next_seq):
+            record = self.buffer.get(seq)
+            terms = LOG_TERM.findall(record.message.upper())
+            if category not in (None, record.category):
+                continue
+            if all(any(term.startswith(word) for term in terms) for word in words):
+                result.append(seq)
+        return result
+    
+    def test_prune_keeps_only_retained_postings(self):
+        index = self.buffer.index
+        self.assertLess(self.buffer.first_seq - index.base, LOG_PRUNE_MIN)
+        self.assertEqual(len(index.timestamps), self.buffer.next_seq - index.base)
+        self.assertEqual(len(index.entry_terms), self.buffer.next_seq - index.base)
+        for postings in list(index.terms.values()) + list(index.categories.values()):
+            self.assertGreaterEqual(postings[0], index.base)
+        
+        # Las palabras que solo tenían registros descartados desaparecen del índice
+        self.assertEqual(set(index.terms), {term for terms in index.entry_terms for term in terms.split()})
+    
+    def test_resize_prunes_at_once(self):
+        self.buffer.resize(10)
+        self.assertEqual(self.buffer.index.base, self.buffer.first_seq)
+        self.assertEqual(list(self.buffer.search(text="caja")), self.scan("caja"))
+    
+    def test_search_after_prunes(self):
+        for text in ("ROJ", "caja", "caj tot", "zzz"):
+            self.assertEqual(list(self.buffer.search(text=text)), self.scan(text), text)
+        self.assertEqual(list(self.buffer.search(category="Errores", text="verde")),
+                         self.scan("verde", category="Errores"))
+    
+    def test_numbers_are_not_indexed(self):
+        self.assertFalse(any(term.isdigit() for term in self.buffer.index.terms))
+        for text in ("99", "caja 12", "1 2", "rojo 5"):
+            self.assertEqual(list(self.buffer.search(text=text)), self.scan(text), text)
+    
+    def test_incremental_search(self):
+        since = self.buffer.next_seq
+        for i in range(since, since + 40):
+            self.buffer.append(record(i, "Errores"))
+        
+        # Solo lo nuevo desde la última búsqueda, con números y rango de tiempo
+        self.assertEqual(list(self.buffer.search(category="Errores", text="caj", since=since)),
+                         self.scan("caj", since=since, category="Errores"))
+        found = self.buffer.search(text="verde 3", start=since + 10.0, end=since + 30.0)
+        self.assertEqual(list(found), [seq for seq in self.scan("verde 3", since=since + 10) if seq < since + 30])
+        self.assertTrue(found)
+
+if __name__ == "__main__":
+    unittest.main()
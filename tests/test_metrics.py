@@ -0,0 +1,63 @@
+"""Histogramas por etapa, contadores y endpoint /metrics"""
+
+import unittest
+import urllib.error
+import urllib.request
+
+from conveyor_core import LatencyHistogram, METRICS_BUCKETS_S, Metrics, MetricsServer
+
+class LatencyHistogramTest(unittest.TestCase):
+    
+    def test_quantiles(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.quantile(0.5))
+        for _ in range(90):
+            histogram.observe(3e-6)
+        for _ in range(10):
+            histogram.observe(0.010)
+        
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.quantile(0.5), 4e-6)  # Límite de la cubeta de 2^2 µs
+        self.assertEqual(histogram.quantile(0.99), 0.010)  # Acotado por el máximo observado
+        histogram.observe(60.0)  # Fuera de las cubetas: +Inf
+        self.assertEqual(histogram.buckets[-1], 1)
+        self.assertEqual(histogram.quantile(1.0), 60.0)
+
+class PrometheusTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.observe("parseo", 3e-6)
+        self.metrics.observe("parseo", 5.0)
+        self.metrics.inc("mensajes", "Color:")
+        self.metrics.inc("mensajes", 'raro"\n', 2)
+        self.metrics.gauge("cola_gui", "Eventos en la cola de la GUI", lambda: 7)
+        self.metrics.gauge("roto", "Falla al leerse", lambda: 1 / 0)
+    
+    def test_text_format(self):
+        lines = self.metrics.prometheus().splitlines()
+        
+        self.assertIn("# TYPE conveyor_parseo_seconds histogram", lines)
+        buckets = [line for line in lines if line.startswith("conveyor_parseo_seconds_bucket")]
+        self.assertEqual(len(buckets), len(METRICS_BUCKETS_S) + 1)
+        self.assertEqual(buckets[2], 'conveyor_parseo_seconds_bucket{le="4e-06"} 1')
+        self.assertEqual(buckets[-1], 'conveyor_parseo_seconds_bucket{le="+Inf"} 2')
+        self.assertIn("conveyor_parseo_seconds_count 2", lines)
+        self.assertIn('conveyor_mensajes_total{tipo="Color:"} 1', lines)
+        self.assertIn('conveyor_mensajes_total{tipo="raro\\"\\n"} 2', lines)
+        self.assertIn("conveyor_cola_gui 7", lines)
+        self.assertFalse(any("roto" in line for line in lines))
+    
+    def test_http_endpoint(self):
+        server = MetricsServer(self.metrics, port=0)
+        try:
+            with urllib.request.urlopen(server.url, timeout=5) as response:
+                self.assertIn("text/plain", response.headers["Content-Type"])
+                self.assertEqual(response.read().decode("utf-8"), self.metrics.prometheus())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(server.url.replace("/metrics", "/otra"), timeout=5)
+        finally:
+            server.close()
+
+if __name__ == "__main__":
+    unittest.main()
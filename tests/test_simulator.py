@@ -0,0 +1,96 @@
+"""Simulador de ESP32 conectado al motor por TCP en cada modo del protocolo"""
+
+import asyncio
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from conveyor_core import ConveyorEngine
+from esp32_simulator import SimulatedESP32
+
+def simulator_args(**options):
+    args = dict(host="127.0.0.1", rate=2000, burst=None, autostart=False, malformed=0, alert_every=0,
+                drop_every=0, reset_on_drop=False, no_push=False, no_binary=False, no_delta=False,
+                lose_events=0)
+    args.update(options)
+    return SimpleNamespace(**args)
+
+class SimulatorTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.engine = ConveyorEngine()
+        self.server = None
+    
+    def tearDown(self):
+        self.engine.shutdown()
+        asyncio.run_coroutine_threadsafe(self.stop_device(), self.loop).result(2)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2)
+        self.loop.close()
+    
+    async def stop_device(self):
+        if self.server is not None:
+            self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def start_device(self, **options):
+        device = SimulatedESP32(0, simulator_args(**options))
+        
+        async def serve():
+            self.server = await asyncio.start_server(device.handle_client, "127.0.0.1", 0)
+            self.loop.create_task(device.generate())
+            return self.server.sockets[0].getsockname()[1]
+        return device, asyncio.run_coroutine_threadsafe(serve(), self.loop).result(2)
+    
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("tiempo de espera agotado")
+            time.sleep(0.02)
+    
+    def run_boxes(self, device, port, boxes=300):
+        self.engine.add_line("Sim", "127.0.0.1", port)
+        self.engine.connect("Sim")
+        line = self.engine.lines["Sim"]
+        self.wait_for(lambda: line.connected)
+        self.engine.set_polling(100)
+        
+        self.engine.send_command("START", ["Sim"])
+        self.wait_for(lambda: device.total >= boxes)
+        self.engine.send_command("STOP", ["Sim"])
+        self.wait_for(lambda: not line.system_running)
+        # Con la cinta detenida los contadores del motor alcanzan a los de la ESP32
+        self.wait_for(lambda: self.engine.run_sync(line.counts) == device.counts())
+        return line
+    
+    def test_text_protocol(self):
+        device, port = self.start_device()
+        line = self.run_boxes(device, port)
+        self.assertEqual(line.protocol, "texto")
+        self.assertEqual(len(self.engine.history), device.total)
+    
+    def test_binary_push_protocol(self):
+        self.engine.binary_protocol = True
+        self.engine.push_updates = True
+        device, port = self.start_device()
+        line = self.run_boxes(device, port)
+        self.assertEqual(line.protocol, "bin1")
+        self.assertTrue(line.push)
+    
+    def test_delta_sync_with_lost_events(self):
+        self.engine.delta_sync = True
+        device, port = self.start_device(lose_events=0.02)
+        line = self.run_boxes(device, port, boxes=1000)
+        self.assertTrue(line.delta)
+        self.assertGreater(self.engine.metrics.counters.get(("sincronizacion", "hueco"), 0), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""Registro de eventos en SQLite"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from conveyor_core import ConveyorEngine, Event
+from conveyor_store import EventStore
+
+class EventStoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "eventos.db")
+    
+    def tearDown(self):
+        self.dir.cleanup()
+    
+    def test_recovered_counts_keep_their_boxes(self):
+        store = EventStore(self.path)
+        store._on_event(Event("count", "L", ("ROJO", (1, 0, 0, 0, 1, 1), 1)))
+        store._on_event(Event("count", "L", ("ROJO", (51, 0, 0, 0, 51, 51), 50)))
+        store.close()
+        
+        rows = store.query(kind="count")
+        self.assertEqual([(color, n, total) for _, _, _, color, n, total, _ in rows], [("ROJO", 1, 1), ("ROJO", 50, 51)])
+        self.assertEqual(rows[-1][-1], [51, 0, 0, 0, 51, 51])
+
+    def test_count_totals_sum_boxes(self):
+        store = EventStore(self.path)
+        store.record("count", "A", "ROJO", 1, ts=10.0)
+        store.record("count", "A", "ROJO", 51, ts=11.0, n=50)
+        store.record("count", "B", "AZUL", 1, ts=12.0)
+        store.record("detection", "A", total=52, ts=12.5)
+        store.close()
+        
+        self.assertEqual(store.count_totals(), {"ROJO": 51, "AZUL": 1})
+        self.assertEqual(store.count_totals(start=11.0, end=12.0), {"ROJO": 50})
+        self.assertEqual(store.count_totals(line="B"), {"AZUL": 1})
+        self.assertEqual(store.written, 4)
+    
+    def test_query_filters_and_order(self):
+        store = EventStore(self.path)
+        for ts in (3.0, 1.0, 2.0):
+            store.record("alarm", "L", data=f"alarma {ts:g}", ts=ts)
+        store.record("status", "M", data={"running": True}, ts=1.5)
+        store.close()
+        
+        self.assertEqual([row[0] for row in store.query()], [1.0, 1.5, 2.0, 3.0])
+        self.assertEqual([row[-1] for row in store.query(start=1.0, end=3.0, kind="alarm")], ["alarma 1", "alarma 2"])
+        self.assertEqual(store.query(line="M"), [(1.5, "M", "status", None, 1, None, {"running": True})])
+        self.assertEqual(len(store.query(limit=2)), 2)
+        
+        # Los lotes quedan confirmados en la base en modo WAL
+        conn = sqlite3.connect(self.path)
+        try:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        finally:
+            conn.close()
+    
+    def test_engine_status_transitions(self):
+        engine = ConveyorEngine()
+        store = EventStore(self.path)
+        try:
+            engine.add_line("L", "127.0.0.1", 1)
+            store.attach(engine)
+            for running in (False, True, True, False):
+                engine.run_sync(self.set_running, engine, running)
+            engine.run_sync(engine.alarm, "Atasco en la cinta\n", engine.lines["L"])
+        finally:
+            engine.shutdown()
+            store.close()
+        
+        self.assertEqual([row[-1]["running"] for row in store.query(kind="status")], [False, True, False])
+        self.assertEqual([row[-1] for row in store.query(kind="alarm")], ["Atasco en la cinta"])
+    
+    @staticmethod
+    def set_running(engine, running):
+        engine.lines["L"].system_running = running
+        engine.bus.publish("status", "L")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Caudal por cubetas y decimación para la gráfica"""
+
+import unittest
+
+from conveyor_core import THROUGHPUT_MIN_BUCKETS, ThroughputHistory, ThroughputRing, decimate_minmax
+
+class ThroughputRingTest(unittest.TestCase):
+    
+    def test_buckets_and_reuse(self):
+        ring = ThroughputRing(60, 10)
+        ring.add(0.5, "ROJO")
+        ring.add(59.9, "ROJO", 3)
+        ring.add(61.0, "AZUL")
+        ring.add(61.0, "NINGUNO")  # Sin columna: solo abre la cubeta
+        self.assertEqual(ring.series("ROJO", 0, 2), [4, 0, 0])
+        self.assertEqual(ring.series("AZUL", 0, 2), [0, 1, 0])
+        
+        # La cubeta 10 reutiliza la posición de la 0: la vieja deja de existir
+        ring.add(600.0, "VERDE")
+        self.assertEqual(ring.series("ROJO", 0, 0), [0])
+        self.assertEqual(ring.series("VERDE", 9, 10), [0, 1])
+    
+    def test_level_for_span(self):
+        history = ThroughputHistory()
+        seconds = [level.seconds for level in history.levels]
+        self.assertEqual(seconds, [1, 60, 3600])
+        self.assertEqual(history.level_for(600).seconds, 1)
+        self.assertEqual(history.level_for(THROUGHPUT_MIN_BUCKETS * 60).seconds, 60)
+        self.assertEqual(history.level_for(30 * 24 * 3600).seconds, 3600)
+        
+        history.add(7200.0, "ROJO", 5)
+        self.assertEqual([sum(level.series("ROJO", 7200 // level.seconds, 7200 // level.seconds))
+                          for level in history.levels], [5, 5, 5])
+
+class DecimateTest(unittest.TestCase):
+    
+    def test_short_series_is_kept(self):
+        self.assertEqual(decimate_minmax([3, 1, 2], 10), [(0, 3), (1, 1), (2, 2)])
+    
+    def test_peaks_survive(self):
+        values = [0] * 10000
+        values[1234] = 99
+        values[8765] = -5
+        points = decimate_minmax(values, 100)
+        
+        self.assertLessEqual(len(points), 200)
+        self.assertIn((1234, 99), points)
+        self.assertIn((8765, -5), points)
+        self.assertEqual([i for i, _ in points], sorted(i for i, _ in points))
+
+if __name__ == "__main__":
+    unittest.main()
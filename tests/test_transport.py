@@ -0,0 +1,157 @@
+"""Transporte asyncio: framing de líneas y conexiones"""
+
+import asyncio
+import socket
+import threading
+import time
+import unittest
+
+from conveyor_core import AsyncTransport, BINARY_MODE, COLOR_FRAME, FRAME_COLOR, FRAME_DETECTION, FRAME_HEADER, RECV_BUFFER_SIZE
+
+class FakeConnection:
+    
+    def __init__(self):
+        self.binary = False
+        self.lines = []
+        self.frames = []
+    
+    def on_line(self, line):
+        self.lines.append(line)
+    
+    def on_frame(self, frame_type, buf, offset, length):
+        self.frames.append((frame_type, bytes(buf[offset:offset + length])))
+
+def consume(conn, data, scan=0):
+    buf = bytearray(data)
+    return AsyncTransport._consume(conn, buf, memoryview(buf), scan, len(buf))
+
+class PeerServer:
+    """Servidor TCP de una sola conexión; handler recibe el socket aceptado"""
+    
+    def __init__(self, handler):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, args=(handler,), daemon=True)
+        self.thread.start()
+    
+    def _serve(self, handler):
+        client, _ = self.sock.accept()
+        with client:
+            handler(client)
+    
+    def close(self):
+        self.sock.close()
+        self.thread.join(timeout=2)
+
+class ConsumeTest(unittest.TestCase):
+    
+    def test_lines_and_blank_lines(self):
+        conn = FakeConnection()
+        data = b'{"type":"init"}\r\n\n  \nDETECTADO\n'
+        self.assertEqual(consume(conn, data), len(data))
+        self.assertEqual(conn.lines, ['{"type":"init"}', "DETECTADO"])
+    
+    def test_partial_line_is_kept(self):
+        conn = FakeConnection()
+        rest = consume(conn, b"DETECTADO\nColor: RO")
+        self.assertEqual(conn.lines, ["DETECTADO"])
+        self.assertEqual(rest, len(b"DETECTADO\n"))
+        
+        # Al completar la línea solo se buscan saltos en los bytes nuevos
+        data = b"Color: ROJO\n"
+        self.assertEqual(consume(conn, data, scan=len(b"Color: RO")), len(data))
+        self.assertEqual(conn.lines, ["DETECTADO", "Color: ROJO"])
+    
+    def test_switch_to_binary_after_proto_line(self):
+        conn = FakeConnection()
+        
+        def on_line(line):
+            conn.lines.append(line)
+            if BINARY_MODE in line:
+                conn.binary = True
+        conn.on_line = on_line
+        color = FRAME_HEADER.pack(COLOR_FRAME.size, FRAME_COLOR) + COLOR_FRAME.pack(2)
+        data = (b'Color: ROJO\n{"type":"proto","mode":"bin1"}\n' + FRAME_HEADER.pack(0, FRAME_DETECTION)
+                + color + color[:2])
+        
+        # Los bytes tras la línea que negocia ya son tramas; la última está incompleta
+        rest = consume(conn, data)
+        self.assertEqual(conn.lines, ["Color: ROJO", '{"type":"proto","mode":"bin1"}'])
+        self.assertEqual(conn.frames, [(FRAME_DETECTION, b""), (FRAME_COLOR, b"\x02")])
+        self.assertEqual(rest, len(data) - 2)
+
+class TransportTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.transport = AsyncTransport()
+        self.lines = []
+        self.closed = threading.Event()
+    
+    def tearDown(self):
+        self.transport.shutdown()
+    
+    def connect(self, port, on_connected=None):
+        self.transport.connect("L", "127.0.0.1", port, self.lines.append,
+                               on_connected or (lambda host, port: None), self.fail,
+                               lambda error: self.closed.set()).result(2)
+    
+    def test_split_and_oversized_lines(self):
+        long_line = "x" * (RECV_BUFFER_SIZE * 2)
+        
+        def send(client):
+            for piece in (b"DETEC", b"TADO\nColor: ", b"ROJO\n", long_line.encode() + b"\nfin\n"):
+                client.sendall(piece)
+                time.sleep(0.02)
+        server = PeerServer(send)
+        try:
+            self.connect(server.port)
+            self.assertTrue(self.closed.wait(2))
+        finally:
+            server.close()
+        self.assertEqual(self.lines, ["DETECTADO", "Color: ROJO", long_line, "fin"])
+    
+    def test_writer_is_cancelled_when_peer_closes(self):
+        connections = []
+        server = PeerServer(lambda client: None)
+        try:
+            self.connect(server.port, lambda host, port: connections.append(self.transport.connections["L"]))
+            self.assertTrue(self.closed.wait(2))
+        finally:
+            server.close()
+        
+        async def writer_done():
+            await asyncio.sleep(0)  # La cancelación se completa en la siguiente vuelta del loop
+            return connections[0].writer.done()
+        self.assertTrue(self.transport.submit(writer_done()).result(2))
+        self.assertNotIn("L", self.transport.connections)
+    
+    def test_urgent_data_goes_first(self):
+        received = []
+        done = threading.Event()
+        
+        def read(client):
+            data = b""
+            while data.count(b"\n") < 3:
+                data += client.recv(1024)
+            received.append(data)
+            done.set()
+        server = PeerServer(read)
+        try:
+            def queue():
+                for data, urgent, coalesce in ((b"GET_DATA\n", False, True), (b"GET_DATA\n", False, True),
+                                               (b"START\n", False, False), (b"STOP\n", True, False)):
+                    self.transport.queue_send("L", data, urgent, coalesce)
+                self.assertEqual(self.transport.discard("L", (b"START\n",)), [b"START\n"])
+                self.transport.queue_send("L", b"RESET_COUNTERS\n")
+            
+            # Se encola todo en una vuelta del loop, antes de que el escritor envíe nada
+            self.connect(server.port, lambda host, port: queue())
+            self.assertTrue(done.wait(2))
+        finally:
+            server.close()
+        self.assertEqual(received, [b"STOP\nGET_DATA\nRESET_COUNTERS\n"])
+
+if __name__ == "__main__":
+    unittest.main()